@@ -0,0 +1,50 @@
+// Client side half of the geometry-once map mode in dashboard_future.py.
+// Polygons arrive once per breakdown through the map-geometry store and are kept here,
+// later updates only carry the demand vector in map-values.
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map: {
+        geometry: {},
+
+        request_geometry: function (breakdown) {
+            if (!breakdown || breakdown in window.dash_clientside.map.geometry) {
+                return window.dash_clientside.no_update;
+            }
+            return breakdown;
+        },
+
+        render: function (geometry, values) {
+            const cache = window.dash_clientside.map.geometry;
+            if (geometry && !(geometry.breakdown in cache)) {
+                cache[geometry.breakdown] = geometry;
+            }
+            if (!values || !(values.breakdown in cache)) {
+                // Geometry for this breakdown is still on its way
+                return window.dash_clientside.no_update;
+            }
+            const shape = cache[values.breakdown];
+            const center = {lat: 37.0902, lon: -95.7129};
+            return {
+                data: [{
+                    type: 'choroplethmapbox',
+                    geojson: shape.geojson,
+                    locations: shape.locations,
+                    z: values.demand,
+                    customdata: shape.regions,
+                    coloraxis: 'coloraxis',
+                    marker: {opacity: 0.5},
+                    hovertemplate: shape.label + '=%{customdata}<br>demand=%{z}<extra></extra>',
+                }],
+                layout: {
+                    coloraxis: {
+                        colorscale: [[0, 'green'], [1, 'red']],
+                        colorbar: {title: {text: 'demand'}},
+                    },
+                    mapbox: {center: center, zoom: 3, style: 'carto-positron'},
+                    margin: {r: 0, t: 0, l: 0, b: 0},
+                    title: {text: shape.title},
+                    legend: {tracegroupgap: 0},
+                },
+            };
+        },
+    },
+});
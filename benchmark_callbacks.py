@@ -0,0 +1,235 @@
+#import require package
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+from datetime import datetime
+
+import numpy as np
+from plotly.utils import PlotlyJSONEncoder
+
+"""
+====================================================================================================================
+Benchmark for the dashboard callbacks: imports the app, calls every callback function directly over a sweep of
+realistic inputs and records wall time (p50/p95), peak Python memory and response JSON size per case
+
+Run from the repository root:
+    python benchmark_callbacks.py --output bench.json
+    python benchmark_callbacks.py --output new.json --baseline bench.json --threshold 0.2
+The second form exits with status 1 when any case is slower (p50) or heavier (JSON size) than the baseline by more
+than the threshold
+====================================================================================================================
+"""
+
+breakdown_regions = {'country': 'USA', 'state': 'New York', 'subregion': 'p1'}
+benchmark_scenarios = ['rcp85hotter', 'rcp85cooler', 'rcp45hotter', 'rcp45cooler', 'projection']
+# (start_month, start_year, end_month, end_year)
+date_ranges = {'narrow': (6, 2050, 8, 2050), 'full': (1, 2020, 12, 2100)}
+
+
+def callback_function(app, output_id):
+    """
+    Return the undecorated function registered for an output, so it can be called without a Dash request.
+    """
+    callback = app.callback_map[output_id]['callback']
+    return getattr(callback, '__wrapped__', callback)
+
+
+def benchmark_cases(dashboard):
+    """
+    Yield (case name, function, arguments) for the whole parameter sweep.
+    """
+    app = dashboard.app
+    daily_compare = callback_function(app, 'compare-graph.figure')
+    weekly_compare = callback_function(app, 'compare-graph-week.figure')
+    scenario_graph = callback_function(app, 'line-graph.figure')
+    ci_graph = callback_function(app, 'line-graph-with-CI.figure')
+    weather_graph = callback_function(app, 'line-graph-for-weather.figure')
+    multi_compare = callback_function(app, 'multi-compare-graph.figure')
+
+    graph_toggle_options = getattr(dashboard.set_graph_toggle_options, '__wrapped__', dashboard.set_graph_toggle_options)
+    region_options = getattr(dashboard.set_region_options, '__wrapped__', dashboard.set_region_options)
+    flags = (False, True)
+
+    for breakdown, region in breakdown_regions.items():
+        yield f'set_graph_toggle_options|{breakdown}', graph_toggle_options, (breakdown,)
+        yield f'set_region_options|{breakdown}', region_options, (breakdown,)
+
+        for scenario_value, max_bool, projection_bool, (range_name, dates) in itertools.product(
+                benchmark_scenarios + ['spread'], flags, flags, date_ranges.items()):
+            args = (scenario_value, breakdown, *dates, max_bool, projection_bool)
+            suffix = f'{breakdown}|{scenario_value}|max={max_bool}|projection={projection_bool}|{range_name}'
+            yield f'update_map|{suffix}', dashboard.update_map, args
+            if hasattr(dashboard, 'update_map_values'):
+                yield f'update_map_values|{suffix}', dashboard.update_map_values, args
+
+        for view, group_by_year, max_bool, projection_bool, (range_name, dates) in itertools.product(
+                ('rcp85hotter', 'spread'), flags, flags, flags, date_ranges.items()):
+            view_name = '|spread' if view == 'spread' else ''
+            yield (f'line-graph{view_name}|{region}|yearly={group_by_year}|max={max_bool}|projection={projection_bool}|{range_name}',
+                   scenario_graph, (view, region, *dates, group_by_year, max_bool, projection_bool))
+
+        for yearly_bool, projection_bool, (range_name, dates) in itertools.product(flags, flags, date_ranges.items()):
+            yield (f'line-graph-with-CI|{region}|yearly={yearly_bool}|projection={projection_bool}|{range_name}',
+                   ci_graph, (region, *dates, projection_bool, yearly_bool))
+
+        for weather, heat_or_cold, projection_bool, (range_name, dates) in itertools.product(
+                ('Num_of_days', 'average_t2', 'degree_day'), ('Heat', 'Cold'), flags, date_ranges.items()):
+            yield (f'line-graph-for-weather|{region}|{weather}|{heat_or_cold}|projection={projection_bool}|{range_name}',
+                   weather_graph, (region, dates[1], dates[3], weather, heat_or_cold, projection_bool, 'summary', None))
+
+        # Extreme days detected on the fly when extreme_days.py has been run: the first region runs the detections,
+        # the other regions read the results kept for these thresholds
+        if getattr(dashboard, 'extreme_days', None) is not None:
+            for i, (weather, heat_or_cold, mode) in enumerate(itertools.product(
+                    ('Num_of_days', 'average_t2'), ('Heat', 'Cold'), ('percentile', 'absolute'))):
+                # Near each mode's default and a little more extreme, a different threshold per case
+                shift = i if mode == 'absolute' and heat_or_cold == 'Heat' else -i
+                threshold = dashboard.default_thresholds[mode][heat_or_cold] + shift
+                yield (f'line-graph-for-weather|{region}|{weather}|{heat_or_cold}|{mode}={threshold}',
+                       weather_graph, (region, 2020, 2100, weather, heat_or_cold, False, mode, threshold))
+
+        for scenario_value, max_bool, projection_bool in itertools.product(benchmark_scenarios, flags, flags):
+            args = (2030, 'Weekday', scenario_value, region, 2080, 'Weekend', 'projection', region, max_bool, projection_bool)
+            suffix = f'{region}|{scenario_value}|max={max_bool}|projection={projection_bool}'
+            yield f'compare-graph|{suffix}', daily_compare, args
+            yield f'compare-graph-week|{suffix}', weekly_compare, args
+
+    # Many series from few files: 20 balancing areas over three years and the benchmark scenarios
+    subregions = [f'p{i}' for i in range(1, 21)]
+    for window, max_bool, projection_bool in itertools.product(('each', 'merged'), flags, flags):
+        args = (subregions, [2030, 2050, 2080], list(benchmark_scenarios), 'Weekday', window, max_bool, projection_bool)
+        yield f'multi-compare-graph|20 regions|{window}|max={max_bool}|projection={projection_bool}', multi_compare, args
+
+
+def response_size(result):
+    """
+    Size of the JSON Dash would send back for a callback result.
+    """
+    if hasattr(result, 'to_plotly_json'):
+        result = result.to_plotly_json()
+    return len(json.dumps(result, cls=PlotlyJSONEncoder))
+
+
+def run_case(function, args, repeat):
+    """
+    Time one case; the first call warms caches and is measured separately as the cold time.
+    """
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+    except Exception as e:
+        return {'error': f'{type(e).__name__}: {e}'}
+    cold = time.perf_counter() - start
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'cold_s': cold,
+        'p50_s': float(np.percentile(timings, 50)),
+        'p95_s': float(np.percentile(timings, 95)),
+        'peak_bytes': peak,
+        'json_bytes': response_size(result),
+    }
+
+
+def compare_results(results, baseline, threshold, min_delta_s=0.001):
+    """
+    List the cases that got slower or heavier than the baseline by more than threshold (a fraction).
+    Slowdowns smaller than min_delta_s are timer noise on sub-millisecond callbacks and are ignored.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None or 'error' in current or 'error' in previous:
+            continue
+        for metric, floor in (('p50_s', min_delta_s), ('json_bytes', 0)):
+            if current[metric] > previous[metric] * (1 + threshold) and current[metric] - previous[metric] > floor:
+                regressions.append((name, metric, previous[metric], current[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard callbacks.')
+    parser.add_argument('--output', default='bench_output.json', help='where to write the results')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 is 20%%')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='ignore slowdowns smaller than this')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per case after the warm-up call')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this text')
+    parser.add_argument('--figure-cache', action='store_true',
+                        help='keep the memoized figure cache on; by default every case is rendered from scratch')
+    args = parser.parse_args()
+    if not args.figure_cache:
+        os.environ['FIGURE_CACHE'] = '0'
+
+    warnings.filterwarnings('ignore')
+    sys.path.insert(0, os.getcwd())
+    start = time.perf_counter()
+    import dashboard_future
+    import_s = time.perf_counter() - start
+
+    results = {}
+    for name, function, call_args in benchmark_cases(dashboard_future):
+        if args.filter in name:
+            # Some callbacks print their errors instead of raising them; a case that prints anything is an error
+            printed = io.StringIO()
+            with contextlib.redirect_stdout(printed):
+                results[name] = run_case(function, call_args, args.repeat)
+            if printed.getvalue().strip() and 'error' not in results[name]:
+                results[name] = {'error': f'printed: {printed.getvalue().strip()[:500]}'}
+
+    report = {
+        'meta': {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'import_s': import_s,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    # Summary per callback
+    errors = sum('error' in r for r in results.values())
+    print(f"Imported dashboard in {import_s:.2f}s, ran {len(results)} cases ({errors} errors), wrote {args.output}")
+    by_callback = {}
+    for name, result in results.items():
+        if 'error' not in result:
+            by_callback.setdefault(name.split('|')[0], []).append(result)
+    for callback, rows in by_callback.items():
+        print(f"{callback:<26} cases={len(rows):<4} p50={np.median([r['p50_s'] for r in rows]) * 1000:8.2f}ms "
+              f"p95={np.max([r['p95_s'] for r in rows]) * 1000:8.2f}ms "
+              f"json={np.median([r['json_bytes'] for r in rows]) / 1024:8.1f}KB")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare_results(results, baseline, args.threshold, args.min_delta_ms / 1000)
+        for name, metric, before, after in regressions:
+            print(f'REGRESSION {name} {metric}: {before:.6g} -> {after:.6g}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions above {args.threshold:.0%} against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+#import require package
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from quantile_sketch import sketch_hourly, write_sketches
+from scenario_cube import scenarios
+
+"""
+====================================================================================================================
+Offline build of the hour-of-day and weekday aggregates read by the comparison graphs
+
+Input, one file per scenario and projection flag in the hourly folder:
+    mock_{scenario}_hourly.csv / _project_mock_{scenario}_hourly.csv
+    with a Time_UTC column and one hourly demand column per region (same names as the monthly files)
+Output, in web_page_data:
+    mock_{scenario}_yearly_aggregated.csv  Year, Weekend_or_Weekday, Hour, {region}_mean/_upper/_lower/_max
+    mock_{scenario}_weekly.csv             Year, weekday, {region}_mean/_upper/_lower/_max (daily totals)
+    mock_{scenario}_sketch.npz             mergeable quantile sketches by year, day type, hour and region
+    and the _project_ variants
+
+Scenarios are built in parallel, and an output is rebuilt only when the content hash of its input changed.
+Run from the repository root:  python build_aggregates.py [--hourly-folder hourly_data] [--workers 4] [--force]
+====================================================================================================================
+"""
+
+manifest_file = 'aggregate_manifest.json'
+# Bump when the aggregation itself changes, so every output is rebuilt once
+aggregate_version = 2
+# Quantiles drawn as the shaded band of the comparison graphs
+upper_quantile = 0.95
+lower_quantile = 0.05
+non_region_columns = ('Unnamed: 0', 'Time_UTC', 'Year', 'Month', 'Day', 'Hour')
+
+
+def prefix(projection_bool):
+    return '_project_' if projection_bool else ''
+
+
+def hourly_file_name(scenario_value, projection_bool):
+    return f'{prefix(projection_bool)}mock_{scenario_value}_hourly.csv'
+
+
+def output_file_names(scenario_value, projection_bool):
+    return (f'{prefix(projection_bool)}mock_{scenario_value}_yearly_aggregated.csv',
+            f'{prefix(projection_bool)}mock_{scenario_value}_weekly.csv',
+            f'{prefix(projection_bool)}mock_{scenario_value}_sketch.npz')
+
+
+def content_hash(file_path, chunk_size=1 << 20):
+    """
+    SHA-256 of a file, read in chunks so large hourly files are never fully loaded.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def summarize(grouped, regions):
+    """
+    Mean, upper/lower quantile and max of every region for each group, as {region}_{stat} columns.
+    """
+    stats = {
+        'mean': grouped.mean(),
+        'upper': grouped.quantile(upper_quantile),
+        'lower': grouped.quantile(lower_quantile),
+        'max': grouped.max(),
+    }
+    columns = {f'{region}_{stat}': stats[stat][region] for region in regions for stat in stats}
+    return pd.DataFrame(columns).reset_index()
+
+
+def read_hourly(file_path):
+    """
+    Read an hourly model output file and return its timestamps and the region columns.
+    """
+    df = pd.read_csv(file_path, parse_dates=['Time_UTC'])
+    regions = [c for c in df.columns if c not in non_region_columns]
+    return pd.DatetimeIndex(df['Time_UTC']), df[regions]
+
+
+def hourly_profile(time, values):
+    """
+    Statistics of the hourly demand by year, day type and hour of day.
+    """
+    keys = [
+        pd.Series(time.year, name='Year'),
+        pd.Series(np.where(time.weekday >= 5, 'Weekend', 'Weekday'), name='Weekend_or_Weekday'),
+        pd.Series(time.hour, name='Hour'),
+    ]
+    return summarize(values.reset_index(drop=True).groupby(keys), values.columns)
+
+
+def weekly_profile(time, values):
+    """
+    Statistics of the daily demand totals by year and day of the week (0 is Monday).
+    """
+    daily = values.set_axis(time).groupby(time.normalize()).sum()
+    keys = [pd.Series(daily.index.year, name='Year'), pd.Series(daily.index.weekday, name='weekday')]
+    return summarize(daily.reset_index(drop=True).groupby(keys), values.columns)
+
+
+def build_one(job):
+    """
+    Build the aggregates of one scenario/projection pair; runs in a worker process.
+    """
+    input_path, daily_path, weekly_path, sketch_path = job
+    time, values = read_hourly(input_path)
+    for output_path, frame in ((daily_path, hourly_profile(time, values)), (weekly_path, weekly_profile(time, values))):
+        frame.to_csv(output_path + '.tmp', index=False)
+        os.replace(output_path + '.tmp', output_path)
+    write_sketches(sketch_path, sketch_hourly(time, values))
+    return input_path
+
+
+def build_aggregates(hourly_path, data_path, workers=None, force=False):
+    """
+    Rebuild every aggregate whose hourly input changed since the last run.
+
+    Parameters:
+    - hourly_path: folder holding the hourly model output.
+    - data_path: the web_page_data folder the dashboard reads; the manifest of input hashes is kept there too.
+    - workers: size of the process pool, defaults to the number of CPUs.
+    - force: rebuild everything regardless of the manifest.
+
+    Returns:
+    - The (built, skipped, missing) lists of hourly file names.
+    """
+    manifest_path = os.path.join(data_path, manifest_file)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    jobs, hashes, built, skipped, missing = [], {}, [], [], []
+    for scenario_value in scenarios:
+        for projection_bool in (False, True):
+            name = hourly_file_name(scenario_value, projection_bool)
+            input_path = os.path.join(hourly_path, name)
+            if not os.path.exists(input_path):
+                missing.append(name)
+                continue
+            outputs = [os.path.join(data_path, f) for f in output_file_names(scenario_value, projection_bool)]
+            hashes[name] = {'sha256': content_hash(input_path), 'version': aggregate_version}
+            if not force and manifest.get(name) == hashes[name] and all(os.path.exists(f) for f in outputs):
+                skipped.append(name)
+                continue
+            jobs.append((input_path, *outputs))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for input_path in pool.map(build_one, jobs):
+            name = os.path.basename(input_path)
+            manifest[name] = hashes[name]
+            built.append(name)
+            # Save after every output so an interrupted run keeps its finished work
+            with open(manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(manifest_path + '.tmp', manifest_path)
+    return built, skipped, missing
+
+
+if __name__ == '__main__':
+    current_directory = os.getcwd()
+    parser = argparse.ArgumentParser(description='Build the hourly profile and weekly aggregates for the dashboard.')
+    parser.add_argument('--hourly-folder', default=os.path.join(current_directory, 'hourly_data'))
+    parser.add_argument('--data-folder', default=os.path.join(current_directory, 'web_page_data'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='rebuild every output')
+    args = parser.parse_args()
+
+    built, skipped, missing = build_aggregates(args.hourly_folder, args.data_folder, args.workers, args.force)
+    print(f'Built {len(built)}, unchanged {len(skipped)}, missing input {len(missing)}')
+    for name in missing:
+        print(f'  no hourly input {name}')
@@ -0,0 +1,162 @@
+#import require package
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+"""
+====================================================================================================================
+Offline build of simplified map geometry: for every breakdown, write one GeoJSON per zoom tier with shared borders
+simplified together (so neighbouring regions still meet) and coordinates quantized to the tier's grid, then report
+vertex counts and payload size per tier
+
+Run from the repository root:  python build_geometry.py
+The dashboard only uses load_geometry_tier() at startup, so geopandas and shapely are imported by the build
+functions themselves and never on the dashboard's import path
+====================================================================================================================
+"""
+
+geometry_folder = 'geometry'
+report_file = 'geometry_report.json'
+
+# Highest map zoom each tier is drawn at, None keeps the source resolution
+zoom_tiers = {'zoom3': 3, 'zoom5': 5, 'zoom7': 7, 'full': None}
+
+
+def tolerance_for_zoom(zoom):
+    """
+    Half the width of a screen pixel in degrees at a web mercator zoom level, nothing smaller can be seen.
+    """
+    return 360 / (256 * 2 ** zoom) / 2
+
+
+def decimals_for_zoom(zoom):
+    """
+    Number of decimals to keep so the quantization grid is ten times finer than the simplification tolerance.
+    """
+    return int(np.ceil(-np.log10(tolerance_for_zoom(zoom) / 10)))
+
+
+def geometry_tier_for_zoom(zoom):
+    """
+    Pick the coarsest tier that still has enough detail for the rendered zoom.
+    """
+    for tier, max_zoom in zoom_tiers.items():
+        if max_zoom is not None and zoom <= max_zoom:
+            return tier
+    return 'full'
+
+
+def tier_path(data_path, breakdown, tier):
+    return os.path.join(data_path, geometry_folder, f'{breakdown}_{tier}.geojson')
+
+
+def load_geometry_tier(data_path, breakdown, zoom):
+    """
+    Read the prebuilt GeoJSON of a breakdown for the rendered zoom.
+
+    Returns:
+    - The GeoJSON dictionary, or None when the build step has not been run.
+    """
+    file_path = tier_path(data_path, breakdown, geometry_tier_for_zoom(zoom))
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def source_layers(data_path, resources_path):
+    """
+    Read every layer to simplify, reprojected to EPSG:4326 the same way the dashboard does.
+    """
+    import geopandas as gpd
+    import shapely
+    layers = {}
+    for breakdown in ('country', 'state', 'subregion'):
+        gdf = gpd.read_file(os.path.join(data_path, f'gdf_{breakdown}.gpkg'))
+        layers[breakdown] = gdf.to_crs(epsg=4326)
+    # Raw balancing-area polygons, stored as WKT in lon/lat
+    pca_path = os.path.join(resources_path, 'US_CAN_MEX_PCA_polygons.csv')
+    if os.path.exists(pca_path):
+        df = pd.read_csv(pca_path)
+        layers['pca'] = gpd.GeoDataFrame(df[['rb']], geometry=shapely.from_wkt(df['WKT']), crs='EPSG:4326')
+    return layers
+
+
+def simplify_layer(gdf, zoom):
+    """
+    Simplify a polygon layer for a zoom level. Shared borders are simplified once, so no new gaps or overlaps open
+    between neighbours; overlaps already in the source layer are kept as they are.
+    """
+    import geopandas as gpd
+    import shapely
+    if zoom is None:
+        return gdf
+    geometry = gdf.geometry.values
+    # coverage_simplify (shapely 2.1+, pinned in requirements.txt) simplifies each shared border once, so both sides
+    # stay identical; simplifying the polygons one by one would move a border differently on each side
+    simplified = shapely.coverage_simplify(geometry, tolerance_for_zoom(zoom))
+    # Shared vertices snap to the same grid point on both sides
+    grid = 10.0 ** -decimals_for_zoom(zoom)
+    quantized = shapely.set_precision(simplified, grid)
+    return gdf.set_geometry(gpd.GeoSeries(quantized, index=gdf.index, crs=gdf.crs))
+
+
+def round_coordinates(coordinates, decimals):
+    if isinstance(coordinates[0], (int, float)):
+        return [round(c, decimals) for c in coordinates]
+    return [round_coordinates(c, decimals) for c in coordinates]
+
+
+def layer_geojson(gdf, decimals):
+    """
+    Serialize a layer the way the dashboard sends it: feature ids from the index, coordinates rounded.
+    """
+    geojson = gdf.__geo_interface__
+    if decimals is not None:
+        for feature in geojson['features']:
+            geometry = feature['geometry']
+            geometry['coordinates'] = round_coordinates(geometry['coordinates'], decimals)
+    return geojson
+
+
+def build_geometry(data_path, resources_path):
+    """
+    Write every breakdown at every tier and return the size report.
+
+    Parameters:
+    - data_path: the web_page_data folder; tiers go to its geometry subfolder.
+    - resources_path: the resources folder holding the WKT polygons.
+
+    Returns:
+    - A list of dictionaries with breakdown, tier, vertices and bytes.
+    """
+    import shapely
+    os.makedirs(os.path.join(data_path, geometry_folder), exist_ok=True)
+    report = []
+    for breakdown, gdf in source_layers(data_path, resources_path).items():
+        for tier, zoom in zoom_tiers.items():
+            simplified = simplify_layer(gdf, zoom)
+            decimals = None if zoom is None else decimals_for_zoom(zoom)
+            payload = json.dumps(layer_geojson(simplified, decimals), separators=(',', ':'))
+            with open(tier_path(data_path, breakdown, tier), 'w') as f:
+                f.write(payload)
+            report.append({
+                'breakdown': breakdown,
+                'tier': tier,
+                'tolerance': None if zoom is None else tolerance_for_zoom(zoom),
+                'vertices': int(shapely.get_num_coordinates(simplified.geometry.values).sum()),
+                'bytes': len(payload),
+            })
+    with open(os.path.join(data_path, geometry_folder, report_file), 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    current_directory = os.getcwd()
+    report = build_geometry(os.path.join(current_directory, 'web_page_data'), os.path.join(current_directory, 'resources'))
+    print(f"{'breakdown':<10} {'tier':<6} {'vertices':>9} {'bytes':>10}")
+    for row in report:
+        print(f"{row['breakdown']:<10} {row['tier']:<6} {row['vertices']:>9} {row['bytes']:>10}")
@@ -0,0 +1,358 @@
+#import require package
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, request
+
+"""
+====================================================================================================================
+Per-callback timing for the Dash app, exposed in Prometheus text format on /metrics
+
+Every function registered with app.callback is wrapped. A request to /_dash-update-component is split into phases:
+    read       time inside the data readers, the functions decorated with @timed_phase('read')
+    compute    the filtering and reductions of the callbacks, marked with `with phase('compute'):`, plus any time
+               of the callback body outside every phase
+    figure     the go.Figure/add_trace/update_layout statements, marked with `with phase('figure'):`
+    serialize  Dash turning the result into the JSON response
+and the bytes read from disk, the response size and the input that triggered the call are recorded with it.
+
+Phases nest: time inside an inner phase counts for it only, a read inside a figure block is not figure time.
+Outside a Dash request (benchmark, pre-warming, export API) phase() and timed_phase() do nothing.
+
+gunicorn runs several workers, so the counts are summed in a SQLite file they all share: each worker adds what it
+recorded to the file every flush_interval_s seconds, and /metrics renders the totals of the file, the same whichever
+worker answers the scrape. Gauges describe one process and carry a worker label instead.
+====================================================================================================================
+"""
+
+time_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+size_buckets = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+# Seconds between two writes of a worker's new counts to the shared file
+flush_interval_s = 1
+# Every metric summed in the shared file: (name, type, help, histogram buckets)
+families = [
+    ('dash_callback_phase_seconds', 'histogram', 'Time spent per callback and phase.', time_buckets),
+    ('dash_callback_response_bytes', 'histogram', 'Size of the callback JSON response.', size_buckets),
+    ('dash_callback_read_bytes_total', 'counter', 'Bytes read from data files by the callback.', None),
+    ('dash_callback_triggers_total', 'counter', 'Callback calls by triggering input.', None),
+    ('data_cache_hits_total', 'counter', 'Reads served from the shared CSV cache.', None),
+    ('data_cache_misses_total', 'counter', 'Reads that parsed the file.', None),
+    ('data_cache_evictions_total', 'counter', 'Frames dropped to stay under the cache size.', None),
+    ('data_cache_invalidations_total', 'counter', 'Frames dropped because their file changed.', None),
+]
+
+
+# The callback request handled by the current thread, set by CallbackMetrics.start_request
+_current = threading.local()
+
+
+def current_call():
+    return getattr(_current, 'call', None)
+
+
+@contextmanager
+def phase(name):
+    """
+    Count the time of the block in a phase of the running callback; the enclosing phase is paused meanwhile.
+    """
+    call = current_call()
+    if call is None:
+        yield
+        return
+    stack = call['stack']
+    now = time.perf_counter()
+    if stack:
+        outer, started = stack[-1]
+        call['phases'][outer] = call['phases'].get(outer, 0.0) + now - started
+    stack.append((name, now))
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _, started = stack.pop()
+        call['phases'][name] = call['phases'].get(name, 0.0) + now - started
+        if stack:
+            stack[-1] = (stack[-1][0], now)
+
+
+def timed_phase(name):
+    """
+    Decorator counting every call of a function in a phase, see phase().
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_call() is None:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def label_text(labels):
+    return ','.join(f'{k}="{escape_label(v)}"' for k, v in labels)
+
+
+def format_value(value):
+    # The file stores every count as a REAL, counts are printed back as integers
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+class CallbackMetrics:
+    """
+    Timings of every callback request served by the server, summed over its worker processes.
+    """
+
+    def __init__(self, db_path):
+        """
+        Parameters:
+        - db_path: SQLite file shared by the workers; created if missing, its totals carry over restarts.
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        # Counts recorded since the last flush, {(sample, labels, le): increment}
+        self.pending = {}
+        # Functions returning the increments of counters kept elsewhere (the data cache) since their last call
+        self.collectors = []
+        self.extra_metrics = []
+        # Process running the flush thread; the metrics are created in the gunicorn master and the thread is started
+        # again in each forked worker
+        self.flush_pid = None
+        self.flush_lock = threading.Lock()
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS samples (name TEXT, labels TEXT, le TEXT, value REAL, '
+                               'PRIMARY KEY (name, labels, le))')
+
+    def connect(self):
+        # One short-lived connection per operation, safe from any thread or process
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # Collection inside a call ------------------------------------------------------------------------------------
+
+    def add_bytes_read(self, file_path, size):
+        call = current_call()
+        if call is not None:
+            call['bytes_read'] += size
+
+    def wrap_callback(self, function):
+        """
+        Time the whole body of a callback, the phases above are collected while it runs.
+        """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            call = current_call()
+            if call is None:
+                # Called outside a Dash request (tests, benchmarks), nothing to attribute the timing to
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                call['callback'] = time.perf_counter() - start
+        return wrapper
+
+    # Request bookkeeping -----------------------------------------------------------------------------------------
+
+    def start_request(self):
+        self.start_flusher()
+        _current.call = {'start': time.perf_counter(), 'phases': {}, 'stack': [], 'bytes_read': 0, 'callback': None}
+
+    def finish_request(self, response):
+        call = current_call()
+        _current.call = None
+        if call is None:
+            return response
+        total = time.perf_counter() - call['start']
+        body = request.get_json(silent=True) or {}
+        name = body.get('output', 'unknown')
+        trigger = ','.join(body.get('changedPropIds') or []) or 'initial'
+
+        phases = dict(call['phases'])
+        if call['callback'] is not None:
+            # Time of the callback outside every marked block is counted as compute too
+            unmarked = max(call['callback'] - sum(phases.values()), 0.0)
+            phases['compute'] = phases.get('compute', 0.0) + unmarked
+            phases['serialize'] = max(total - call['callback'], 0.0)
+        phases['total'] = total
+        size = response.calculate_content_length() or 0
+
+        with self.lock:
+            for phase, seconds in phases.items():
+                self.observe('dash_callback_phase_seconds', time_buckets, (('callback', name), ('phase', phase)),
+                             seconds)
+            self.observe('dash_callback_response_bytes', size_buckets, (('callback', name),), size)
+            self.add('dash_callback_read_bytes_total', (('callback', name),), call['bytes_read'])
+            self.add('dash_callback_triggers_total', (('callback', name), ('trigger', trigger)), 1)
+        return response
+
+    def add(self, sample, labels, value, le=''):
+        key = (sample, label_text(labels), le)
+        self.pending[key] = self.pending.get(key, 0) + value
+
+    def observe(self, metric, buckets, labels, value):
+        for bound in buckets:
+            if value <= bound:
+                self.add(f'{metric}_bucket', labels, 1, str(bound))
+        self.add(f'{metric}_bucket', labels, 1, '+Inf')
+        self.add(f'{metric}_sum', labels, value)
+        self.add(f'{metric}_count', labels, 1)
+
+    # Shared totals -----------------------------------------------------------------------------------------------
+
+    def start_flusher(self):
+        pid = os.getpid()
+        if self.flush_pid == pid:
+            return
+        with self.flush_lock:
+            if self.flush_pid != pid:
+                # What a forked worker inherited was recorded by its parent, the worker only adds its own counts
+                with self.lock:
+                    self.pending = {}
+                for collect in self.collectors:
+                    collect()
+                threading.Thread(target=self.flush_forever, name='callback-metrics-flush', daemon=True).start()
+                self.flush_pid = pid
+
+    def flush_forever(self):
+        while True:
+            time.sleep(flush_interval_s)
+            self.flush()
+
+    def flush(self):
+        """
+        Add the counts recorded since the last flush to the shared file.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            for collect in self.collectors:
+                for key, value in collect().items():
+                    pending[key] = pending.get(key, 0) + value
+        if not pending:
+            return
+        try:
+            with self.connect() as connection:
+                connection.executemany('INSERT INTO samples (name, labels, le, value) VALUES (?, ?, ?, ?) '
+                                       'ON CONFLICT (name, labels, le) DO UPDATE SET value = value + excluded.value',
+                                       [(name, labels, le, value) for (name, labels, le), value in pending.items()])
+        except sqlite3.Error:
+            # A busy file is retried at the next flush, nothing recorded is lost
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + value
+
+    # Exposition --------------------------------------------------------------------------------------------------
+
+    def render(self):
+        """
+        Return every metric in Prometheus text exposition format, the counts summed over all the workers.
+        """
+        self.flush()
+        with self.connect() as connection:
+            samples = {(name, labels, le): value
+                       for name, labels, le, value in connection.execute('SELECT name, labels, le, value FROM samples')}
+        lines = []
+        for metric, kind, help_text, buckets in families:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            if kind == 'histogram':
+                for labels in sorted({labels for name, labels, _ in samples if name == f'{metric}_count'}):
+                    prefix = f'{labels},' if labels else ''
+                    for bound in [str(bound) for bound in buckets] + ['+Inf']:
+                        value = samples.get((f'{metric}_bucket', labels, bound), 0)
+                        lines.append(f'{metric}_bucket{{{prefix}le="{bound}"}} {format_value(value)}')
+                    for suffix in ('_sum', '_count'):
+                        value = samples[(f'{metric}{suffix}', labels, '')]
+                        lines.append(f'{metric}{suffix}{{{labels}}} {format_value(value)}')
+            else:
+                for (name, labels, _), value in sorted(samples.items()):
+                    if name == metric:
+                        lines.append(f'{metric}{{{labels}}} {format_value(value)}' if labels
+                                     else f'{metric} {format_value(value)}')
+        for render_extra in self.extra_metrics:
+            lines.extend(render_extra())
+        return '\n'.join(lines) + '\n'
+
+
+def data_cache_counts(data_cache):
+    """
+    Return a collector of the increments of the shared CSV cache counters since its last call.
+    """
+    last = {}
+
+    def collect():
+        stats = data_cache.stats()
+        increments = {}
+        for key in ('hits', 'misses', 'evictions', 'invalidations'):
+            if stats[key] != last.get(key, 0):
+                increments[(f'data_cache_{key}_total', '', '')] = stats[key] - last.get(key, 0)
+            last[key] = stats[key]
+        return increments
+    return collect
+
+
+def data_cache_gauges(data_cache):
+    """
+    Return a renderer of the memory held by the CSV cache of the worker answering the scrape.
+    """
+    def render():
+        return ['# TYPE data_cache_bytes gauge',
+                f'data_cache_bytes{{worker="{os.getpid()}"}} {data_cache.stats()["bytes"]}']
+    return render
+
+
+def instrument_app(app, db_path, data_cache=None):
+    """
+    Turn on callback metrics for a Dash app. Must run before the callbacks are registered.
+
+    Parameters:
+    - app: the Dash app; its callback decorator is wrapped and /metrics is added to app.server.
+    - db_path: SQLite file where the workers sum their counts.
+    - data_cache: the shared DataCache, its misses report bytes read and its counters are exported.
+
+    Returns:
+    - The CallbackMetrics collecting the data.
+    """
+    metrics = CallbackMetrics(db_path)
+
+    if data_cache is not None:
+        data_cache.read_hooks.append(metrics.add_bytes_read)
+        metrics.collectors.append(data_cache_counts(data_cache))
+        metrics.extra_metrics.append(data_cache_gauges(data_cache))
+
+    original_callback = app.callback
+
+    def callback(*args, **kwargs):
+        register = original_callback(*args, **kwargs)
+        return lambda function: register(metrics.wrap_callback(function))
+    app.callback = callback
+
+    server = app.server
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path.endswith('/_dash-update-component'):
+            metrics.start_request()
+
+    @server.after_request
+    def record_callback_timer(response):
+        if request.path.endswith('/_dash-update-component'):
+            return metrics.finish_request(response)
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,108 @@
+#import require package
+import os
+import re
+
+import pandas as pd
+
+from build_aggregates import output_file_names, upper_quantile, lower_quantile
+
+"""
+====================================================================================================================
+Series for the many-region comparison: the requested (scenario, year, region) series are grouped by the aggregate
+file they live in, each file is read once with every needed column, and all the series of a file come out of one
+(row, region, statistic) array, so the cost grows with the number of files rather than the number of series.
+Merged windows come from the quantile sketches instead, one profile per (scenario, region) over all selected years
+====================================================================================================================
+"""
+
+
+def state_subregions(resources_path):
+    """
+    Return {state: [balancing areas]} from state_to_ba_mapping.csv, areas in numeric order.
+    """
+    df = pd.read_csv(os.path.join(resources_path, 'state_to_ba_mapping.csv'))
+    return {state: sorted(re.findall(r'p\d+', areas), key=lambda area: int(area[1:]))
+            for state, areas in zip(df['state'], df['reeds_ba_list'])}
+
+
+def load_hourly_series(data_path, read_csv, regions, years, scenarios, daytype, projection_bool, max_bool):
+    """
+    Fetch the hour-of-day profile of every (scenario, year, region) combination.
+
+    Parameters:
+    - data_path: folder holding the *_yearly_aggregated.csv files.
+    - read_csv: the reader to use, normally data_cache.read_csv so the files are shared with the other graphs.
+    - regions, years, scenarios: the selections to combine.
+    - daytype: 'Weekday' or 'Weekend'.
+    - projection_bool: use the projection files.
+    - max_bool: return the hourly max instead of the mean and its quantile band.
+
+    Returns:
+    - A list of dictionaries with scenario, year, region, hours and value (plus upper and lower unless max_bool),
+      and the list of files that do not exist.
+    """
+    stats = ('max',) if max_bool else ('mean', 'upper', 'lower')
+    series = []
+    missing = []
+    # One file per scenario, each read once whatever the number of regions and years asked from it
+    for scenario_value in dict.fromkeys(scenarios):
+        file_name = output_file_names(scenario_value, projection_bool)[0]
+        file_path = os.path.join(data_path, file_name)
+        if not os.path.exists(file_path):
+            missing.append(file_name)
+            continue
+        df = read_csv(file_path)
+        present = [region for region in regions if f'{region}_{stats[0]}' in df.columns]
+        rows = df[df['Year'].isin(years) & (df['Weekend_or_Weekday'] == daytype)]
+        columns = [f'{region}_{stat}' for region in present for stat in stats]
+        block = rows[columns].to_numpy().reshape(len(rows), len(present), len(stats))
+        row_years = rows['Year'].to_numpy()
+        hours = rows['Hour'].to_numpy()
+
+        for year in years:
+            selected = row_years == year
+            if not selected.any():
+                continue
+            year_block = block[selected]
+            for j, region in enumerate(present):
+                entry = {'scenario': scenario_value, 'year': year, 'region': region, 'hours': hours[selected],
+                         'value': year_block[:, j, 0]}
+                if not max_bool:
+                    entry['upper'] = year_block[:, j, 1]
+                    entry['lower'] = year_block[:, j, 2]
+                series.append(entry)
+    return series, missing
+
+
+def load_window_series(sketches, regions, years, scenarios, daytype, projection_bool, max_bool):
+    """
+    Merge the selected years into one hour-of-day profile per (scenario, region) from the quantile sketches.
+
+    Parameters:
+    - sketches: the QuantileSketches of the data folder.
+    - the others: as for load_hourly_series.
+
+    Returns:
+    - Entries shaped like those of load_hourly_series with the median as value (the max with max_bool) and the
+      quantile band, year holding the label of the window, and the list of sketch files that do not exist.
+    """
+    quantiles = (1.0,) if max_bool else (0.5, upper_quantile, lower_quantile)
+    label = f'{min(years)}-{max(years)}' if len(years) > 1 else str(years[0]) if years else ''
+    series = []
+    missing = []
+    for scenario_value in dict.fromkeys(scenarios):
+        file_name = output_file_names(scenario_value, projection_bool)[2]
+        sketch = sketches.get(file_name)
+        if sketch is None:
+            missing.append(file_name)
+            continue
+        for region in regions:
+            hours, values = sketch.quantiles(region, years, daytype, quantiles)
+            if len(hours) == 0:
+                continue
+            entry = {'scenario': scenario_value, 'year': label, 'region': region, 'hours': hours, 'value': values[0]}
+            if not max_bool:
+                entry['upper'] = values[1]
+                entry['lower'] = values[2]
+            series.append(entry)
+    return series, missing
@@ -0,0 +1,144 @@
+#import require package
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+"""
+====================================================================================================================
+Analytic confidence bands for any aggregation window (month, quarter, year, decade or a number of months),
+computed for every region at once from the scenario cube and the monthly model error table. The cube is monthly, so
+every window is a whole number of months and only the monthly error applies
+
+Errors of consecutive periods are treated as independent, so the standard deviation of a window of n periods is
+sigma * sqrt(n); the band is the window total +/- z * sigma * sqrt(n). Partial windows at the edges of a date range
+use their own n
+====================================================================================================================
+"""
+
+# Standard deviation of the monthly model error, one row per region named 'error_<region>'
+monthly_error_table = os.path.join('web_page_data', 'std_dev_monthly_aggregated_errors.csv')
+z_95 = 1.959963984540054
+
+
+def read_sigmas(file_path):
+    """
+    Return {lower-cased region: standard deviation} from one error table.
+    """
+    df = pd.read_csv(file_path)
+    df.columns = ['region', 'sd']
+    regions = df['region'].str.replace('error_', '', n=1, regex=False).str.lower()
+    return dict(zip(regions, df['sd'].astype(float)))
+
+
+def window_labels(years, months, window):
+    """
+    Label every month with the window it falls in.
+
+    Parameters:
+    - years, months: arrays dating each month.
+    - window: 'month', 'quarter', 'year', 'decade', or a number of months counted from the first one.
+
+    Returns:
+    - An integer array, equal labels for the months of one window.
+    """
+    years = np.asarray(years, dtype=np.int64)
+    months = np.asarray(months, dtype=np.int64)
+    if window == 'month':
+        return years * 12 + months - 1
+    if window == 'quarter':
+        return years * 4 + (months - 1) // 3
+    if window == 'year':
+        return years
+    if window == 'decade':
+        return years // 10
+    return np.arange(len(years)) // int(window)
+
+
+class ConfidenceBands:
+    """
+    Band engine over the scenario cube; the error table is read once and kept as a dictionary.
+    """
+
+    def __init__(self, base_path, cube):
+        self.base_path = base_path
+        self.cube = cube
+        self.sigmas = None
+        self.centers = {}
+        self.lock = threading.Lock()
+
+    def sigma_table(self):
+        table = self.sigmas
+        if table is None:
+            with self.lock:
+                table = self.sigmas
+                if table is None:
+                    table = read_sigmas(os.path.join(self.base_path, monthly_error_table))
+                    self.sigmas = table
+        return table
+
+    def sigma(self, region):
+        """
+        Standard deviation of one month of a region's error, NaN when the region has no entry.
+        """
+        return self.sigma_table().get(region.lower(), np.nan)
+
+    def sigma_vector(self, regions):
+        table = self.sigma_table()
+        return np.array([table.get(r.lower(), np.nan) for r in regions])
+
+    def scenario_mean(self, projection_bool):
+        """
+        (month, region) mean of the monthly totals over every scenario.
+        """
+        key = bool(projection_bool)
+        center = self.centers.get(key)
+        if center is None:
+            center = self.cube.values[:, int(key), 0].mean(axis=0, dtype=np.float64)
+            self.centers[key] = center
+        return center
+
+    def bands(self, values, years, months, sigmas, window, z=z_95):
+        """
+        Aggregate monthly values to windows and put a band around them, for every column at once.
+
+        Parameters:
+        - values: (month, region) array of monthly totals, months in time order.
+        - years, months: dates of the rows of values.
+        - sigmas: monthly error standard deviation of each column.
+        - window: see window_labels.
+        - z: half-width of the band in standard deviations, 1.96 for 95%.
+
+        Returns:
+        - The first (year, month) of each window, and the (window, region) total, lower and upper bounds.
+        """
+        labels = window_labels(years, months, window)
+        if len(labels) == 0:
+            empty = np.empty((0, values.shape[1]))
+            return years[:0], months[:0], empty, empty, empty
+        starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+        counts = np.diff(np.r_[starts, len(labels)])
+        total = np.add.reduceat(values, starts, axis=0)
+        half = z * np.sqrt(counts)[:, None] * np.asarray(sigmas)[None, :]
+        return years[starts], months[starts], total, total - half, total + half
+
+    def frame(self, regions, projection_bool, start_year, start_month, end_year, end_month, window):
+        """
+        Scenario-mean band for some regions over a date range, shaped like the monthly_CI_*_Data_data files:
+        a Time_UTC index (first day of each window) and average_, upper_ and lower_ columns per region.
+        """
+        cube = self.cube
+        position = cube.years.astype(np.int64) * 12 + cube.months
+        mask = (position >= start_year * 12 + start_month) & (position <= end_year * 12 + end_month)
+        columns = cube.region_positions(regions)
+        values = self.scenario_mean(projection_bool)[mask][:, columns]
+        years, months, total, lower, upper = self.bands(values, cube.years[mask], cube.months[mask],
+                                                         self.sigma_vector(regions), window)
+        df = pd.DataFrame(index=pd.DatetimeIndex(pd.to_datetime(pd.DataFrame({'Year': years, 'Month': months,
+                                                                                'Day': 1})), name='Time_UTC'))
+        for i, region in enumerate(regions):
+            df[f'upper_{region}'] = upper[:, i]
+            df[f'lower_{region}'] = lower[:, i]
+            df[f'average_{region}'] = total[:, i]
+        return df
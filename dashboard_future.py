@@ -1,19 +1,37 @@
 #import require package
+# Imported first so the cold-start profile starts its clock before everything else
+import startup_profile
 import dash
 from dash import html, dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import plotly.graph_objects as go
-import geopandas as gpd
+from plotly import colors as plotly_colors, __version__ as plotly_version
 import pandas as pd
-import plotly.express as px
 import json
 import numpy as np
 import os
-from shapely.geometry import Point
-from shapely import wkt
 from datetime import date
-import ast  # Import the ast module
-from ast import literal_eval
+from flask import has_request_context
+from scenario_cube import load_scenario_cube, cube_file, cube_meta_file
+from range_index import load_range_index, prefix_file, block_file, sparse_file, index_meta_file
+from scenario_envelope import load_scenario_envelope, envelope_of, envelope_file, envelope_meta_file
+from data_cache import data_cache
+from build_geometry import load_geometry_tier, tier_path, geometry_tier_for_zoom
+from weather_index import WeatherIndex
+from extreme_days import load_extreme_days, default_thresholds
+from figure_cache import FigureCache, layout_values, code_version
+from confidence_bands import ConfidenceBands, monthly_error_table
+from jobs import JobQueue, install_session_cookie, job_progress
+from compare_series import state_subregions, load_hourly_series, load_window_series
+from quantile_sketch import QuantileSketches
+from spatial_index import SpatialIndex, install_locate_api
+from downsample import minmax_indices, union_indices, band_polygon, default_width_px
+from callback_metrics import instrument_app, phase
+from memory_budget import MemoryReport
+from data_export import install_export_api
+
+startup_profile.mark('imports')
 
 # Get the current directory where your script is running
 current_directory = os.getcwd()
@@ -21,6 +39,12 @@ current_directory = os.getcwd()
 # Construct the path to your data folder dynamically
 data_path = os.path.join(current_directory, 'web_page_data')
 
+# DATA_COMPACT=1 keeps the parsed tables in compact types (float32 where exact to 1e-6, small integers, categorical
+# names); MEMORY_BUDGET_MB is the private memory budget per worker, checked by memory_budget.py and shown on /metrics
+data_compact = os.environ.get('DATA_COMPACT', '0') == '1'
+memory_report = MemoryReport(float(os.environ['MEMORY_BUDGET_MB']) * 1024 ** 2
+                             if os.environ.get('MEMORY_BUDGET_MB') else None)
+
 #adding mapping data
 # Define file paths for saving
 gdf_country_path = os.path.join(data_path, 'gdf_country.gpkg')
@@ -28,9 +52,39 @@ gdf_state_path = os.path.join(data_path, 'gdf_state.gpkg')
 gdf_subregion_path = os.path.join(data_path, 'gdf_subregion.gpkg')
 
 
-std_monthly_path = os.path.join(data_path, 'std_dev_monthly_aggregated_errors.csv')
-std_monthly_df=pd.read_csv(std_monthly_path )
-std_monthly_df.columns = ['region', 'sd']
+
+# Memory-map the packed monthly demand for every scenario, built from the CSVs on first run (float32 in compact mode)
+scenario_cube = load_scenario_cube(data_path, compact=data_compact)
+# Prefix sums and block maxima over the cube, so a date range is aggregated without scanning it
+range_index = load_range_index(data_path, scenario_cube)
+# Min/median/max and spread over the five scenarios for every month and region, precomputed from the cube
+scenario_envelope = load_scenario_envelope(data_path, scenario_cube)
+startup_profile.mark('scenario cube, range index and envelope')
+# Confidence bands for any window, from the cube and the monthly error table (read once)
+confidence_bands = ConfidenceBands(current_directory, scenario_cube)
+# Degree-day and extreme-weather summaries keyed by region, each file is indexed on first use
+weather_index = WeatherIndex(data_path, compact=data_compact)
+# Daily temperature and demand packed by extreme_days.py, to detect extreme days for any threshold; None when not built
+extreme_days = load_extreme_days(data_path)
+# Time-series traces are thinned to about one point per pixel of this width
+plot_width_px = int(os.environ.get('PLOT_WIDTH_PX', default_width_px))
+# Rendered figures by callback inputs, in memory and in web_page_data/figure_cache; FIGURE_CACHE=0 turns it off and
+# FIGURE_CACHE_DIR= (empty) keeps it in memory only. The code and render settings version every key
+figure_cache = FigureCache(int(os.environ.get('FIGURE_CACHE_BYTES', 64 * 1024 ** 2)),
+                           os.environ.get('FIGURE_CACHE_DIR', os.path.join(data_path, 'figure_cache')),
+                           enabled=os.environ.get('FIGURE_CACHE', '1') != '0',
+                           version=code_version(current_directory, {'plot_width_px': plot_width_px,
+                                                                    'data_compact': data_compact,
+                                                                    'plotly': plotly_version}))
+cube_files = [os.path.join(data_path, name) for name in (cube_file, cube_meta_file)]
+range_index_files = cube_files + [os.path.join(data_path, name)
+                                  for name in (prefix_file, block_file, sparse_file, index_meta_file)]
+envelope_files = cube_files + [os.path.join(data_path, name) for name in (envelope_file, envelope_meta_file)]
+monthly_error_file = os.path.join(current_directory, monthly_error_table)
+# Mergeable quantile sketches written by build_aggregates.py, for bands over any set of years
+quantile_sketches = QuantileSketches(data_path)
+# Balancing areas of every state, to add a whole state to the many-region comparison
+subregions_by_state = state_subregions(os.path.join(current_directory, 'resources'))
 
 
 # Function to read GeoJSON from a file
@@ -39,25 +93,49 @@ def read_geojson(file_path):
         return json.load(f)
 
 
-# Read the GeoDataFrames
-gdf_country = gpd.read_file(gdf_country_path)
-gdf_state = gpd.read_file(gdf_state_path)
-gdf_subregion = gpd.read_file(gdf_subregion_path)
+# The map is drawn at a fixed zoom
+map_zoom = 3
 
-gdf_country = gdf_country.to_crs(epsg=4326)
-gdf_state = gdf_state.to_crs(epsg=4326)
-gdf_subregion = gdf_subregion.to_crs(epsg=4326)
 
-geojson_country = gdf_country.__geo_interface__
-geojson_state = gdf_state.__geo_interface__
-geojson_subregion = gdf_subregion.__geo_interface__
+def load_map_layer(breakdown, gpkg_path):
+    """
+    Load one map breakdown: the prebuilt, already reprojected GeoJSON from build_geometry.py when it exists,
+    otherwise the GeoPackage reprojected here (geopandas is only imported on that slow path).
+
+    Returns:
+    - The attributes of each region as a DataFrame indexed like the GeoJSON feature ids, and the GeoJSON.
+    """
+    geojson = load_geometry_tier(data_path, breakdown, map_zoom)
+    if geojson is None:
+        import geopandas as gpd
+        gdf = gpd.read_file(gpkg_path).to_crs(epsg=4326)
+        return pd.DataFrame(gdf.drop(columns=gdf.geometry.name)), gdf.__geo_interface__
+    features = geojson['features']
+    data = pd.DataFrame([feature['properties'] for feature in features],
+                        index=pd.Index([int(feature['id']) for feature in features]))
+    return data, geojson
+
+
+# Attributes (region names) and geometry of each breakdown
+gdf_country, geojson_country = load_map_layer('country', gdf_country_path)
+gdf_state, geojson_state = load_map_layer('state', gdf_state_path)
+gdf_subregion, geojson_subregion = load_map_layer('subregion', gdf_subregion_path)
+# Region of each map feature id, for click-to-select
+region_by_location = {breakdown: dict(zip(data.index.astype(str), data[label]))
+                      for breakdown, data, label in (('country', gdf_country, 'country'), ('state', gdf_state, 'state'),
+                                                     ('subregion', gdf_subregion, 'rb'))}
+# Subregion and state of any lat/lon points, served on /api/locate; the STRtrees are only built by the first lookup,
+# so startup does not pay for them
+spatial_index = SpatialIndex(data_path, {'subregion': (gdf_subregion_path, 'rb'), 'state': (gdf_state_path, 'state')})
+startup_profile.mark('map geometry')
 
 
 
 # Function to convert a DataFrame with 'lon' and 'lat' columns to a GeoDataFrame
 def df_to_gdf(df):
-    # Create a GeoSeries from the 'lon' and 'lat' columns
-    geometry = [Point(xy) for xy in zip(df.lon, df.lat)]
+    import geopandas as gpd
+    # Create a GeoSeries from the 'lon' and 'lat' columns in one vectorized call
+    geometry = gpd.points_from_xy(df.lon, df.lat)
     gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:4326")
     return gdf
 def hex_to_rgba(hex_color, opacity):
@@ -76,6 +154,28 @@ def hex_to_rgba(hex_color, opacity):
     return f'rgba({r}, {g}, {b}, {opacity})'
 
 
+def missing_aggregate_figure(file_paths, title):
+    """
+    Return the empty figure shown by a compare graph whose aggregate files are not built yet.
+
+    Parameters:
+    - file_paths: the aggregate files the graph reads.
+    - title: the title the graph would have had.
+
+    Returns:
+    - None when every file exists, else a figure naming the missing files.
+    """
+    missing = [os.path.basename(file_path) for file_path in file_paths if not os.path.exists(file_path)]
+    if not missing:
+        return None
+    with phase('figure'):
+        fig = go.Figure()
+        fig.add_annotation(text=f"No data — run build_aggregates.py ({', '.join(missing)} missing)",
+                           xref='paper', yref='paper', x=0.5, y=0.5, showarrow=False)
+        fig.update_layout(title=title)
+    return fig
+
+
 #include weekday date
 weekday_map = {
     0: 'Monday',
@@ -102,10 +202,65 @@ color_map = {
     }
 weather_condition_mapping={}
 
+# Send map polygons to the browser once per breakdown and only demand values afterwards, set MAP_GEOMETRY_ONCE=0
+# to go back to rebuilding the whole choropleth figure on the server
+map_geometry_once = os.environ.get('MAP_GEOMETRY_ONCE', '1') != '0'
+
+# Render the heavy figures in background jobs the page polls for, newer requests cancel older ones from the same
+# browser; BACKGROUND_JOBS=1 turns it on, JOB_THREADS sets the render threads per process
+background_jobs = os.environ.get('BACKGROUND_JOBS', '0') == '1'
+# Graphs that can be rendered in the background, each has a '<graph>-job' store holding its latest job id
+background_graphs = ['usa-map', 'line-graph', 'line-graph-with-CI', 'line-graph-for-weather']
+
 # Initialize the Dash app
 app = dash.Dash(__name__)
 #Define seriver
 server=app.server
+# Per-callback timings on /metrics, set CALLBACK_METRICS=0 to turn off. Has to run before any callback is registered.
+# The workers sum their counts in METRICS_DB
+if os.environ.get('CALLBACK_METRICS', '1') != '0':
+    callback_metrics = instrument_app(app, os.environ.get('METRICS_DB', os.path.join(data_path, 'metrics.sqlite')),
+                                      data_cache=data_cache)
+    callback_metrics.extra_metrics.append(memory_report.metrics())
+# Bulk CSV / Arrow export of the scenario cube under /api/demand, set EXPORT_API=0 to turn off
+if os.environ.get('EXPORT_API', '1') != '0':
+    install_export_api(server, data_path, scenario_cube)
+# Subregion and state of batches of lat/lon points under /api/locate, set LOCATE_API=0 to turn off
+if os.environ.get('LOCATE_API', '1') != '0':
+    install_locate_api(server, spatial_index)
+if background_jobs:
+    job_queue = JobQueue(os.environ.get('JOBS_DB', os.path.join(data_path, 'jobs.sqlite')),
+                         int(os.environ.get('JOB_THREADS', 2)))
+    install_session_cookie(server)
+
+# Inputs of every figure callback served from the server, by output ('line-graph.figure'), for pre-warming
+figure_inputs = {}
+# Graphs registered for background rendering, in the order of the poll callback outputs
+job_graphs = []
+
+
+def triggered_inputs():
+    """
+    The inputs that triggered the running callback, none when it is called directly (benchmark, pre-warming).
+    """
+    if not has_request_context():
+        return set()
+    return {trigger['prop_id'] for trigger in dash.callback_context.triggered}
+
+
+def figure_callback(graph_id, inputs):
+    """
+    Register a function rendering the figure of a graph: as a normal callback, or with BACKGROUND_JOBS=1 as a
+    callback that queues a job and stores its id in '<graph_id>-job' for poll_figure_jobs to pick up.
+    """
+    def decorator(function):
+        figure_inputs[f'{graph_id}.figure'] = inputs
+        if not background_jobs:
+            return app.callback(Output(graph_id, 'figure'), inputs)(function)
+        job_graphs.append(graph_id)
+        app.callback(Output(f'{graph_id}-job', 'data'), inputs)(job_queue.submitter(graph_id, function))
+        return function
+    return decorator
 """
 ====================================================================================================================
 THe folloowing is the html commponet,
@@ -140,6 +295,7 @@ app.layout = html.Div([
         ''', dangerously_allow_html=True),
     ]),
     html.H2("Demand Prediction model:", style={'marginBottom': 0, 'marginTop': 0}),
+    html.Div(id='job-progress', style={'minHeight': '1.2em', 'color': 'gray'}),
     html.P('The following map part can be customise by selecting paramter on your right, add it will sum all the demand for that period for each region', style={'textAlign': 'justify'}),
     html.Div([
         dcc.Graph(
@@ -147,6 +303,13 @@ app.layout = html.Div([
             config={'scrollZoom': False,'modeBarButtonsToRemove': ['zoom', 'zoomIn', 'zoomOut', 'pan']},
             style={'display': 'inline-block', 'width': '80%'}
         ),
+        # Stores for the geometry-once map mode
+        dcc.Store(id='map-geometry-request'),
+        dcc.Store(id='map-geometry'),
+        dcc.Store(id='map-values'),
+        # Background job ids and the poll timer, used when BACKGROUND_JOBS=1
+        *[dcc.Store(id=f'{graph_id}-job') for graph_id in background_graphs],
+        dcc.Interval(id='job-interval', interval=250, disabled=True),
         html.Div([
             html.H4("Select Breakdown:", style={'marginBottom': -20, 'marginTop': 0}), 
             dcc.RadioItems(
@@ -168,7 +331,8 @@ app.layout = html.Div([
                     {'label': 'High', 'value': 'rcp85cooler'},
                     {'label': 'Moderate', 'value': 'rcp45hotter'},
                     {'label': 'Low', 'value': 'rcp45cooler'},
-                    {'label': 'reference','value': 'projection'}
+                    {'label': 'reference','value': 'projection'},
+                    {'label': 'Scenario spread', 'value': 'spread'}
                 ],
                 value='rcp85hotter',  # Default value
                 style={'padding': 20},
@@ -256,6 +420,17 @@ app.layout = html.Div([
                     ],value='Num_of_days',  multi=False)
                     ]
                 ),
+        html.H4("Extreme day threshold:", style={'marginBottom': 0, 'marginTop': 0}),
+        html.Div([
+            dcc.RadioItems(id='extreme-threshold-mode', options=[
+                    {'label': 'Precomputed', 'value': 'summary'},
+                    {'label': 'Percentile of 2010 weather days', 'value': 'percentile', 'disabled': extreme_days is None},
+                    {'label': 'Temperature (°C)', 'value': 'absolute', 'disabled': extreme_days is None},
+                ], value='summary', inline=True, style={'display': 'inline-block'}),
+            dcc.Input(id='extreme-threshold-value', type='number', value=default_thresholds['percentile']['Heat'],
+                      debounce=True,
+                      style={'marginLeft': 10, 'width': 80}),
+        ]),
         html.P('The following, give you an idea of the weather structure,the graph show number of extreme weather and average demand of electicty during extreme weather.', style={'textAlign': 'justify'}),
         dcc.Graph(id='line-graph-for-weather'),  # Placeholder for the line graph
     ], style={'width': '100%','display': 'inline-block'}),  # Adjust width to 50% to share space equally
@@ -347,9 +522,44 @@ app.layout = html.Div([
         html.Div([
             dcc.Graph(id='compare-graph-week'),  # Placeholder for the comparison graph
         ], style={'width': '55%', 'display': 'inline-block'}),  # Use 100% of the parent div width
-    ], style={'display': 'flex', 'flex-direction': 'row'})  # Use flexbox for side-by-side layout
+    ], style={'display': 'flex', 'flex-direction': 'row'}),  # Use flexbox for side-by-side layout
+    html.H3("Comparing many regions:", style={'marginBottom': 0, 'marginTop': 0}),
+    html.P('Pick any number of regions, years and scenarios to draw the average demand by hour of every combination on one graph. Choosing a state adds all of its balancing areas. Merging the years draws the median of all the selected years together, the shadow area is their 95% and 5% quantile.', style={'textAlign': 'justify'}),
+    html.Div([
+        html.Div([
+            dcc.Graph(id='multi-compare-graph'),
+        ], style={'width': '55%', 'display': 'inline-block'}),
+        html.Div([
+            html.H4("Choose Regions:", style={'marginBottom': 0, 'marginTop': 0}),
+            dcc.Dropdown(id='multi-compare-regions',
+                         options=[{'label': region, 'value': region} for region in scenario_cube.regions],
+                         value=['USA'], multi=True),
+            html.H4("Add the Balancing Areas of a State:", style={'marginBottom': 0, 'marginTop': 0}),
+            dcc.Dropdown(id='multi-compare-state',
+                         options=[{'label': state, 'value': state} for state in subregions_by_state],
+                         value=None, multi=False),
+            html.H4("Choose Years:", style={'marginBottom': 0, 'marginTop': 0}),
+            dcc.Dropdown(id='multi-compare-years',
+                         options=[{'label': year, 'value': year} for year in range(2020, 2100)],
+                         value=[2020, 2050], multi=True),
+            html.H4("Choose Scenarios:", style={'marginBottom': 0, 'marginTop': 0}),
+            dcc.Dropdown(id='multi-compare-scenarios',
+                         options=[{'label': label, 'value': value} for value, label in scenario_labels.items()],
+                         value=['rcp85hotter'], multi=True),
+            html.H4("Choose Day Type:", style={'marginBottom': 0, 'marginTop': 0}),
+            dcc.Dropdown(id='multi-compare-daytype',
+                         options=[{'label': daytype, 'value': daytype} for daytype in ['Weekday', 'Weekend']],
+                         value='Weekday'),
+            html.H4("Years:", style={'marginBottom': -20, 'marginTop': 0}),
+            dcc.RadioItems(id='multi-compare-window',
+                           options=[{'label': 'One line per year', 'value': 'each'},
+                                    {'label': 'Merge the selected years', 'value': 'merged'}],
+                           value='each', style={'padding': 20}, inline=True),
+        ], style={'display': 'inline-block', 'width': '45%'}),
+    ], style={'display': 'flex', 'flex-direction': 'row'})
 
 ])
+startup_profile.mark('layout')
 
 """
 ====================================================================================================================
@@ -357,22 +567,19 @@ Code for updating the map graph
 ====================================================================================================================
 """
 
-@app.callback(
-    Output('usa-map', 'figure'),
-    [
-        Input('scenario-toggle', 'value'),
-        Input('map-toggle', 'value'),
-        Input('start-month-dropdown', 'value'),
-        Input('start-year-dropdown', 'value'),
-        Input('end-month-dropdown', 'value'),
-        Input('end-year-dropdown', 'value'),
-        Input('max-toggle','value'),
-        Input('projection-toggle','value'),
-    ]
-)
+map_inputs = [
+    Input('scenario-toggle', 'value'),
+    Input('map-toggle', 'value'),
+    Input('start-month-dropdown', 'value'),
+    Input('start-year-dropdown', 'value'),
+    Input('end-month-dropdown', 'value'),
+    Input('end-year-dropdown', 'value'),
+    Input('max-toggle','value'),
+    Input('projection-toggle','value'),
+]
 
 
-def update_map(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool):
+def map_breakdown(toggle_value):
     # Choose the correct DataFrame and title based on toggle_value
     if toggle_value == 'country':
         data = gdf_country
@@ -394,70 +601,131 @@ def update_map(scenario_value,toggle_value,start_month,start_year,end_month,end_
         geojson = geojson_subregion
         color_column = 'rb'
         columns_to_read = ['Year','Month'] + [f'p{i}' for i in range(1, 135)]
-    data_path=os.path.join(current_directory, 'web_page_data')
-    if projection_bool:
-        if max_bool:
-            file_path = os.path.join(data_path, f'_project_max_{scenario_value}_monthlly.csv')
-        else:
-            file_path = os.path.join(data_path, f'_project_mock_{scenario_value}.csv')
+    return data, geojson, color_column, columns_to_read
 
-    else:
-        if max_bool:
-            file_path = os.path.join(data_path, f'max_{scenario_value}_monthlly.csv')
-        else:
-            file_path = os.path.join(data_path, f'mock_{scenario_value}.csv')
-
-
-    
-    # Read only the selected columns from the CSV file
-    df = pd.read_csv(file_path, usecols=columns_to_read)
-    
-    start_date = pd.Timestamp(year=start_year, month=start_month, day=1)
-    end_date = pd.Timestamp(year=end_year, month=end_month, day=30)
-
-    
-    # Create a mask for the date range
-    mask = (df['Year'] > start_year) | \
-           ((df['Year'] == start_year) & (df['Month'] >= start_month)) & \
-           (df['Year'] < end_year) | \
-           ((df['Year'] == end_year) & (df['Month'] <= end_month))
-    # Sum df vertically by column
-    if max_bool:
-        df_summed = df.drop(['Year', 'Month'], axis=1).max().reset_index()
-    else:
-        df_summed = df.drop(['Year', 'Month'], axis=1).sum().reset_index()
 
-    df_summed.columns = ['region', 'demand']
+def map_demand(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool):
+    """
+    Return the GeoDataFrame of the selected breakdown with a 'demand' column for the selected scenario and range.
+    """
+    data, geojson, color_column, columns_to_read = map_breakdown(toggle_value)
+    # Sum (or take the max of) each region over the selected months with the precomputed range index
+    regions = columns_to_read[2:]
+    if scenario_value == 'spread':
+        # How far apart the scenarios are: range of the per-scenario totals (or maxima), every scenario in one lookup
+        totals = range_index.aggregate_scenarios(projection_bool, max_bool, regions,
+                                                 start_year, start_month, end_year, end_month)
+        demand = totals.max(axis=0) - totals.min(axis=0)
+    else:
+        demand = range_index.aggregate(scenario_value, projection_bool, max_bool, regions,
+                                       start_year, start_month, end_year, end_month)
 
     # Create a mapping from region to demand
-    demand_mapping = df_summed.set_index('region')['demand'].to_dict()
-
-    # Apply the mapping to create a new 'demand' column in 'data'
-    data['demand'] = data[color_column].map(demand_mapping)
-    # Use Plotly Express to create the choropleth map with a Mapbox base map
-    fig = px.choropleth_mapbox(data, geojson=geojson, 
-                               locations=data.index, 
-                               color='demand',
-                               color_continuous_scale=[(0, "green"), (1, "red")],
-                               mapbox_style="carto-positron",
-                               hover_data=[color_column,'demand'],
-                               zoom=3, center={"lat": 37.0902, "lon": -95.7129},
-                               opacity=0.5)
-
-    # Update layout to fix the map view (disable zoom and pan)
-    fig.update_layout(
-        mapbox=dict(
-            center={"lat": 37.0902, "lon": -95.7129},
-            zoom=3,
-            style="carto-positron"
-        ),
-        margin={"r":0,"t":0,"l":0,"b":0},
-        title=f"Map by {toggle_value.title()}",
-    )
+    demand_mapping = dict(zip(regions, demand))
+
+    # Apply the mapping to a copy, the GeoDataFrames are shared by every request
+    return data.assign(demand=data[color_column].map(demand_mapping))
+
+
+def map_files(scenario_value, toggle_value, *args):
+    # The range index and the geometry the breakdown was drawn from: the prebuilt tier, else the GeoPackage
+    gpkg_paths = {'country': gdf_country_path, 'state': gdf_state_path, 'subregion': gdf_subregion_path}
+    return range_index_files + [tier_path(data_path, toggle_value, geometry_tier_for_zoom(map_zoom)),
+                                gpkg_paths.get(toggle_value, gdf_subregion_path)]
+
+
+@figure_cache.memoize('usa-map.figure', map_files)
+def update_map(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool):
+    data = map_demand(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool)
+    _, geojson, color_column, _ = map_breakdown(toggle_value)
+    job_progress(0.5)
+    with phase('figure'):
+        # Only the server-rendered map needs plotly express, keep it out of the startup path
+        import plotly.express as px
+        # Use Plotly Express to create the choropleth map with a Mapbox base map
+        fig = px.choropleth_mapbox(data, geojson=geojson, 
+                                   locations=data.index, 
+                                   color='demand',
+                                   color_continuous_scale=[(0, "green"), (1, "red")],
+                                   mapbox_style="carto-positron",
+                                   hover_data=[color_column,'demand'],
+                                   zoom=3, center={"lat": 37.0902, "lon": -95.7129},
+                                   opacity=0.5)
+
+        # Update layout to fix the map view (disable zoom and pan)
+        fig.update_layout(
+            mapbox=dict(
+                center={"lat": 37.0902, "lon": -95.7129},
+                zoom=3,
+                style="carto-positron"
+            ),
+            margin={"r":0,"t":0,"l":0,"b":0},
+            title=f"Map by {toggle_value.title()}",
+        )
 
 
     return fig
 
+
+"""
+Geometry-once map mode: the polygons of a breakdown are sent to the browser the first time it is shown and
+cached there by assets/map_geometry.js, after that a toggle only sends the demand vector
+"""
+
+def geometry_payload(toggle_value):
+    """
+    Build what the browser needs to draw a breakdown: bare feature geometries (no properties), the feature id
+    and region name of each row, in the same order as the demand vectors sent later.
+    """
+    data, geojson, color_column, _ = map_breakdown(toggle_value)
+    features = [{'type': 'Feature', 'id': feature['id'], 'geometry': feature['geometry']}
+                for feature in geojson['features']]
+    return {
+        'breakdown': toggle_value,
+        'title': f"Map by {toggle_value.title()}",
+        'label': color_column,
+        'geojson': {'type': 'FeatureCollection', 'features': features},
+        'locations': [str(i) for i in data.index],
+        'regions': data[color_column].tolist(),
+    }
+
+
+map_geometry = {toggle_value: geometry_payload(toggle_value) for toggle_value in ('country', 'state', 'subregion')}
+startup_profile.mark('map payloads')
+
+
+def update_map_geometry(toggle_value):
+    if toggle_value is None:
+        raise PreventUpdate
+    return map_geometry[toggle_value]
+
+
+def update_map_values(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool):
+    data = map_demand(scenario_value,toggle_value,start_month,start_year,end_month,end_year,max_bool,projection_bool)
+    # NaN is not valid JSON, regions without data are sent as null
+    return {
+        'breakdown': toggle_value,
+        'demand': [None if np.isnan(v) else float(v) for v in data['demand']],
+    }
+
+
+if map_geometry_once:
+    # The browser asks for a breakdown's geometry only when it has not cached it yet
+    app.clientside_callback(
+        ClientsideFunction(namespace='map', function_name='request_geometry'),
+        Output('map-geometry-request', 'data'),
+        Input('map-toggle', 'value'),
+    )
+    app.callback(Output('map-geometry', 'data'), Input('map-geometry-request', 'data'))(update_map_geometry)
+    app.callback(Output('map-values', 'data'), map_inputs)(update_map_values)
+    app.clientside_callback(
+        ClientsideFunction(namespace='map', function_name='render'),
+        Output('usa-map', 'figure'),
+        [Input('map-geometry', 'data'), Input('map-values', 'data')],
+    )
+else:
+    figure_callback('usa-map', map_inputs)(update_map)
+
 """
 ====================================================================================================================
 Code for updating toggle, so it depends on how you want to sepearation the region, it will deplay all the option possible
@@ -467,9 +735,10 @@ Code for updating toggle, so it depends on how you want to sepearation the regio
 @app.callback(
     [Output('graph-toggle', 'options'),
      Output('graph-toggle', 'value')],
-    [Input('map-toggle', 'value')]
+    [Input('map-toggle', 'value'),
+     Input('usa-map', 'clickData')]
 )
-def set_graph_toggle_options(selected_map_view):
+def set_graph_toggle_options(selected_map_view, click_data=None):
     #print(f"Selected map view: {selected_map_view}")
     if selected_map_view == 'country':
         # Explicitly return 'USA' as the option
@@ -488,6 +757,12 @@ def set_graph_toggle_options(selected_map_view):
         options = [{'label': f'p{i}', 'value': f'p{i}'} for i in range(1, 135)]
         value='p1'
 
+    # Clicking a region of the map selects it, the feature id gives the region with one dictionary lookup
+    if click_data and 'usa-map.clickData' in triggered_inputs():
+        region = region_by_location[selected_map_view].get(str(click_data['points'][0].get('location')))
+        if region is None or region not in {option['value'] for option in options}:
+            raise PreventUpdate
+        return dash.no_update, region
     return options,value
 """
 ====================================================================================================================
@@ -546,9 +821,6 @@ Graph for daily comparison
 
 def update_daily_compare_graph(year_left, daytype_left, scenario_left, region_left,
                  year_right, daytype_right, scenario_right, region_right,max_bool,projection_bool):
-    # Create the figure
-    fig = go.Figure()
-
     # Hours array to use as x-axis
     hours = list(range(24))
     ## Left
@@ -566,23 +838,20 @@ def update_daily_compare_graph(year_left, daytype_left, scenario_left, region_le
     else:
         compare_df_path_left= os.path.join(data_path, f'mock_{scenario_left}_yearly_aggregated.csv')
         compare_df_path_right= os.path.join(data_path, f'mock_{scenario_right}_yearly_aggregated.csv')
-    compare_df_left = pd.read_csv(compare_df_path_left)
-    row_left = compare_df_left[(compare_df_left['Year'] == year_left) & (compare_df_left['Weekend_or_Weekday']== daytype_left)]
-    if not row_left.empty:
-        left_mean = row_left[column_name_left_mean].values
-        left_upper = row_left[column_name_left_upper].values
-        left_lower = row_left[column_name_left_lower].values
-        left_max = row_left[column_name_left_max].values
-        hours_left = row_left['Hour'].values
-
-        # Plot mean
-        if max_bool:
-            fig.add_trace(go.Scatter(x=hours_left, y=left_max, mode='lines', name='Left Max', line=dict(color='aqua')))
-        else:
-            fig.add_trace(go.Scatter(x=hours_left, y=left_mean, mode='lines', name='Left Mean', line=dict(color='blue')))
-            # Plot upper and lower with fill
-            fig.add_trace(go.Scatter(x=hours_left, y=left_upper, mode='lines', line=dict(width=0), showlegend=False))
-            fig.add_trace(go.Scatter(x=hours_left, y=left_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(0,0,255,0.2)', showlegend=False))
+    title_text = f'{daytype_left} of {region_left} in {year_left} base on {scenario_left} <br>vs {daytype_right} of {region_right} in {year_right} base on {scenario_right}'
+    # The aggregates are built by build_aggregates.py, until then the graph says so instead of failing
+    fig = missing_aggregate_figure([compare_df_path_left, compare_df_path_right], title_text)
+    if fig is not None:
+        return fig
+    compare_df_left = data_cache.read_csv(compare_df_path_left)
+    with phase('compute'):
+        row_left = compare_df_left[(compare_df_left['Year'] == year_left) & (compare_df_left['Weekend_or_Weekday']== daytype_left)]
+        if not row_left.empty:
+            left_mean = row_left[column_name_left_mean].values
+            left_upper = row_left[column_name_left_upper].values
+            left_lower = row_left[column_name_left_lower].values
+            left_max = row_left[column_name_left_max].values
+            hours_left = row_left['Hour'].values
 
     ## Right
     # Construct column names for mean, upper, and lower
@@ -592,26 +861,39 @@ def update_daily_compare_graph(year_left, daytype_left, scenario_left, region_le
     column_name_right_max = f"{region_right}_max"
 
     # Assuming compare_df structure and that the row for the selected year and region exists
-    compare_df_right = pd.read_csv(compare_df_path_right)
-    row_right = compare_df_right[(compare_df_right['Year'] == year_right) & (compare_df_right['Weekend_or_Weekday']== daytype_right)]
-    if not row_right.empty:
-        right_mean = row_right[column_name_right_mean].values
-        right_upper = row_right[column_name_right_upper].values
-        right_lower = row_right[column_name_right_lower].values
-        right_max = row_right[column_name_right_max].values
-        hours_right = row_right['Hour'].values
-
-
-        # Plot mean
-        if max_bool:
-            fig.add_trace(go.Scatter(x=hours_right, y=right_max, mode='lines', name='Right Mean', line=dict(color='pink')))
-        else:
-            fig.add_trace(go.Scatter(x=hours_right, y=right_mean, mode='lines', name='Right Mean', line=dict(color='red')))
-            # Plot upper and lower with fill
-            fig.add_trace(go.Scatter(x=hours_right, y=right_upper, mode='lines', line=dict(width=0), showlegend=False))
-            fig.add_trace(go.Scatter(x=hours_right, y=right_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(255,0,0,0.2)', showlegend=False))
+    compare_df_right = data_cache.read_csv(compare_df_path_right)
+    with phase('compute'):
+        row_right = compare_df_right[(compare_df_right['Year'] == year_right) & (compare_df_right['Weekend_or_Weekday']== daytype_right)]
+        if not row_right.empty:
+            right_mean = row_right[column_name_right_mean].values
+            right_upper = row_right[column_name_right_upper].values
+            right_lower = row_right[column_name_right_lower].values
+            right_max = row_right[column_name_right_max].values
+            hours_right = row_right['Hour'].values
 
-    fig.update_layout(title=f'{daytype_left} of {region_left} in {year_left} base on {scenario_left} <br>vs {daytype_right} of {region_right} in {year_right} base on {scenario_right}', xaxis_title='Hour of Day', yaxis_title='Hourly Demand(Mwh)', xaxis=dict(range=[0, 23]))
+    with phase('figure'):
+        # Create the figure
+        fig = go.Figure()
+        if not row_left.empty:
+            # Plot mean
+            if max_bool:
+                fig.add_trace(go.Scatter(x=hours_left, y=left_max, mode='lines', name='Left Max', line=dict(color='aqua')))
+            else:
+                fig.add_trace(go.Scatter(x=hours_left, y=left_mean, mode='lines', name='Left Mean', line=dict(color='blue')))
+                # Plot upper and lower with fill
+                fig.add_trace(go.Scatter(x=hours_left, y=left_upper, mode='lines', line=dict(width=0), showlegend=False))
+                fig.add_trace(go.Scatter(x=hours_left, y=left_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(0,0,255,0.2)', showlegend=False))
+        if not row_right.empty:
+            # Plot mean
+            if max_bool:
+                fig.add_trace(go.Scatter(x=hours_right, y=right_max, mode='lines', name='Right Mean', line=dict(color='pink')))
+            else:
+                fig.add_trace(go.Scatter(x=hours_right, y=right_mean, mode='lines', name='Right Mean', line=dict(color='red')))
+                # Plot upper and lower with fill
+                fig.add_trace(go.Scatter(x=hours_right, y=right_upper, mode='lines', line=dict(width=0), showlegend=False))
+                fig.add_trace(go.Scatter(x=hours_right, y=right_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(255,0,0,0.2)', showlegend=False))
+
+        fig.update_layout(title=title_text, xaxis_title='Hour of Day', yaxis_title='Hourly Demand(Mwh)', xaxis=dict(range=[0, 23]))
 
     return fig
 """
@@ -637,27 +919,27 @@ Graph for weekly comparison
 
 def update_weekly_compare_graph(year_left, daytype_left, scenario_left, region_left,
                  year_right, daytype_right, scenario_right, region_right,max_bool,projection_bool):
-    # Create the figure
-    fig = go.Figure()
-
-    # Hours array to use as x-axis
-    hours = list(range(7))
     ## Left
-    try:
-        # Construct column names for mean, upper, and lower
-        if projection_bool:
-            compare_weekly_df_path_left= os.path.join(data_path, f'_project_mock_{scenario_left}_weekly.csv')
-            compare_weekly_df_path_right= os.path.join(data_path, f'_project_mock_{scenario_right}_weekly.csv')
-        else:
-            compare_weekly_df_path_left= os.path.join(data_path, f'mock_{scenario_left}_weekly.csv')
-            compare_weekly_df_path_right= os.path.join(data_path, f'mock_{scenario_right}_weekly.csv')
-        compare_weekly_df_left = pd.read_csv(compare_weekly_df_path_left)
-        column_name_left_mean = f"{region_left}_mean"
-        column_name_left_upper = f"{region_left}_upper"
-        column_name_left_lower = f"{region_left}_lower"
-        column_name_left_max = f"{region_left}_max"
-
-        # Assuming compare_df structure and that the row for the selected year and region exists
+    # Construct column names for mean, upper, and lower
+    if projection_bool:
+        compare_weekly_df_path_left= os.path.join(data_path, f'_project_mock_{scenario_left}_weekly.csv')
+        compare_weekly_df_path_right= os.path.join(data_path, f'_project_mock_{scenario_right}_weekly.csv')
+    else:
+        compare_weekly_df_path_left= os.path.join(data_path, f'mock_{scenario_left}_weekly.csv')
+        compare_weekly_df_path_right= os.path.join(data_path, f'mock_{scenario_right}_weekly.csv')
+    title_text = f'Week of {region_left} in {year_left} base on {scenario_left} <br>vs Week of {region_right} in {year_right} base on {scenario_right}'
+    # The aggregates are built by build_aggregates.py, until then the graph says so instead of failing
+    fig = missing_aggregate_figure([compare_weekly_df_path_left, compare_weekly_df_path_right], title_text)
+    if fig is not None:
+        return fig
+    compare_weekly_df_left = data_cache.read_csv(compare_weekly_df_path_left)
+    column_name_left_mean = f"{region_left}_mean"
+    column_name_left_upper = f"{region_left}_upper"
+    column_name_left_lower = f"{region_left}_lower"
+    column_name_left_max = f"{region_left}_max"
+
+    # Assuming compare_df structure and that the row for the selected year and region exists
+    with phase('compute'):
         row_left = compare_weekly_df_left[(compare_weekly_df_left['Year'] == year_left)]
         if not row_left.empty:
             left_mean = row_left[column_name_left_mean].values
@@ -665,46 +947,50 @@ def update_weekly_compare_graph(year_left, daytype_left, scenario_left, region_l
             left_lower = row_left[column_name_left_lower].values
             left_max = row_left[column_name_left_max].values
             weekdays_left = row_left['weekday'].map(weekday_map).values
-            if max_bool:
-                fig.add_trace(go.Scatter(x=weekdays_left , y=left_max, mode='lines', name='Left Max', line=dict(color='aqua')))
-            else:
-                # Plot mean
-                fig.add_trace(go.Scatter(x=weekdays_left , y=left_mean, mode='lines', name='Left Mean', line=dict(color='blue')))
-                
-                # Plot upper and lower with fill
-                fig.add_trace(go.Scatter(x=weekdays_left , y=left_upper, mode='lines', line=dict(width=0), showlegend=False))
-                fig.add_trace(go.Scatter(x=weekdays_left , y=left_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(0,0,255,0.2)', showlegend=False))
 
-        ## Right
-        # Construct column names for mean, upper, and lower
-        compare_weekly_df_right = pd.read_csv(compare_weekly_df_path_right)
-        column_name_right_mean = f"{region_right}_mean"
-        column_name_right_upper = f"{region_right}_upper"
-        column_name_right_lower = f"{region_right}_lower"
-        column_name_right_max = f"{region_right}_max"
+    ## Right
+    # Construct column names for mean, upper, and lower
+    compare_weekly_df_right = data_cache.read_csv(compare_weekly_df_path_right)
+    column_name_right_mean = f"{region_right}_mean"
+    column_name_right_upper = f"{region_right}_upper"
+    column_name_right_lower = f"{region_right}_lower"
+    column_name_right_max = f"{region_right}_max"
 
-        # Assuming compare_df structure and that the row for the selected year and region exists
+    # Assuming compare_df structure and that the row for the selected year and region exists
+    with phase('compute'):
         row_right = compare_weekly_df_right[(compare_weekly_df_right['Year'] == year_right)]
         if not row_right.empty:
             right_mean = row_right[column_name_right_mean].values
             right_upper = row_right[column_name_right_upper].values
             right_lower = row_right[column_name_right_lower].values
             right_max = row_right[column_name_right_max].values
-            weekdays_right = row_left['weekday'].map(weekday_map).values
+            weekdays_right = row_right['weekday'].map(weekday_map).values
 
+    with phase('figure'):
+        # Create the figure
+        fig = go.Figure()
+        if not row_left.empty:
             if max_bool:
-                fig.add_trace(go.Scatter(x=weekdays_left , y=right_max, mode='lines', name='Right Max', line=dict(color='pink')))
+                fig.add_trace(go.Scatter(x=weekdays_left , y=left_max, mode='lines', name='Left Max', line=dict(color='aqua')))
+            else:
+                # Plot mean
+                fig.add_trace(go.Scatter(x=weekdays_left , y=left_mean, mode='lines', name='Left Mean', line=dict(color='blue')))
+
+                # Plot upper and lower with fill
+                fig.add_trace(go.Scatter(x=weekdays_left , y=left_upper, mode='lines', line=dict(width=0), showlegend=False))
+                fig.add_trace(go.Scatter(x=weekdays_left , y=left_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(0,0,255,0.2)', showlegend=False))
+        if not row_right.empty:
+            if max_bool:
+                fig.add_trace(go.Scatter(x=weekdays_right, y=right_max, mode='lines', name='Right Max', line=dict(color='pink')))
 
             else:
                 # Plot mean
                 fig.add_trace(go.Scatter(x=weekdays_right, y=right_mean, mode='lines', name='Right Mean', line=dict(color='red')))
-            
+
                 # Plot upper and lower with fill
                 fig.add_trace(go.Scatter(x=weekdays_right, y=right_upper, mode='lines', line=dict(width=0), showlegend=False))
                 fig.add_trace(go.Scatter(x=weekdays_right, y=right_lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(255,0,0,0.2)', showlegend=False))
-    except Exception as e:
-        print(e)
-    fig.update_layout(title=f'Week of {region_left} in {year_left} base on {scenario_left} <br>vs Week of {region_right} in {year_right} base on {scenario_right}',xaxis_title='Week Day', yaxis_title='Daily Average demand(Mwh)', xaxis=dict(range=[0, 6]))
+        fig.update_layout(title=title_text,xaxis_title='Week Day', yaxis_title='Daily Average demand(Mwh)', xaxis=dict(range=[0, 6]))
 
     return fig
 
@@ -713,8 +999,8 @@ def update_weekly_compare_graph(year_left, daytype_left, scenario_left, region_l
 Graph for comparing scenario
 ====================================================================================================================
 """
-@app.callback(
-    Output('line-graph', 'figure'),
+@figure_callback(
+    'line-graph',
     [
         Input('scenario-toggle', 'value'),
         Input('graph-toggle', 'value'),
@@ -727,64 +1013,70 @@ Graph for comparing scenario
         Input('projection-toggle','value'),
     ]
 )
+@figure_cache.memoize('line-graph.figure', envelope_files + [monthly_error_file])
 def update_line_graph(scenario_value, graph_value, start_month, start_year, end_month, end_year,group_by_year,max_bool,projection_bool):
 
     scenarios = ['rcp85hotter', 'rcp85cooler','rcp45hotter','rcp45cooler', 'projection']
-    data_path = os.path.join(current_directory, 'web_page_data')
-    
 
-    # Create the figure outside of the loop, so all lines are on the same graph
-    fig = go.Figure()
-    if group_by_year:
-        std_dev = (((std_monthly_df.loc[std_monthly_df['region'].str.lower()  == f'error_{graph_value}'.lower() , 'sd'].values[0])**2)*12)**(0.5)
-    else:
-        std_dev = std_monthly_df.loc[std_monthly_df['region'].str.lower()  == f'error_{graph_value}'.lower() , 'sd'].values[0]
+    # Monthly errors are taken as independent, a year of them has sqrt(12) times the monthly deviation
+    std_dev = confidence_bands.sigma(graph_value) * np.sqrt(12 if group_by_year else 1)
 
 
-    for scenario_value in scenarios:
-        # Construct the file path for the current scenario
-        if projection_bool:
-            if max_bool:
-                file_path = os.path.join(data_path, f'_project_max_{scenario_value}_monthlly.csv')
-            else:
-                file_path = os.path.join(data_path, f'_project_mock_{scenario_value}.csv')
-        else:
-            if max_bool:
-                file_path = os.path.join(data_path, f'max_{scenario_value}_monthlly.csv')
-            else:
-                file_path = os.path.join(data_path, f'mock_{scenario_value}.csv')
-
-        # Define the columns to read from the CSV file
-        columns_to_read = ['Year', 'Month', graph_value]
-
-        # Read only the selected columns from the CSV file
-        df = pd.read_csv(file_path, usecols=columns_to_read)
-
-        # Create a datetime column from 'Year' and 'Month' for filtering
+    # Fetch the region for all scenarios at once as a scenario x month matrix
+    matrix = scenario_cube.scenario_matrix(projection_bool, max_bool, graph_value)
+    with phase('compute'):
         if group_by_year:
-            # Group by 'Year' and sum the specified column
-            if max_bool:
-                df = df.groupby('Year')[graph_value].max().reset_index()
-            else:
-                df = df.groupby('Year')[graph_value].sum().reset_index()
-            
-            # Create a 'time' column combining 'Year', 'Month', and 'Day', with 'Month'=1, 'Day'=1
-            # Since 'Month' and 'Day' are constants, you can directly assign them
-            df['time'] = pd.to_datetime(df.assign(Month=1, Day=1)[['Year', 'Month', 'Day']])
+            # Sum (or max) every scenario by year in one reduction, each year is dated January 1st
+            years, matrix = scenario_cube.yearly(matrix, max_bool)
+            time = pd.Series(pd.to_datetime(pd.DataFrame({'Year': years, 'Month': 1, 'Day': 1})))
         else:
-            df['time'] = pd.to_datetime(df.assign(Day=1)[['Year', 'Month', 'Day']])
-        
+            time = pd.Series(pd.to_datetime(pd.DataFrame({'Year': scenario_cube.years, 'Month': scenario_cube.months, 'Day': 1})))
+
         # Create start and end date Timestamps
         start_date = pd.Timestamp(year=start_year, month=start_month, day=1)
         end_date = pd.Timestamp(year=end_year, month=end_month, day=1)
-        
-        # Filter the data based on the selected date range
-        mask = (df['time'] >= start_date) & (df['time'] <= end_date)
-        filtered_df = df.loc[mask]
-        
-        # Extract the data for plotting
-        x_data = filtered_df['time']
-        y_data = filtered_df[graph_value]
+
+        # Filter the data based on the selected date range, the same columns for every scenario
+        mask = ((time >= start_date) & (time <= end_date)).to_numpy()
+        x_range = time[mask].to_numpy()
+
+    with phase('figure'):
+        # Create the figure outside of the loop, so all lines are on the same graph
+        fig = go.Figure()
+
+    if scenario_value == 'spread':
+        # One banded trace instead of five lines: the scenario median inside the range of the five scenarios
+        with phase('compute'):
+            if group_by_year:
+                envelope = envelope_of(matrix)
+            else:
+                envelope = scenario_envelope.series(projection_bool, max_bool, graph_value)
+            low, median, high, spread = envelope[:, mask]
+            keep = union_indices((low, median, high), plot_width_px)
+            x_band, y_band = band_polygon(x_range[keep], high[keep], low[keep])
+        with phase('figure'):
+            fig.add_trace(go.Scatter(x=x_band, y=y_band, fill='toself', fillcolor=hex_to_rgba('#7f7f7f', 0.3),
+                                     line=dict(color='rgba(255,255,255,0)'), hoverinfo='skip', name='Scenario range'))
+            fig.add_trace(go.Scatter(x=x_range[keep], y=median[keep], mode='lines', name='Scenario median',
+                                     line=dict(color='#7f7f7f'), customdata=spread[keep],
+                                     hovertemplate='%{x}<br>median=%{y}<br>spread=%{customdata}<extra></extra>'))
+            fig.update_layout(title=f"Spread of Scenarios for {graph_value}")
+        return fig
+
+    for scenario_value in scenarios:
+        # Stops here if a newer request replaced this one while it runs as a background job
+        job_progress(scenarios.index(scenario_value) / len(scenarios))
+        with phase('compute'):
+            y_range = matrix[scenario_cube.scenario_index[scenario_value], mask]
+            # At most one point per pixel, keeping every bucket's min and max so peaks are drawn exactly
+            keep = minmax_indices(y_range, plot_width_px)
+            x_data = x_range[keep]
+            y_data = y_range[keep]
+            if not max_bool:
+                # Calculate the upper and lower bounds for 2 std_dev
+                y_upper = y_data + (2 * std_dev)
+                y_lower = y_data - (2 * std_dev)
+                x_band, y_band = band_polygon(x_data, y_upper, y_lower)
 
         # Add the line trace for the current scenario
         label = scenario_labels[scenario_value]
@@ -793,26 +1085,24 @@ def update_line_graph(scenario_value, graph_value, start_month, start_year, end_
         rgba_color = hex_to_rgba(color, 0.2)  # Convert to RGBA with 20% opacity
 
 
-        fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name=label,line=dict(color=color)))
-        if not max_bool:
-            # Calculate the upper and lower bounds for 2 std_dev
-            y_upper = y_data + (2 * std_dev)
-            y_lower = y_data - (2 * std_dev)
-            
-            # Add area trace for the upper bound
-            fig.add_trace(go.Scatter(
-            x=x_data.tolist() + x_data.tolist()[::-1], # x, then x reversed
-            y=y_upper.tolist() + y_lower.tolist()[::-1], # upper, then lower reversed
-            fill='toself',
-            fillcolor=rgba_color,
-            line=dict(color='rgba(255,255,255,0)'),
-            hoverinfo="skip",
-            showlegend=False
-        ))
+        with phase('figure'):
+            fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name=label,line=dict(color=color)))
+            if not max_bool:
+                # Add area trace for the upper bound
+                fig.add_trace(go.Scatter(
+                x=x_band, # x, then x reversed
+                y=y_band, # upper, then lower reversed
+                fill='toself',
+                fillcolor=rgba_color,
+                line=dict(color='rgba(255,255,255,0)'),
+                hoverinfo="skip",
+                showlegend=False
+            ))
 
     # Dynamically set the title to indicate a comparison
     title_text = f"Comparison of Scenarios for {graph_value}"
-    fig.update_layout(title=title_text)
+    with phase('figure'):
+        fig.update_layout(title=title_text)
 
     # Display the figure
     return fig
@@ -822,8 +1112,8 @@ Graph ploting average and prediction error
 ====================================================================================================================
 """
 
-@app.callback(
-    Output('line-graph-with-CI', 'figure'),
+@figure_callback(
+    'line-graph-with-CI',
     [
         Input('graph-toggle', 'value'),
         Input('start-month-dropdown', 'value'),
@@ -834,6 +1124,9 @@ Graph ploting average and prediction error
         Input('group-by-year-toggle', 'value'),
     ]
 )
+@figure_cache.memoize('line-graph-with-CI.figure', cube_files + [os.path.join(data_path, name) for name in (
+    'monthly_CI_Data_data.csv', 'monthly_CI_Data_data_project.csv',
+    'monthly_CI_yearly_Data_data.csv', 'monthly_CI_yearly_Data_data_project.csv')] + [monthly_error_file])
 def update_line_graph(graph_value, start_month, start_year, end_month, end_year, projection_bool,yearly_bool):
     data_path = os.path.join(current_directory, 'web_page_data')
     if yearly_bool:
@@ -851,50 +1144,64 @@ def update_line_graph(graph_value, start_month, start_year, end_month, end_year,
     # Create a list of columns to read, based on the input value
     columns_to_read = ['Time_UTC', f'upper_{graph_value}', f'lower_{graph_value}', f'average_{graph_value}']
 
-    # Read the dataframe, specifying the columns to read to optimize memory usage
-    df = pd.read_csv(file_path, usecols=columns_to_read, parse_dates=['Time_UTC'], index_col='Time_UTC')
-
-    # Create start and end date Timestamps
-    start_date = pd.Timestamp(year=start_year, month=start_month, day=1)
-    end_date = pd.Timestamp(year=end_year, month=end_month, day=1)
-
-    # Filter the dataframe based on the selected date range
-    filtered_df = df.loc[start_date:end_date]
-
-    # Create the figure
-    fig = go.Figure()
-
-    # Add the average line
-    fig.add_trace(go.Scatter(
-        x=filtered_df.index,
-        y=filtered_df[f'average_{graph_value}'],
-        mode='lines',
-        name='Average',
-        line=dict(color='royalblue')
-    ))
-
-    fig.add_trace(go.Scatter(
-        x=filtered_df.index,
-        y=filtered_df[f'upper_{graph_value}'],
-        line=dict(width=0),
-        mode='lines',
-        name='Upper Bound',
-        showlegend=False
-    ))
-
-    fig.add_trace(go.Scatter(
-        x=filtered_df.index,
-        y=filtered_df[f'lower_{graph_value}'],
-        fill='tonexty',  # Fill area between trace0 and trace1
-        mode='lines',
-        line=dict(width=0),
-        name='Lower Bound',
-        fillcolor='rgba(0,100,80,0.2)',
-        showlegend=False
-    ))
-    # Dynamically set the title and axis labels
-    title_text = f"{graph_value} future predcition with Confidence Interval 95% convidence interval"
-    fig.update_layout(title=title_text, xaxis_title='Time', yaxis_title=graph_value)
+    if os.path.exists(file_path):
+        # Read the dataframe, specifying the columns to read to optimize memory usage
+        df = data_cache.read_csv(file_path, usecols=columns_to_read, parse_dates=['Time_UTC'], index_col='Time_UTC')
+
+        # Create start and end date Timestamps
+        start_date = pd.Timestamp(year=start_year, month=start_month, day=1)
+        end_date = pd.Timestamp(year=end_year, month=end_month, day=1)
+
+        # Filter the dataframe based on the selected date range
+        with phase('compute'):
+            filtered_df = df.loc[start_date:end_date]
+    else:
+        # No precomputed file for this view, compute the band from the scenario mean and the monthly errors
+        with phase('compute'):
+            filtered_df = confidence_bands.frame([graph_value], projection_bool, start_year, start_month,
+                                                 end_year, end_month, 'year' if yearly_bool else 'month')
+    with phase('compute'):
+        # Thin the three traces together so the band stays aligned with the average
+        keep = union_indices([filtered_df[f'{bound}_{graph_value}'].to_numpy() for bound in ('average', 'upper', 'lower')],
+                             plot_width_px)
+        filtered_df = filtered_df.iloc[keep]
+    job_progress(0.5)
+
+    with phase('figure'):
+        # Create the figure
+        fig = go.Figure()
+
+        # Add the average line
+        fig.add_trace(go.Scatter(
+            x=filtered_df.index,
+            y=filtered_df[f'average_{graph_value}'],
+            mode='lines',
+            name='Average',
+            line=dict(color='royalblue')
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=filtered_df.index,
+            y=filtered_df[f'upper_{graph_value}'],
+            line=dict(width=0),
+            mode='lines',
+            name='Upper Bound',
+            showlegend=False
+        ))
+
+        fig.add_trace(go.Scatter(
+            x=filtered_df.index,
+            y=filtered_df[f'lower_{graph_value}'],
+            fill='tonexty',  # Fill area between trace0 and trace1
+            mode='lines',
+            line=dict(width=0),
+            name='Lower Bound',
+            fillcolor='rgba(0,100,80,0.2)',
+            showlegend=False
+        ))
+        # Dynamically set the title and axis labels
+        title_text = f"{graph_value} future predcition with Confidence Interval 95% convidence interval"
+        fig.update_layout(title=title_text, xaxis_title='Time', yaxis_title=graph_value)
 
     return fig
 """
@@ -904,7 +1211,21 @@ Graph ploting hot date and cold date
 """
 
 @app.callback(
-    Output('line-graph-for-weather', 'figure'),
+    Output('extreme-threshold-value', 'value'),
+    [Input('extreme-threshold-mode', 'value'),
+     Input('heat/cold-toggle', 'value')]
+)
+def set_threshold_default(threshold_mode, heat_or_cold):
+    # A percentile and a temperature are on different scales, so each mode starts from its own default. A heat and a
+    # cold temperature differ too, the percentile is the same for both
+    if threshold_mode not in default_thresholds:
+        raise PreventUpdate
+    if threshold_mode == 'percentile' and 'extreme-threshold-mode.value' not in triggered_inputs():
+        raise PreventUpdate
+    return default_thresholds[threshold_mode][heat_or_cold]
+
+@figure_callback(
+    'line-graph-for-weather',
     [
         Input('graph-toggle', 'value'),
         Input('start-year-dropdown', 'value'),
@@ -912,112 +1233,188 @@ Graph ploting hot date and cold date
         Input('weather-to-show','value'),
         Input('heat/cold-toggle','value'),
         Input('projection-toggle','value'),
+        Input('extreme-threshold-mode','value'),
+        Input('extreme-threshold-value','value'),
     ]
 )
-def update_line_graph( graph_value, start_year,  end_year, weather,heat_or_cold,projection_bool):
+def update_line_graph( graph_value, start_year,  end_year, weather,heat_or_cold,projection_bool, threshold_mode, threshold):
 
     scenarios = ['rcp85hotter', 'rcp85cooler','rcp45hotter','rcp45cooler', 'projection']
-    data_path = os.path.join(current_directory, 'web_page_data')
-    fig = go.Figure()
-    if weather =='degree_day':
-        for scenario_value in scenarios:
-            if heat_or_cold == 'Heat':
-                file_path = os.path.join(data_path, f'all_hdd_{scenario_value}.csv')
-            else:
-                file_path = os.path.join(data_path, f'all_cdd_{scenario_value}.csv')
-            df = pd.read_csv(file_path)
-            df['region'] = df['region'].str.lower()
-            graph_value = graph_value.lower()
-            df = df[df['region'] == graph_value]
-            
-            mask = (df['Year'] >= start_year) & (df['Year'] <= end_year)
-            filtered_df = df.loc[mask]
-            if not filtered_df.empty:
-                x_data = filtered_df['Year'].values 
-                y_data = filtered_df['hdd'].values if heat_or_cold == 'Heat' else filtered_df['cdd'].values
-                
-                if scenario_value=='projection':
-                    fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name='fix-weather on 2010'))
-                else:
-                    # Here we use the dictionary to get the label for the legend
-                    label = scenario_labels[scenario_value]
-                    fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name=label))
-            else:
-                print(f"No data for scenario {scenario_value} after filtering by {graph_value} from {start_year} to {end_year}")
-            title_text = f"{heat_or_cold} degree days by year for {graph_value}"
-
-
-        
-        fig.update_layout(title=title_text)
-
-        # Display the figure
-        return fig
-
+    graph_value = graph_value.lower()
+    if weather == 'degree_day':
+        title_text = f"{heat_or_cold} degree days by year for {graph_value}"
+    elif weather == 'Num_of_days':
+        title_text = f"Number of extreme {heat_or_cold} days by year for {graph_value}"
+    else:  # For the average demand case
+        title_text = f"Average demand for extreme {heat_or_cold} by year in {graph_value}"
+    # Degree days have no threshold, the extreme-day views are detected on the fly unless the summaries are asked for
+    detect = weather != 'degree_day' and threshold_mode != 'summary' and extreme_days is not None
+    if detect:
+        if threshold is None or (threshold_mode == 'percentile' and not 0 < threshold < 100):
+            with phase('figure'):
+                fig = go.Figure()
+                fig.add_annotation(text='Choose a percentile between 0 and 100' if threshold_mode == 'percentile'
+                                   else 'Choose a temperature', xref='paper', yref='paper', x=0.5, y=0.5, showarrow=False)
+                fig.update_layout(title=title_text)
+            return fig
+        if threshold_mode == 'percentile':
+            percentile = threshold if heat_or_cold == 'Heat' else 100 - threshold
+            title_text += f" ({'above' if heat_or_cold == 'Heat' else 'below'} the {percentile:g}th percentile of 2010 weather)"
+        else:
+            title_text += f" ({'above' if heat_or_cold == 'Heat' else 'below'} {threshold:g} °C)"
 
-    # Create the figure outside of the loop, so all lines are on the same graph
-    fig = go.Figure()
+    with phase('figure'):
+        # Create the figure outside of the loop, so all lines are on the same graph
+        fig = go.Figure()
     for scenario_value in scenarios:
-        # Construct the file path based on the scenario and weather type
-        if projection_bool:
-            if weather == 'Num_of_days':
-                if scenario_value=='projection':continue
-                if heat_or_cold == 'Heat':
-                    file_path = os.path.join(data_path, f'all_max_outliers_summary_{scenario_value}_project_.csv')
-                else:
-                    file_path = os.path.join(data_path, f'all_min_outliers_summary_{scenario_value}_project_.csv')
-                title_text = f"Number of extreme {heat_or_cold} days by year for {graph_value}"
-            else:  # For the average demand case
-                if scenario_value=='projection':continue
-                if heat_or_cold == 'Heat':
-                    file_path = os.path.join(data_path, f'all_max_outliers_demand_summary_{scenario_value}_project_.csv')
-                else:
-                    file_path = os.path.join(data_path, f'all_min_outliers_demand_summary_{scenario_value}_project_.csv')
-                title_text = f"Average demand for extreme {heat_or_cold} by year in {graph_value}"
+        # Stops here if a newer request replaced this one while it runs as a background job
+        job_progress(scenarios.index(scenario_value) / len(scenarios))
+        if detect:
+            # Counts and mean demand of every scenario come from one detection, kept for this threshold
+            series = extreme_days.series(weather, heat_or_cold, projection_bool, scenario_value, graph_value,
+                                         start_year, end_year, threshold_mode, threshold)
+        # Extreme-weather summaries have no reference scenario
+        elif weather != 'degree_day' and scenario_value == 'projection':
+            continue
         else:
-            if weather == 'Num_of_days':
-                if scenario_value=='projection':continue
-                if heat_or_cold == 'Heat':
-                    file_path = os.path.join(data_path, f'all_max_outliers_summary_{scenario_value}.csv')
-                else:
-                    file_path = os.path.join(data_path, f'all_min_outliers_summary_{scenario_value}.csv')
-                title_text = f"Number of extreme {heat_or_cold} days by year for {graph_value}"
-            else:  # For the average demand case
-                if scenario_value=='projection':continue
-                if heat_or_cold == 'Heat':
-                    file_path = os.path.join(data_path, f'all_max_outliers_demand_summary_{scenario_value}.csv')
-                else:
-                    file_path = os.path.join(data_path, f'all_min_outliers_demand_summary_{scenario_value}.csv')
-                title_text = f"Average demand for extreme {heat_or_cold} by year in {graph_value}"
-        
-        df = pd.read_csv(file_path)
-        df['region'] = df['region'].str.lower()
-        graph_value = graph_value.lower()
-        df = df[df['region'] == graph_value]
-        
-        mask = (df['Year'] >= start_year) & (df['Year'] <= end_year)
-        filtered_df = df.loc[mask]
-        
-        if not filtered_df.empty:
-            x_data = filtered_df['Year'].values 
-            y_data = filtered_df['number_of_days'].values if weather == 'Num_of_days' else filtered_df['average_total_load'].values
+            # One dictionary lookup per scenario in the region-keyed index
+            series = weather_index.series(weather, heat_or_cold, projection_bool, scenario_value, graph_value, start_year, end_year)
+        if series is None:
+            continue
+        x_data, y_data = series
+        with phase('figure'):
             if scenario_value=='projection':
                 fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name='fix-weather on 2010'))
             else:
+                # Here we use the dictionary to get the label for the legend
                 label = scenario_labels[scenario_value]
                 fig.add_trace(go.Scatter(x=x_data, y=y_data, mode='lines', name=label))
-        else:
-            print(f"No data for scenario {scenario_value} after filtering by {graph_value} from {start_year} to {end_year}")
 
-            
+    with phase('figure'):
+        if not fig.data:
+            fig.add_annotation(text=f"No data for {graph_value} from {start_year} to {end_year}",
+                               xref='paper', yref='paper', x=0.5, y=0.5, showarrow=False)
+        fig.update_layout(title=title_text)
 
+    # Display the figure
+    return fig
 
+"""
+====================================================================================================================
+Graph for comparing many regions, years and scenarios: one read per aggregate file whatever the number of series
+====================================================================================================================
+"""
+@app.callback(
+    Output('multi-compare-regions', 'value'),
+    [Input('multi-compare-state', 'value')],
+    [State('multi-compare-regions', 'value')]
+)
+def add_state_subregions(state, regions):
+    if not state:
+        raise PreventUpdate
+    regions = list(regions or [])
+    return regions + [area for area in subregions_by_state[state] if area not in regions]
 
-    
-    fig.update_layout(title=title_text)
 
-    # Display the figure
+@app.callback(
+    Output('multi-compare-graph', 'figure'),
+    [
+        Input('multi-compare-regions', 'value'),
+        Input('multi-compare-years', 'value'),
+        Input('multi-compare-scenarios', 'value'),
+        Input('multi-compare-daytype', 'value'),
+        Input('multi-compare-window', 'value'),
+        Input('max-toggle','value'),
+        Input('projection-toggle','value'),
+    ]
+)
+def update_multi_compare_graph(regions, years, scenarios, daytype, window, max_bool, projection_bool):
+    # Selecting the rows and merging the sketches is compute, the file reads inside count as read
+    with phase('compute'):
+        if window == 'merged':
+            # Median and quantile band of all the selected years together, merged from the sketches
+            series, missing = load_window_series(quantile_sketches, regions or [], sorted(years or []),
+                                                 scenarios or [], daytype, projection_bool, max_bool)
+        else:
+            series, missing = load_hourly_series(data_path, data_cache.read_csv, regions or [], years or [],
+                                                 scenarios or [], daytype, projection_bool, max_bool)
+    with phase('figure'):
+        fig = go.Figure()
+    palette = plotly_colors.qualitative.Dark24
+    for i, entry in enumerate(series):
+        color = palette[i % len(palette)]
+        name = f"{entry['region']} {entry['year']} {scenario_labels[entry['scenario']]}"
+        if not max_bool:
+            with phase('compute'):
+                band_x, band_y = band_polygon(entry['hours'], entry['upper'], entry['lower'])
+        with phase('figure'):
+            if not max_bool:
+                fig.add_trace(go.Scatter(x=band_x, y=band_y, mode='lines', line=dict(width=0), fill='toself',
+                                         fillcolor=hex_to_rgba(color, 0.15), legendgroup=name, showlegend=False,
+                                         hoverinfo='skip'))
+            fig.add_trace(go.Scatter(x=entry['hours'], y=entry['value'], mode='lines', name=name, legendgroup=name,
+                                     line=dict(color=color)))
+
+    with phase('figure'):
+        if not fig.data:
+            fig.add_annotation(text='No data for this selection' + (f" ({', '.join(missing)} missing)" if missing else ''),
+                               xref='paper', yref='paper', x=0.5, y=0.5, showarrow=False)
+        statistic = 'Max' if max_bool else 'Median' if window == 'merged' else 'Average'
+        fig.update_layout(title=f"{statistic} {daytype} demand by hour, {len(series)} series",
+                          xaxis_title='Hour of Day', yaxis_title='Hourly Demand(Mwh)', xaxis=dict(range=[0, 23]))
     return fig
 
+"""
+====================================================================================================================
+Background rendering: one poll callback hands finished figures to their graphs and shows what is still running
+====================================================================================================================
+"""
+
+
+def poll_figure_jobs(n_intervals, *job_ids):
+    figures, states = job_queue.collect(job_ids)
+    messages = []
+    for graph_id, job_id in zip(job_graphs, job_ids):
+        status, progress, error = states.get(job_id, (None, None, None))
+        if status in ('queued', 'running'):
+            messages.append(f"Updating {graph_id} {progress:.0%}")
+        elif status == 'failed':
+            messages.append(f"{graph_id} failed: {error}")
+    running = any(states.get(job_id, ('',))[0] in ('queued', 'running') for job_id in job_ids)
+    outputs = [dash.no_update if figure is None else figure for figure in figures]
+    # The timer only runs while something is pending
+    return outputs + [' | '.join(messages), not running]
+
+
+if job_graphs:
+    app.callback(
+        [Output(graph_id, 'figure') for graph_id in job_graphs]
+        + [Output('job-progress', 'children'), Output('job-interval', 'disabled')],
+        [Input('job-interval', 'n_intervals')] + [Input(f'{graph_id}-job', 'data') for graph_id in job_graphs],
+    )(poll_figure_jobs)
+startup_profile.mark('callbacks')
+
+# Everything a worker keeps in memory, by dataset; memory-mapped files are counted apart as they are shared
+memory_report.register('scenario cube', lambda: scenario_cube)
+memory_report.register('range index', lambda: (range_index.prefix, range_index.blocks, range_index.sparse))
+memory_report.register('scenario envelope', lambda: scenario_envelope.values)
+memory_report.register('data cache', lambda: data_cache.entries,
+                       lambda: (data_cache.misses, data_cache.evictions, data_cache.invalidations))
+memory_report.register('weather index', lambda: weather_index.tables, lambda: len(weather_index.tables))
+memory_report.register('quantile sketches', lambda: quantile_sketches.sketches,
+                       lambda: [signature for signature, _ in quantile_sketches.sketches.values()])
+memory_report.register('extreme days', lambda: extreme_days,
+                       lambda: len(extreme_days.results) if extreme_days is not None else 0)
+memory_report.register('confidence bands', lambda: (confidence_bands.sigmas, confidence_bands.centers),
+                       lambda: (confidence_bands.sigmas is not None, len(confidence_bands.centers)))
+memory_report.register('map layers', lambda: (gdf_country, gdf_state, gdf_subregion,
+                                              geojson_country, geojson_state, geojson_subregion))
+memory_report.register('map geometry payloads', lambda: map_geometry)
+memory_report.register('spatial index', lambda: spatial_index, lambda: len(spatial_index.trees))
+memory_report.register('figure cache', lambda: figure_cache.entries,
+                       lambda: (len(figure_cache.entries), figure_cache.current_bytes))
+memory_report.register('state mapping', lambda: subregions_by_state)
+
 """
 ====================================================================================================================
 the main code for the run
@@ -1025,5 +1422,31 @@ the main code for the run
 """
 
 
+def warm_shared_data():
+    """
+    Load every lazily read dataset now. gunicorn.conf.py calls this in the master process, before the workers are
+    forked, so the workers share these pages with the master instead of each reading its own copy on first use.
+    """
+    weather_index.warm(scenario_cube.scenarios)
+    prewarm_figures()
+    # Measure the warmed datasets once here, /metrics then only measures again the ones that changed
+    memory_report.report()
+
+
+def prewarm_figures():
+    """
+    Render the default view and the most requested inputs of every memoized figure, FIGURE_CACHE_PREWARM=0 skips it
+    and FIGURE_CACHE_PREWARM_TOP sets how many popular input combinations are rendered per figure.
+    """
+    if os.environ.get('FIGURE_CACHE_PREWARM', '1') == '0':
+        return
+    values = layout_values(app.layout)
+    # The map figure is only rendered on the server with MAP_GEOMETRY_ONCE=0
+    default_args = {name: [values.get(i.component_id) for i in figure_inputs[name]]
+                    for name in figure_cache.functions if name in figure_inputs}
+    figure_cache.prewarm(default_args, int(os.environ.get('FIGURE_CACHE_PREWARM_TOP', 20)))
+
+
 if __name__ == '__main__':
+    prewarm_figures()
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,130 @@
+#import require package
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from callback_metrics import timed_phase
+from memory_budget import compact_frame
+
+"""
+====================================================================================================================
+Shared read layer for the data files: parsed frames are kept in a byte-bounded LRU cache keyed by
+(path, columns, dtypes, read options) and dropped as soon as the file's size or mtime changes; with DATA_COMPACT=1
+frames are stored with compact column types (see memory_budget.py)
+====================================================================================================================
+"""
+
+# Default budget, override with the DATA_CACHE_BYTES environment variable
+default_max_bytes = 256 * 1024 ** 2
+
+
+def _freeze(value):
+    """
+    Turn read_csv arguments (lists, dicts) into something hashable for the cache key.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class DataCache:
+    """
+    Byte-bounded LRU cache of parsed data files.
+
+    Frames handed out are shared between callbacks and must not be modified in place.
+    """
+
+    def __init__(self, max_bytes=default_max_bytes, compact=False):
+        self.max_bytes = max_bytes
+        self.compact = compact
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Called as hook(file_path, bytes) after every read that went to disk
+        self.read_hooks = []
+
+    @timed_phase('read')
+    def read_csv(self, file_path, usecols=None, dtype=None, **kwargs):
+        """
+        Drop-in for pd.read_csv that serves repeated reads of an unchanged file from memory.
+
+        Parameters:
+        - file_path: the CSV to read.
+        - usecols, dtype, kwargs: passed on to pd.read_csv and part of the cache key.
+
+        Returns:
+        - The parsed DataFrame.
+        """
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        key = (file_path, _freeze(usecols), _freeze(dtype), _freeze(kwargs))
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == signature:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # The file changed on disk since it was cached
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+
+        df = pd.read_csv(file_path, usecols=usecols, dtype=dtype, **kwargs)
+        if self.compact:
+            df = compact_frame(df)
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        for hook in self.read_hooks:
+            hook(file_path, stat.st_size)
+
+        with self.lock:
+            if size <= self.max_bytes:
+                if key in self.entries:
+                    self._remove(key)
+                self.entries[key] = (signature, df, size)
+                self.current_bytes += size
+                while self.current_bytes > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+                    self.evictions += 1
+        return df
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """
+        Return the hit/miss counters and the current memory use of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+# One cache per process, shared by every callback
+data_cache = DataCache(int(os.environ.get('DATA_CACHE_BYTES', default_max_bytes)),
+                       compact=os.environ.get('DATA_COMPACT', '0') == '1')
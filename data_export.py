@@ -0,0 +1,165 @@
+#import require package
+import hashlib
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from flask import Response, abort, request
+
+from scenario_cube import cube_file, file_signature
+
+"""
+====================================================================================================================
+Bulk export API on the Flask server, read straight from the memory-mapped scenario cube the callbacks use:
+
+    GET /api/demand?scenario=rcp85hotter&projection=0&stat=sum&regions=USA,p1&start=2030-01&end=2060-12&format=csv
+    GET /api/demand/meta
+
+The extract is streamed in chunks of months, as CSV (Year, Month and one column per region, like the monthly CSVs)
+or as an Arrow IPC stream when pyarrow is installed (format=arrow), so a worker never holds more than one chunk.
+Every response carries an ETag built from the cube file and the query, a repeated pull of unchanged data gets a
+304 Not Modified without reading anything
+====================================================================================================================
+"""
+
+# Months per streamed chunk
+chunk_months = 120
+
+
+def parse_month(text, name):
+    """
+    Parse 'YYYY-MM' into (year, month), answering 400 when it is malformed.
+    """
+    try:
+        year, month = (int(part) for part in text.split('-'))
+    except ValueError:
+        abort(400, description=f'{name} must look like 2030-01')
+    if not 1 <= month <= 12:
+        abort(400, description=f'{name} has no month {month}')
+    return year, month
+
+
+def csv_chunks(cube, block, rows, regions):
+    """
+    Yield the selected rows as CSV text, one chunk of months at a time, after the header (sent even when no month
+    matches).
+    """
+    positions = cube.region_positions(regions)
+    yield pd.DataFrame(columns=['Year', 'Month'] + regions).to_csv(index=False)
+    for start in range(0, len(rows), chunk_months):
+        part = rows[start:start + chunk_months]
+        df = pd.DataFrame(block[part][:, positions], columns=regions)
+        df.insert(0, 'Month', cube.months[part])
+        df.insert(0, 'Year', cube.years[part])
+        yield df.to_csv(index=False, header=False)
+
+
+def arrow_chunks(cube, block, rows, regions):
+    """
+    Yield the selected rows as an Arrow IPC stream, one record batch per chunk of months.
+    """
+    import pyarrow as pa
+
+    positions = cube.region_positions(regions)
+    schema = pa.schema([('Year', pa.int32()), ('Month', pa.int8())] + [(region, pa.float64()) for region in regions])
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    for start in range(0, len(rows), chunk_months):
+        part = rows[start:start + chunk_months]
+        values = block[part][:, positions]
+        columns = [pa.array(cube.years[part], pa.int32()), pa.array(cube.months[part], pa.int8())]
+        columns += [pa.array(values[:, i], pa.float64()) for i in range(len(regions))]
+        writer.write_batch(pa.record_batch(columns, schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+def arrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def install_export_api(server, data_path, cube):
+    """
+    Add the export routes to the Flask server.
+
+    Parameters:
+    - server: the Flask app behind Dash.
+    - data_path: the web_page_data folder, the cube file signature there versions every ETag.
+    - cube: the ScenarioCube the callbacks read.
+    """
+    version = file_signature(os.path.join(data_path, cube_file))
+    formats = {'csv': ('text/csv', csv_chunks)}
+    if arrow_available():
+        formats['arrow'] = ('application/vnd.apache.arrow.stream', arrow_chunks)
+    first_month = f'{cube.years[0]}-{cube.months[0]:02d}'
+    last_month = f'{cube.years[-1]}-{cube.months[-1]:02d}'
+
+    def conditional(etag):
+        # The answer only depends on the cube and the query, an unchanged pull is answered from the ETag alone
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        return None
+
+    @server.route('/api/demand/meta')
+    def export_meta():
+        body = json.dumps({
+            'scenarios': cube.scenarios,
+            'regions': cube.regions,
+            'start': first_month,
+            'end': last_month,
+            'stats': ['sum', 'max'],
+            'formats': list(formats),
+        })
+        etag = hashlib.sha1(json.dumps([version, body]).encode()).hexdigest()
+        response = conditional(etag) or Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response
+
+    @server.route('/api/demand')
+    def export_demand():
+        args = request.args
+        scenario_value = args.get('scenario', cube.scenarios[0])
+        if scenario_value not in cube.scenario_index:
+            abort(400, description=f'unknown scenario {scenario_value}, choose from {", ".join(cube.scenarios)}')
+        projection_bool = args.get('projection', '0').lower() in ('1', 'true')
+        stat = args.get('stat', 'sum')
+        if stat not in ('sum', 'max'):
+            abort(400, description='stat must be sum or max')
+        regions = [r for r in args.get('regions', '').split(',') if r] or list(cube.regions)
+        unknown = [r for r in regions if r not in cube.region_index]
+        if unknown:
+            abort(400, description=f'unknown regions {", ".join(unknown)}')
+        file_format = args.get('format', 'csv')
+        if file_format not in formats:
+            abort(400, description=f'format must be one of {", ".join(formats)}')
+        start_year, start_month = parse_month(args.get('start', first_month), 'start')
+        end_year, end_month = parse_month(args.get('end', last_month), 'end')
+
+        query = [scenario_value, projection_bool, stat, regions, start_year, start_month, end_year, end_month,
+                 file_format]
+        etag = hashlib.sha1(json.dumps([version, query]).encode()).hexdigest()
+        response = conditional(etag)
+        if response is not None:
+            return response
+
+        position = cube.years.astype(np.int64) * 12 + cube.months
+        rows = np.flatnonzero((position >= start_year * 12 + start_month) & (position <= end_year * 12 + end_month))
+        block = cube.block(scenario_value, projection_bool, stat == 'max')
+        mimetype, chunks = formats[file_format]
+        response = Response(chunks(cube, block, rows, regions), mimetype=mimetype)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        file_name = f"{scenario_value}_{'project_' if projection_bool else ''}{stat}.{file_format}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{file_name}"'
+        return response
@@ -0,0 +1,72 @@
+#import require package
+import numpy as np
+
+"""
+====================================================================================================================
+Resolution-aware downsampling for the time-series graphs: a trace never carries more points than the graph has
+pixels across. The plotted range is cut into equal buckets and only the first and last point and each bucket's
+minimum and maximum are kept, so every peak and trough is drawn exactly and the payload stays flat however fine
+the underlying time resolution gets
+====================================================================================================================
+"""
+
+# Width in pixels the traces are sized for, one kept point per pixel
+default_width_px = 800
+
+
+def minmax_indices(y, max_points=default_width_px):
+    """
+    Pick the positions to keep from a series.
+
+    Parameters:
+    - y: 1-D array of values, NaN allowed.
+    - max_points: upper bound on the number of positions returned.
+
+    Returns:
+    - Sorted positions into y: the first and last one plus the minimum and maximum of every bucket.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    return bucket_extremes(y, y, max_points)
+
+
+def union_indices(series, max_points=default_width_px):
+    """
+    Positions to keep for traces drawn together over the same x (a line and its band), one set for all of them so
+    the traces stay aligned. Every bucket keeps where the lowest and the highest of the series peak, so the outline of
+    the band is exact and no trace gets more than max_points points.
+    """
+    stacked = np.asarray([np.asarray(y, dtype=np.float64) for y in series])
+    # fmin/fmax skip NaN, a position is NaN only when every series is
+    return bucket_extremes(np.fmin.reduce(stacked, axis=0), np.fmax.reduce(stacked, axis=0), max_points)
+
+
+def bucket_extremes(low, high, max_points):
+    """
+    Sorted positions of the first and last point and, in every bucket, of the minimum of low and the maximum of high.
+    """
+    n = len(low)
+    n_buckets = max((max_points - 2) // 2, 1)
+    if n <= max_points:
+        return np.arange(n)
+
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+    offsets = np.arange(n_buckets) * size
+    extremes = []
+    for values, fill, pick in ((low, np.inf, np.argmin), (high, -np.inf, np.argmax)):
+        padded = np.full(n_buckets * size, np.nan)
+        padded[:n] = values
+        rows = padded.reshape(n_buckets, size)
+        extremes.append(offsets + pick(np.where(np.isnan(rows), fill, rows), axis=1))
+    keep = np.concatenate(([0, n - 1], *extremes))
+    # A bucket made only of padding points past the end
+    return np.unique(keep[keep < n])
+
+
+def band_polygon(x, upper, lower):
+    """
+    Closed outline of the area between two curves, for a fill='toself' trace: x then x reversed,
+    upper then lower reversed.
+    """
+    x = np.asarray(x)
+    return np.concatenate((x, x[::-1])), np.concatenate((np.asarray(upper), np.asarray(lower)[::-1]))
@@ -0,0 +1,296 @@
+#import require package
+import argparse
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from build_aggregates import hourly_file_name, read_hourly
+from callback_metrics import timed_phase
+from scenario_cube import scenarios
+
+"""
+====================================================================================================================
+Extreme-day detection for any threshold, from daily temperature and demand arrays instead of the all_*_outliers_*
+summaries, which only hold the thresholds they were built with
+
+Input, in the hourly folder next to the demand files of build_aggregates.py:
+    {scenario}_t2_hourly.csv  Time_UTC and one hourly 2 m temperature column (degrees C) per region
+Output, in web_page_data, memory-mapped by the dashboard:
+    extreme_days_temperature.npy  daily max and min temperature, (max/min, scenario, day, region)
+    extreme_days_load.npy         daily total demand, (projection flag, scenario, day, region)
+    extreme_days.json             regions, scenarios and first day of the arrays
+
+A heat day has a daily max above the threshold, a cold day a daily min below it. The threshold is a temperature, or a
+percentile of the region's days in the reference scenario (fixed 2010 weather), so hotter scenarios get more heat
+days. One detection compares every scenario, day and region in a single pass, a few years at a time, and sums them by
+year; its counts and mean loads are kept by threshold, so going back to a threshold costs nothing.
+
+Run from the repository root:  python extreme_days.py [--hourly-folder hourly_data]
+====================================================================================================================
+"""
+
+temperature_file = 'extreme_days_temperature.npy'
+load_file = 'extreme_days_load.npy'
+extreme_meta_file = 'extreme_days.json'
+# Scenario whose days set the percentile thresholds, all scenarios pooled when it is missing
+reference_scenario = 'projection'
+# Detections kept, each is a few hundred kB
+max_results = 64
+# Years compared per step of a detection, bounds its temporaries
+years_per_block = 8
+# Threshold each mode starts from, by heat/cold: a percentile, or a temperature in degrees C
+default_thresholds = {'percentile': {'Heat': 95, 'Cold': 95}, 'absolute': {'Heat': 35, 'Cold': -10}}
+
+
+def temperature_file_name(scenario_value):
+    return f'{scenario_value}_t2_hourly.csv'
+
+
+def daily_frames(file_path, how):
+    """
+    Read an hourly file and reduce every region to one value per day.
+
+    Parameters:
+    - file_path: hourly file with a Time_UTC column and one column per region.
+    - how: list of reductions, 'max', 'min' or 'sum'; days without any value stay NaN.
+
+    Returns:
+    - One DataFrame per reduction, indexed by day.
+    """
+    time, values = read_hourly(file_path)
+    grouped = values.set_axis(time).groupby(time.normalize())
+    return [grouped.sum(min_count=1) if reduction == 'sum' else grouped.agg(reduction) for reduction in how]
+
+
+def save_array(path, values):
+    # The temporary name carries the process id, so two builds running at once never write the same file
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, values)
+    os.replace(tmp_path, path)
+
+
+def build_extreme_days(hourly_path, data_path, scenario_values=scenarios):
+    """
+    Pack the daily temperature and demand of every scenario into the arrays read by ExtremeDays.
+
+    Parameters:
+    - hourly_path: folder holding the hourly temperature and demand files.
+    - data_path: the web_page_data folder to write to.
+    - scenario_values: scenarios to pack, those without a temperature file are left out.
+
+    Returns:
+    - The scenarios packed, empty when no temperature file was found (nothing is written then).
+    """
+    temperatures, loads = {}, {}
+    for scenario_value in scenario_values:
+        file_path = os.path.join(hourly_path, temperature_file_name(scenario_value))
+        if not os.path.exists(file_path):
+            continue
+        temperatures[scenario_value] = daily_frames(file_path, ['max', 'min'])
+        for projection_bool in (False, True):
+            demand_path = os.path.join(hourly_path, hourly_file_name(scenario_value, projection_bool))
+            if os.path.exists(demand_path):
+                loads[scenario_value, projection_bool] = daily_frames(demand_path, ['sum'])[0]
+    packed = list(temperatures)
+    if not packed:
+        return packed
+
+    # Regions in the order of the first file, days as one contiguous range over all of them
+    regions = list(temperatures[packed[0]][0].columns)
+    first_day = min(frames[0].index.min() for frames in temperatures.values())
+    last_day = max(frames[0].index.max() for frames in temperatures.values())
+    days = pd.date_range(first_day, last_day, freq='D')
+
+    temperature = np.full((2, len(packed), len(days), len(regions)), np.nan, dtype=np.float32)
+    load = np.full((2, len(packed), len(days), len(regions)), np.nan, dtype=np.float32)
+    for s, scenario_value in enumerate(packed):
+        for k, frame in enumerate(temperatures[scenario_value]):
+            temperature[k, s] = frame.reindex(index=days, columns=regions).to_numpy(dtype=np.float32)
+        for p, projection_bool in enumerate((False, True)):
+            frame = loads.get((scenario_value, projection_bool))
+            if frame is not None:
+                load[p, s] = frame.reindex(index=days, columns=regions).to_numpy(dtype=np.float32)
+
+    save_array(os.path.join(data_path, temperature_file), temperature)
+    save_array(os.path.join(data_path, load_file), load)
+    meta_path = os.path.join(data_path, extreme_meta_file)
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'regions': regions, 'scenarios': packed, 'first_day': str(days[0].date()), 'days': len(days)}, f)
+    os.replace(tmp_path, meta_path)
+    return packed
+
+
+class ExtremeDays:
+    """
+    Counts of extreme days and mean demand on them by scenario, year and region, for any threshold.
+    """
+
+    def __init__(self, meta, temperature, load):
+        """
+        Parameters:
+        - meta: the content of extreme_days.json.
+        - temperature, load: the arrays of extreme_days_temperature.npy and extreme_days_load.npy.
+        """
+        self.scenarios = meta['scenarios']
+        self.regions = meta['regions']
+        self.scenario_index = {s: i for i, s in enumerate(self.scenarios)}
+        self.region_index = {r.lower(): i for i, r in enumerate(self.regions)}
+        self.temperature = temperature
+        self.load = load
+        day_years = pd.date_range(meta['first_day'], periods=meta['days'], freq='D').year.to_numpy()
+        # Days are in time order, every year is one contiguous run of the day axis
+        self.year_starts = np.r_[0, np.flatnonzero(np.diff(day_years)) + 1]
+        self.years = day_years[self.year_starts]
+        # Days with a temperature, by scenario, year and region: a year counts as data only when it has some. Both
+        # passes go a few years at a time like detect, every worker runs them when it imports the dashboard
+        n_scenarios, _, n_regions = temperature.shape[1:]
+        self.observed = np.empty((n_scenarios, len(self.years), n_regions), dtype=np.int32)
+        self.load_complete = True
+        for first, last, start, stop, year_starts in self.year_blocks():
+            self.observed[:, first:last] = np.add.reduceat(~np.isnan(temperature[0, :, start:stop]), year_starts,
+                                                           axis=1, dtype=np.int32)
+            if self.load_complete:
+                self.load_complete = not any(np.isnan(load[p, :, start:stop]).any() for p in range(2))
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def year_blocks(self):
+        """
+        Cut the day axis into runs of years_per_block years.
+
+        Returns:
+        - For every run: its first and past-the-end year positions, its first and past-the-end days, and the first
+          day of each of its years counted from the start of the run.
+        """
+        bounds = np.r_[self.year_starts, self.temperature.shape[2]]
+        for first in range(0, len(self.years), years_per_block):
+            last = min(first + years_per_block, len(self.years))
+            start, stop = bounds[first], bounds[last]
+            yield first, last, start, stop, self.year_starts[first:last] - start
+
+    def thresholds(self, heat_or_cold, mode, value):
+        """
+        Threshold of every region, in degrees.
+
+        Parameters:
+        - heat_or_cold: 'Heat' or 'Cold'.
+        - mode: 'absolute' for a temperature, 'percentile' for a percentile of the reference scenario; a cold
+          percentile p is taken from the low end, at 100 - p.
+        - value: the temperature or percentile.
+        """
+        if mode == 'absolute':
+            return np.full(len(self.regions), float(value))
+        daily = self.temperature[0 if heat_or_cold == 'Heat' else 1]
+        if reference_scenario in self.scenario_index:
+            days = daily[self.scenario_index[reference_scenario]]
+        else:
+            days = np.asarray(daily).reshape(-1, len(self.regions))
+        q = float(value) if heat_or_cold == 'Heat' else 100 - float(value)
+        return np.nanpercentile(days, q, axis=0)
+
+    @timed_phase('read')
+    def detect(self, heat_or_cold, mode, value):
+        """
+        Count the extreme days of every scenario, year and region, and average their demand, in one pass over the
+        arrays.
+
+        Returns:
+        - The (scenario, year, region) day counts and the (projection flag, scenario, year, region) mean daily
+          demand on those days, NaN where there is none.
+        """
+        key = (heat_or_cold, mode, float(value))
+        with self.lock:
+            result = self.results.get(key)
+            if result is not None:
+                self.results.move_to_end(key)
+                return result
+
+        threshold = self.thresholds(heat_or_cold, mode, value)
+        counts = np.empty(self.observed.shape, dtype=np.int32)
+        totals = np.empty((2,) + self.observed.shape, dtype=np.float32)
+        days = np.empty(totals.shape, dtype=np.int32)
+        # A few years at a time and one projection flag at a time, so the temporaries stay a few MB whatever the
+        # length of the arrays
+        for first, last, start, stop, year_starts in self.year_blocks():
+            if heat_or_cold == 'Heat':
+                extreme = self.temperature[0, :, start:stop] > threshold
+            else:
+                extreme = self.temperature[1, :, start:stop] < threshold
+            counts[:, first:last] = np.add.reduceat(extreme, year_starts, axis=1, dtype=np.int32)
+            # Demand summed over the extreme days; when some days have no demand, only the days that have one are
+            # summed and counted
+            for p in range(2):
+                load = self.load[p, :, start:stop]
+                if self.load_complete:
+                    selected = extreme
+                    days[p, :, first:last] = counts[:, first:last]
+                else:
+                    selected = extreme & ~np.isnan(load)
+                    days[p, :, first:last] = np.add.reduceat(selected, year_starts, axis=1, dtype=np.int32)
+                totals[p, :, first:last] = np.add.reduceat(np.where(selected, load, np.float32(0)), year_starts, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_load = np.where(days > 0, totals.astype(np.float64) / days, np.nan)
+
+        result = (counts, mean_load)
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > max_results:
+                self.results.popitem(last=False)
+        return result
+
+    def series(self, weather, heat_or_cold, projection_bool, scenario_value, region, start_year, end_year,
+               mode, value):
+        """
+        Return the (years, values) of one region and scenario between start_year and end_year, or None when there is
+        no data, like WeatherIndex.series.
+
+        Parameters:
+        - weather: 'Num_of_days' for the number of extreme days, 'average_t2' for their mean daily demand.
+        - mode, value: the threshold, see thresholds.
+        """
+        s = self.scenario_index.get(scenario_value)
+        r = self.region_index.get(region.lower())
+        if s is None or r is None:
+            return None
+        counts, mean_load = self.detect(heat_or_cold, mode, value)
+        if weather == 'Num_of_days':
+            values = counts[s, :, r]
+            mask = self.observed[s, :, r] > 0
+        else:
+            values = mean_load[int(bool(projection_bool)), s, :, r]
+            mask = ~np.isnan(values)
+        mask &= (self.years >= start_year) & (self.years <= end_year)
+        if not mask.any():
+            return None
+        return self.years[mask], values[mask]
+
+
+def load_extreme_days(data_path):
+    """
+    Memory-map the packed daily arrays, or return None when extreme_days.py has not been run.
+    """
+    paths = [os.path.join(data_path, name) for name in (temperature_file, load_file, extreme_meta_file)]
+    if not all(os.path.exists(path) for path in paths):
+        return None
+    with open(paths[2]) as f:
+        meta = json.load(f)
+    return ExtremeDays(meta, np.load(paths[0], mmap_mode='r'), np.load(paths[1], mmap_mode='r'))
+
+
+if __name__ == '__main__':
+    current_directory = os.getcwd()
+    parser = argparse.ArgumentParser(description='Pack daily temperature and demand for extreme-day detection.')
+    parser.add_argument('--hourly-folder', default=os.path.join(current_directory, 'hourly_data'))
+    parser.add_argument('--data-folder', default=os.path.join(current_directory, 'web_page_data'))
+    args = parser.parse_args()
+
+    packed = build_extreme_days(args.hourly_folder, args.data_folder)
+    if packed:
+        print(f"Packed the daily arrays of {', '.join(packed)}")
+    else:
+        print(f'No {temperature_file_name("<scenario>")} file in {args.hourly_folder}, nothing written')
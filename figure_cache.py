@@ -0,0 +1,264 @@
+#import require package
+import atexit
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import plotly.io as pio
+
+from scenario_cube import file_signature
+
+"""
+====================================================================================================================
+Memoized figures: a callback's figure is serialized once per distinct set of inputs and kept as JSON text in a
+byte-bounded LRU in memory, with a second tier of files on disk shared by every worker and kept across restarts.
+The signatures (size, mtime) of the data files a callback reads are part of the key, so a changed file makes its
+figures unreachable and they age out of both tiers. So is a version of the rendering code and settings (see
+code_version), so the disk tier does not serve the figures of a previous deploy.
+
+How often each set of inputs is asked for is counted, and prewarm() renders the layout's default view and the
+most requested combinations at startup.
+====================================================================================================================
+"""
+
+default_max_bytes = 64 * 1024 ** 2
+default_max_disk_bytes = 512 * 1024 ** 2
+popular_file = 'popular.json'
+
+
+def code_version(directory, settings):
+    """
+    Hash the source of every module loaded from directory together with the render settings.
+
+    Parameters:
+    - directory: the repository folder, only the modules found there are hashed.
+    - settings: dictionary of the settings figures depend on (plot width, data mode, library versions...).
+
+    Returns:
+    - A hex digest that changes with any deployed code change or setting change.
+    """
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode())
+    directory = os.path.abspath(directory)
+    paths = {os.path.abspath(module.__file__) for module in list(sys.modules.values())
+             if getattr(module, '__file__', None)}
+    for path in sorted(paths):
+        if path.endswith('.py') and os.path.dirname(path) == directory:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def layout_values(layout):
+    """
+    Return {component id: initial value} for every component of a Dash layout that has both.
+    """
+    return {component.id: component.value for component in layout._traverse()
+            if getattr(component, 'id', None) is not None and getattr(component, 'value', None) is not None}
+
+
+class FigureCache:
+    """
+    Two-tier cache of serialized callback figures.
+    """
+
+    def __init__(self, max_bytes=default_max_bytes, cache_dir=None, max_disk_bytes=default_max_disk_bytes,
+                 enabled=True, version=None):
+        self.enabled = enabled
+        # Part of every key, see code_version
+        self.version = version
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or None
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+        self.functions = {}
+        # Requests per (callback name, inputs), counted since the last save to popular.json
+        self.requests = {}
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.enabled and self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            atexit.register(self.save_popular)
+
+    # Tiers -------------------------------------------------------------------------------------------------------
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.entries.move_to_end(digest)
+                self.memory_hits += 1
+                return entry
+        if self.cache_dir is None:
+            return None
+        file_path = os.path.join(self.cache_dir, digest + '.json')
+        try:
+            with open(file_path, encoding='utf-8') as f:
+                text = f.read()
+            # The modification time orders the disk tier for pruning
+            os.utime(file_path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        self.put_memory(digest, text)
+        return text
+
+    def put_memory(self, digest, text):
+        size = len(text)
+        with self.lock:
+            if size > self.max_bytes or digest in self.entries:
+                return
+            self.entries[digest] = text
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+
+    def put(self, digest, text):
+        self.put_memory(digest, text)
+        if self.cache_dir is None:
+            return
+        file_path = os.path.join(self.cache_dir, digest + '.json')
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, file_path)
+        self.prune_disk()
+
+    def prune_disk(self):
+        """
+        Delete the least recently used figure files until the disk tier fits its budget.
+        """
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.json') and entry.name != popular_file:
+                stat = entry.stat()
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, file_path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    # Memoization -------------------------------------------------------------------------------------------------
+
+    def memoize(self, name, files):
+        """
+        Cache the figures returned by a callback function.
+
+        Parameters:
+        - name: unique name of the callback, used in the key and to find it again for pre-warming.
+        - files: the data files the callback reads, as a list of paths or a function of the callback arguments
+          returning one. Their signatures are part of the key.
+
+        Returns:
+        - A decorator. The decorated function returns the figure as a dictionary on a cache hit.
+        """
+        def decorator(function):
+            if not self.enabled:
+                return function
+
+            @wraps(function)
+            def wrapper(*args):
+                inputs = json.dumps(args, sort_keys=True, default=str)
+                paths = files(*args) if callable(files) else files
+                signatures = [file_signature(p) if os.path.exists(p) else None for p in paths]
+                digest = hashlib.sha1(json.dumps([self.version, name, inputs, signatures]).encode()).hexdigest()
+                with self.lock:
+                    self.requests[(name, inputs)] = self.requests.get((name, inputs), 0) + 1
+
+                text = self.get(digest)
+                if text is not None:
+                    return json.loads(text)
+                figure = function(*args)
+                with self.lock:
+                    self.misses += 1
+                self.put(digest, pio.to_json(figure, validate=False))
+                return figure
+
+            self.functions[name] = wrapper
+            return wrapper
+        return decorator
+
+    # Popularity and pre-warming ----------------------------------------------------------------------------------
+
+    def load_popular(self):
+        if self.cache_dir is None:
+            return {}
+        try:
+            with open(os.path.join(self.cache_dir, popular_file)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_popular(self):
+        """
+        Add the requests counted since the last save to popular.json. Workers saving at the same moment can lose
+        each other's counts, which only makes the ranking slightly less exact.
+        """
+        if self.cache_dir is None:
+            return
+        with self.lock:
+            requests, self.requests = self.requests, {}
+        if not requests:
+            return
+        popular = self.load_popular()
+        for (name, inputs), count in requests.items():
+            counts = popular.setdefault(name, {})
+            counts[inputs] = counts.get(inputs, 0) + count
+        file_path = os.path.join(self.cache_dir, popular_file)
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(popular, f)
+        os.replace(tmp_path, file_path)
+
+    def prewarm(self, default_args, top=20):
+        """
+        Render the default view of every memoized callback and its most requested inputs.
+
+        Parameters:
+        - default_args: {callback name: argument list of the default view}.
+        - top: how many of the most requested input combinations to render per callback.
+
+        Returns:
+        - The number of figures rendered or loaded.
+        """
+        popular = self.load_popular()
+        rendered = 0
+        for name, function in self.functions.items():
+            counts = popular.get(name, {})
+            candidates = [default_args[name]] if name in default_args else []
+            candidates += [json.loads(inputs) for inputs in sorted(counts, key=counts.get, reverse=True)[:top]]
+            for args in candidates:
+                try:
+                    function(*args)
+                    rendered += 1
+                except Exception as e:
+                    # Inputs recorded before a data change may no longer be valid, they just are not pre-warmed
+                    print(f'Could not pre-warm {name} {args}: {type(e).__name__}: {e}')
+        # Pre-warming is not a request, do not count it as one
+        with self.lock:
+            self.requests = {}
+        return rendered
+
+    def stats(self):
+        with self.lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+            }
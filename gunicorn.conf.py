@@ -0,0 +1,39 @@
+#import require package
+import gc
+import multiprocessing
+import os
+
+"""
+====================================================================================================================
+gunicorn settings for serving the dashboard with one worker per core
+
+The app is imported once in the master (preload_app), which builds or opens the memory-mapped scenario cube and
+range index and reads the map geometry and summary tables. Workers are forked from it and share those pages
+instead of each loading a private copy, and a restarted worker is forked again without reloading anything.
+
+Run from the repository root:  gunicorn
+Environment: PORT (default 8050), WEB_CONCURRENCY (workers, default one per core), MAX_REQUESTS (recycle a worker
+after this many requests, default 0 = never)
+====================================================================================================================
+"""
+
+wsgi_app = 'dashboard_future:server'
+bind = f"0.0.0.0:{os.environ.get('PORT', '8050')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+timeout = 120
+
+
+def when_ready(server):
+    """
+    Runs in the master once the app is loaded and before any worker is forked.
+    """
+    import dashboard_future
+    dashboard_future.warm_shared_data()
+    # Move everything loaded so far out of the collector's reach, otherwise the first collection in each worker
+    # writes to every object header and turns the shared pages into private copies
+    gc.collect()
+    gc.freeze()
+    server.log.info('Shared data loaded in the master, %d objects frozen', gc.get_freeze_count())
@@ -0,0 +1,214 @@
+#import require package
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import plotly.io as pio
+from flask import request
+
+"""
+====================================================================================================================
+Local background job queue for the heavy figure callbacks, backed by a SQLite file so every gunicorn worker sees
+every job: a callback only records the job and returns, a thread pool renders the figure, and the page polls for
+the result with a dcc.Interval
+
+A new job from the same browser session for the same figure cancels the older ones: jobs still queued are dropped
+and running ones stop at their next job_progress() checkpoint
+
+Every job records the pid of the worker that owns it, and each worker touches the updated time of its unfinished
+jobs every heartbeat_s seconds. A queued or running job not touched for stale_after_s seconds belonged to a worker
+that was killed or timed out; it is marked failed so the page stops polling for it
+====================================================================================================================
+"""
+
+session_cookie = 'dash_session'
+# Finished, failed and cancelled jobs are deleted after this many seconds
+job_lifetime_s = 3600
+# How often a worker touches its unfinished jobs, and how long without it before they count as lost
+heartbeat_s = 5
+stale_after_s = 30
+
+_current = threading.local()
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when a newer request for the same figure and session superseded it.
+    """
+
+
+def job_progress(fraction):
+    """
+    Report how far the running job is (0 to 1) and stop it if it was superseded. Does nothing outside a job,
+    so callback functions can call it whether they run synchronously or in the background.
+    """
+    job = getattr(_current, 'job', None)
+    if job is not None:
+        queue, job_id = job
+        if not queue.update_progress(job_id, fraction):
+            raise JobCancelled(job_id)
+
+
+def current_session():
+    """
+    The browser session of the current Dash request, from the cookie set by install_session_cookie().
+    """
+    return request.cookies.get(session_cookie) or request.remote_addr or 'anonymous'
+
+
+def install_session_cookie(server):
+    """
+    Give every browser a random session id cookie on its first response (the page itself, before any callback).
+    """
+    @server.after_request
+    def set_session_cookie(response):
+        if session_cookie not in request.cookies:
+            response.set_cookie(session_cookie, uuid.uuid4().hex, httponly=True, samesite='Lax')
+        return response
+
+
+class JobQueue:
+    """
+    SQLite-backed queue of figure jobs with a per-process thread pool running them.
+    """
+
+    def __init__(self, db_path, threads=2):
+        self.db_path = db_path
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='figure-job')
+        # Process running the heartbeat thread; the queue is created in the gunicorn master and the thread is
+        # started again in each forked worker
+        self.heartbeat_pid = None
+        self.heartbeat_lock = threading.Lock()
+        with self.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, session TEXT, name TEXT, '
+                               'status TEXT, progress REAL, result TEXT, error TEXT, delivered INTEGER, '
+                               'updated REAL, owner INTEGER)')
+            # Files created before jobs had an owner
+            if 'owner' not in [row[1] for row in connection.execute('PRAGMA table_info(jobs)')]:
+                connection.execute('ALTER TABLE jobs ADD COLUMN owner INTEGER')
+            connection.execute('CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session, name, status)')
+
+    def connect(self):
+        # One short-lived connection per operation, safe from any thread or process
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def submitter(self, name, function):
+        """
+        Return a callback function that queues function(*args) as a job and returns the job id at once.
+        """
+        def submit(*args):
+            return self.submit(current_session(), name, function, args)
+        submit.__name__ = f'submit_{function.__name__}'
+        return submit
+
+    def submit(self, session, name, function, args):
+        self.start_heartbeat()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.connect() as connection:
+            connection.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE session = ? AND name = ? "
+                               "AND status IN ('queued', 'running')", (now, session, name))
+            self.fail_stale(connection, now)
+            connection.execute("DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND updated < ?",
+                               (now - job_lifetime_s,))
+            connection.execute("INSERT INTO jobs (id, session, name, status, progress, result, error, delivered, "
+                               "updated, owner) VALUES (?, ?, ?, 'queued', 0, NULL, NULL, 0, ?, ?)",
+                               (job_id, session, name, now, os.getpid()))
+        self.executor.submit(self.run, job_id, function, args)
+        return job_id
+
+    def start_heartbeat(self):
+        pid = os.getpid()
+        if self.heartbeat_pid == pid:
+            return
+        with self.heartbeat_lock:
+            if self.heartbeat_pid != pid:
+                threading.Thread(target=self.heartbeat, args=(pid,), name='figure-job-heartbeat', daemon=True).start()
+                self.heartbeat_pid = pid
+
+    def heartbeat(self, pid):
+        """
+        Keep the unfinished jobs of this process from being taken as lost, until the process exits.
+        """
+        while True:
+            time.sleep(heartbeat_s)
+            try:
+                with self.connect() as connection:
+                    connection.execute("UPDATE jobs SET updated = ? WHERE owner = ? AND status IN ('queued', 'running')",
+                                       (time.time(), pid))
+            except sqlite3.Error:
+                # A busy file is retried at the next beat, well before the jobs count as stale
+                pass
+
+    def fail_stale(self, connection, now, ids=None):
+        """
+        Mark as failed the unfinished jobs whose worker stopped touching them, all of them or only ids.
+        """
+        where = f" AND id IN ({','.join('?' * len(ids))})" if ids else ''
+        connection.execute(f"UPDATE jobs SET status = 'failed', error = 'worker stopped before finishing', "
+                           f"updated = ? WHERE status IN ('queued', 'running') AND updated < ?{where}",
+                           (now, now - stale_after_s, *(ids or [])))
+
+    def set_status(self, job_id, status, **columns):
+        assignments = ''.join(f', {column} = ?' for column in columns)
+        with self.connect() as connection:
+            # A cancelled job stays cancelled whatever its thread does afterwards
+            connection.execute(f"UPDATE jobs SET status = ?, updated = ?{assignments} "
+                               f"WHERE id = ? AND status != 'cancelled'",
+                               (status, time.time(), *columns.values(), job_id))
+
+    def update_progress(self, job_id, fraction):
+        """
+        Record progress; returns False when the job has been cancelled.
+        """
+        with self.connect() as connection:
+            cursor = connection.execute("UPDATE jobs SET progress = ?, updated = ? WHERE id = ? AND status = 'running'",
+                                        (fraction, time.time(), job_id))
+            return cursor.rowcount == 1
+
+    def run(self, job_id, function, args):
+        with self.connect() as connection:
+            started = connection.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ? "
+                                         "AND status = 'queued'", (time.time(), job_id)).rowcount
+        if not started:
+            # Superseded while it was waiting in the queue
+            return
+        _current.job = (self, job_id)
+        try:
+            result = function(*args)
+            self.set_status(job_id, 'done', progress=1.0, result=pio.to_json(result, validate=False))
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self.set_status(job_id, 'failed', error=f'{type(e).__name__}: {e}')
+        finally:
+            _current.job = None
+
+    def collect(self, job_ids):
+        """
+        Check on jobs from the page.
+
+        Returns:
+        - For each job id, the finished figure as a dictionary the first time it is collected, otherwise None.
+        - {job id: (status, progress, error)} for every job that is known; jobs of a worker that stopped are
+          reported as failed.
+        """
+        ids = [job_id for job_id in job_ids if job_id]
+        if not ids:
+            return [None] * len(job_ids), {}
+        with self.connect() as connection:
+            self.fail_stale(connection, time.time(), ids)
+            rows = connection.execute(f"SELECT id, status, progress, error, delivered, result FROM jobs "
+                                      f"WHERE id IN ({','.join('?' * len(ids))})", ids).fetchall()
+            finished = [row[0] for row in rows if row[1] == 'done' and not row[4]]
+            if finished:
+                connection.execute(f"UPDATE jobs SET delivered = 1, result = NULL "
+                                   f"WHERE id IN ({','.join('?' * len(finished))})", finished)
+        results = {row[0]: json.loads(row[5]) for row in rows if row[0] in finished}
+        states = {row[0]: (row[1], row[2], row[3]) for row in rows}
+        return [results.get(job_id) for job_id in job_ids], states
@@ -0,0 +1,549 @@
+#import require package
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import numpy as np
+
+"""
+====================================================================================================================
+Local load test for the dashboard server: replays scripted user sessions as the browser would, one
+_dash-update-component POST per callback, with the cascades a change sets off (map-toggle -> graph and region
+options -> map -> every line graph), at a chosen number of concurrent sessions
+
+The callback graph and the initial property values are read from the running app (/_dash-dependencies and
+/_dash-layout), so new callbacks are picked up without changing this file. Callbacks in the same step of a cascade
+are sent in parallel like a browser does; the clientside map callbacks are stood in for by small Python versions
+
+Run from the repository root, it starts gunicorn with gunicorn.conf.py on a free local port:
+    python load_test.py --workers 2 --sessions 8 --duration 60
+    python load_test.py --workers 4 --worker-class gthread --threads 4 --sessions 16 --output gthread.json
+    python load_test.py --url http://127.0.0.1:8050 --sessions 4       (an already running server)
+Reports throughput, latency percentiles per callback and per user action, error rates, and the CPU and RSS of the
+server processes (read from /proc, Linux only)
+====================================================================================================================
+"""
+
+# Parallel requests a browser makes to one host
+browser_connections = 6
+# Largest number of steps followed in one cascade, guards against callback cycles
+max_cascade_steps = 20
+
+
+def layout_props(node, props=None):
+    """
+    Collect {'id.property': value} for every component with an id in a /_dash-layout tree.
+    """
+    props = {} if props is None else props
+    if isinstance(node, list):
+        for child in node:
+            layout_props(child, props)
+    elif isinstance(node, dict) and 'props' in node:
+        component_props = node['props']
+        component_id = component_props.get('id')
+        if isinstance(component_id, str):
+            for name, value in component_props.items():
+                if name not in ('id', 'children'):
+                    props[f'{component_id}.{name}'] = value
+        layout_props(component_props.get('children'), props)
+    return props
+
+
+def output_props(output):
+    """
+    Split a dependency output string ('a.b' or '..a.b...c.d..') into its 'id.property' names.
+    """
+    if output.startswith('..'):
+        return output[2:-2].split('...')
+    return [output]
+
+
+class Callback:
+    """
+    One entry of /_dash-dependencies.
+    """
+
+    def __init__(self, dependency):
+        self.output = dependency['output']
+        self.outputs = output_props(self.output)
+        self.multi = self.output.startswith('..')
+        self.inputs = [f"{i['id']}.{i['property']}" for i in dependency['inputs']]
+        self.state = [f"{s['id']}.{s['property']}" for s in dependency['state']]
+        self.clientside = dependency.get('clientside_function')
+        self.prevent_initial_call = dependency.get('prevent_initial_call', False)
+
+    def body(self, props, changed):
+        def value_list(names):
+            return [{'id': name.split('.', 1)[0], 'property': name.split('.', 1)[1], 'value': props.get(name)}
+                    for name in names]
+        outputs = [{'id': name.split('.', 1)[0], 'property': name.split('.', 1)[1]} for name in self.outputs]
+        return {
+            'output': self.output,
+            'outputs': outputs if self.multi else outputs[0],
+            'inputs': value_list(self.inputs),
+            'state': value_list(self.state),
+            'changedPropIds': [name for name in self.inputs if name in changed],
+        }
+
+
+def request_geometry(session, callback, props):
+    # Python stand-in for map.request_geometry in assets/map_geometry.js
+    breakdown = props.get(callback.inputs[0])
+    if not breakdown or breakdown in session.geometry:
+        return {}
+    return {callback.outputs[0]: breakdown}
+
+
+def render_map(session, callback, props):
+    # Python stand-in for map.render: the browser keeps the geometry, the figure itself feeds no other callback
+    geometry = props.get('map-geometry.data')
+    if geometry:
+        session.geometry.add(geometry['breakdown'])
+    return {}
+
+
+clientside_functions = {('map', 'request_geometry'): request_geometry, ('map', 'render'): render_map}
+
+
+class Recorder:
+    """
+    Thread-safe store of every request and action measured during the run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.actions = []
+
+    def request(self, callback, seconds, status, size):
+        with self.lock:
+            self.requests.append((callback, seconds, status, size))
+
+    def action(self, name, seconds, errors):
+        with self.lock:
+            self.actions.append((name, seconds, errors))
+
+
+class Session:
+    """
+    One simulated browser tab: its own property values, keep-alive connections and map geometry cache.
+    """
+
+    def __init__(self, url, callbacks, initial_props, recorder, rng):
+        self.url = urlsplit(url)
+        self.callbacks = callbacks
+        self.props = dict(initial_props)
+        self.recorder = recorder
+        self.rng = rng
+        self.geometry = set()
+        self.connections = threading.local()
+        self.pool = ThreadPoolExecutor(max_workers=browser_connections)
+
+    def connection(self):
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=300)
+            self.connections.connection = connection
+        return connection
+
+    def post(self, callback, changed):
+        """
+        Send one callback request and return the property values it changed.
+        """
+        payload = json.dumps(callback.body(self.props, changed))
+        start = time.perf_counter()
+        try:
+            connection = self.connection()
+            connection.request('POST', f'{self.url.path.rstrip("/")}/_dash-update-component', payload,
+                               {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connections.connection = None
+            self.recorder.request(callback.output, time.perf_counter() - start, 'connection error', 0)
+            return None
+        self.recorder.request(callback.output, time.perf_counter() - start, status, len(data))
+        if status == 204:
+            # PreventUpdate
+            return {}
+        if status != 200:
+            return None
+        updates = {}
+        for component_id, values in json.loads(data).get('response', {}).items():
+            for name, value in values.items():
+                updates[f'{component_id}.{name}'] = value
+        return updates
+
+    def run_callback(self, callback, changed):
+        if callback.clientside:
+            function = clientside_functions.get((callback.clientside['namespace'], callback.clientside['function_name']))
+            return function(self, callback, self.props) if function else {}
+        return self.post(callback, changed)
+
+    def cascade(self, changed, initial=False):
+        """
+        Fire every callback triggered by the changed properties and then the ones their outputs trigger, a step at
+        a time. Returns the number of failed requests.
+        """
+        if initial:
+            pending = [c for c in self.callbacks if not c.prevent_initial_call]
+        else:
+            pending = [c for c in self.callbacks if any(name in changed for name in c.inputs)]
+        changed = set(changed)
+        done = set()
+        errors = 0
+        for _ in range(max_cascade_steps):
+            if not pending:
+                break
+            # Like the renderer, wait for callbacks whose inputs another pending callback is about to change
+            waiting_on = {name for c in pending for name in c.outputs}
+            ready = [c for c in pending if not any(name in waiting_on for name in c.inputs)] or pending
+            results = list(self.pool.map(lambda c: self.run_callback(c, changed), ready))
+            step_changed = set()
+            for callback, updates in zip(ready, results):
+                done.add(callback.output)
+                if updates is None:
+                    errors += 1
+                    continue
+                self.props.update(updates)
+                step_changed.update(updates)
+            changed |= step_changed
+            pending = [c for c in pending if c not in ready]
+            pending += [c for c in self.callbacks if c.output not in done and c not in pending
+                        and any(name in step_changed for name in c.inputs)]
+        return errors
+
+    def act(self, name, updates):
+        """
+        Apply a user change and run its cascade, recording how long the whole action took.
+        """
+        start = time.perf_counter()
+        if updates is None:
+            errors = self.cascade(set(), initial=True)
+        else:
+            self.props.update(updates)
+            errors = self.cascade(set(updates))
+        self.recorder.action(name, time.perf_counter() - start, errors)
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def option_values(props, component_id, fallback):
+    options = props.get(f'{component_id}.options') or []
+    values = [option['value'] if isinstance(option, dict) else option for option in options]
+    return values or fallback
+
+
+def session_script(session):
+    """
+    Yield (action name, property updates) for one planner's visit: load the page, then explore.
+    """
+    rng = session.rng
+    props = session.props
+    yield 'page load', None
+    for _ in range(rng.randint(4, 10)):
+        kind = rng.choice(['map-toggle', 'scenario', 'date range', 'max/projection', 'map click', 'region',
+                           'compare', 'weather'])
+        if kind == 'map-toggle':
+            yield kind, {'map-toggle.value': rng.choice(['country', 'state', 'subregion'])}
+        elif kind == 'scenario':
+            yield kind, {'scenario-toggle.value': rng.choice(option_values(props, 'scenario-toggle', ['rcp85hotter']))}
+        elif kind == 'date range':
+            start_year = rng.randint(2020, 2090)
+            yield kind, {'start-year-dropdown.value': start_year,
+                         'end-year-dropdown.value': rng.randint(start_year, 2099)}
+        elif kind == 'max/projection':
+            yield kind, {rng.choice(['max-toggle.value', 'projection-toggle.value']): rng.choice([True, False])}
+        elif kind == 'map click':
+            regions = option_values(props, 'graph-toggle', ['USA'])
+            yield kind, {'usa-map.clickData': {'points': [{'location': str(rng.randrange(len(regions)))}]}}
+        elif kind == 'region':
+            yield kind, {'graph-toggle.value': rng.choice(option_values(props, 'graph-toggle', ['USA']))}
+        elif kind == 'compare':
+            yield kind, {'year-dropdown-left.value': rng.randint(2020, 2099),
+                         'daytype-dropdown-left.value': rng.choice(['Weekday', 'Weekend'])}
+        else:
+            # A new extreme-day threshold, when the server can detect them
+            modes = [option['value'] for option in props.get('extreme-threshold-mode.options') or []
+                     if isinstance(option, dict) and not option.get('disabled')]
+            mode = props.get('extreme-threshold-mode.value')
+            if mode in modes[1:] and rng.random() < 0.3:
+                # Typing a threshold on the scale the page shows: a percentile, or a temperature for heat or cold
+                if mode == 'percentile':
+                    value = rng.randint(80, 99)
+                elif props.get('heat/cold-toggle.value') == 'Cold':
+                    value = rng.randint(-20, -5)
+                else:
+                    value = rng.randint(30, 40)
+                yield kind, {'extreme-threshold-value.value': value}
+                continue
+            updates = {'weather-to-show.value': rng.choice(option_values(props, 'weather-to-show', ['Num_of_days'])),
+                       'heat/cold-toggle.value': rng.choice(['Heat', 'Cold'])}
+            if len(modes) > 1 and rng.random() < 0.5:
+                # Switching the mode, the page then sets the threshold to that mode's default
+                updates['extreme-threshold-mode.value'] = rng.choice(modes[1:])
+            yield kind, updates
+
+
+def run_sessions(url, n_sessions, duration_s, think_s, seed, recorder):
+    """
+    Keep n_sessions simulated planners busy for duration_s seconds, each starting a new visit when one ends.
+    """
+    url_parts = urlsplit(url)
+    connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port or 80, timeout=60)
+    base = url_parts.path.rstrip('/')
+
+    def get_json(path):
+        connection.request('GET', f'{base}{path}')
+        response = connection.getresponse()
+        return json.loads(response.read())
+
+    callbacks = [Callback(dependency) for dependency in get_json('/_dash-dependencies')]
+    initial_props = layout_props(get_json('/_dash-layout'))
+    known = {name for callback in callbacks for name in callback.inputs}
+    deadline = time.perf_counter() + duration_s
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        while time.perf_counter() < deadline:
+            session = Session(url, callbacks, initial_props, recorder, rng)
+            for name, updates in session_script(session):
+                if time.perf_counter() >= deadline:
+                    break
+                # Skip actions on components this version of the app does not have
+                if updates is None or all(key in known for key in updates):
+                    session.act(name, updates)
+                    time.sleep(think_s * rng.uniform(0.5, 1.5))
+            session.close()
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(n_sessions)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+class ProcessSampler:
+    """
+    Samples CPU time, RSS and PSS of a process and its children from /proc while the test runs.
+    """
+
+    def __init__(self, root_pid, interval_s=0.5):
+        self.root_pid = root_pid
+        self.interval_s = interval_s
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.samples = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def pids(self):
+        pids = [self.root_pid]
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as f:
+                        if int(f.read().rsplit(')', 1)[1].split()[1]) == self.root_pid:
+                            pids.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    continue
+        return pids
+
+    def read(self, pid):
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_s = (int(fields[11]) + int(fields[12])) / self.ticks
+        memory = {}
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    memory['rss'] = int(line.split()[1]) * 1024
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        memory['pss'] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return cpu_s, memory.get('rss', 0), memory.get('pss', 0)
+
+    def loop(self):
+        while not self.stop_event.is_set():
+            now = time.perf_counter()
+            for pid in self.pids():
+                try:
+                    self.samples.setdefault(pid, []).append((now, *self.read(pid)))
+                except OSError:
+                    continue
+            self.stop_event.wait(self.interval_s)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def summary(self):
+        rows = []
+        for pid, samples in sorted(self.samples.items()):
+            if len(samples) < 2:
+                continue
+            elapsed = samples[-1][0] - samples[0][0]
+            rows.append({
+                'pid': pid,
+                'role': 'master' if pid == self.root_pid else 'worker',
+                'cpu_percent': 100 * (samples[-1][1] - samples[0][1]) / elapsed if elapsed else 0.0,
+                'peak_rss_bytes': max(s[2] for s in samples),
+                'peak_pss_bytes': max(s[3] for s in samples),
+            })
+        return rows
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(workers, worker_class, threads, timeout_s=180):
+    """
+    Start gunicorn with the repository settings on a free local port and wait until it answers.
+
+    Returns:
+    - The gunicorn process and the base URL.
+    """
+    port = free_port()
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--worker-class', worker_class, '--threads', str(threads)]
+    process = subprocess.Popen(command, cwd=os.getcwd(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               text=True)
+    deadline = time.time() + timeout_s
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with status {process.returncode}:\n{process.stderr.read()[-2000:]}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/_dash-layout')
+            if connection.getresponse().status == 200:
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError('gunicorn did not answer in time')
+
+
+def percentiles(values):
+    values = np.asarray(values)
+    return {f'p{q}_s': float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def summarize(recorder, wall_s):
+    """
+    Throughput, latency percentiles and error rates per callback and per user action.
+    """
+    by_callback = {}
+    for callback, seconds, status, size in recorder.requests:
+        by_callback.setdefault(callback, []).append((seconds, status, size))
+    callbacks = {}
+    for callback, rows in sorted(by_callback.items()):
+        errors = sum(status not in (200, 204) for _, status, _ in rows)
+        callbacks[callback] = {'requests': len(rows), 'error_rate': errors / len(rows),
+                               'mean_bytes': float(np.mean([size for _, _, size in rows])),
+                               **percentiles([seconds for seconds, _, _ in rows])}
+    by_action = {}
+    for name, seconds, errors in recorder.actions:
+        by_action.setdefault(name, []).append((seconds, errors))
+    actions = {name: {'count': len(rows), 'failed': sum(errors > 0 for _, errors in rows),
+                      **percentiles([seconds for seconds, _ in rows])}
+               for name, rows in sorted(by_action.items())}
+    total_errors = sum(status not in (200, 204) for _, _, status, _ in recorder.requests)
+    return {
+        'wall_s': wall_s,
+        'requests': len(recorder.requests),
+        'requests_per_s': len(recorder.requests) / wall_s,
+        'actions_per_s': len(recorder.actions) / wall_s,
+        'error_rate': total_errors / len(recorder.requests) if recorder.requests else 0.0,
+        'callbacks': callbacks,
+        'actions': actions,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the dashboard with replayed user sessions.')
+    parser.add_argument('--url', help='test a server that is already running instead of starting gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='sync', help='gunicorn worker class (sync, gthread, ...)')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--sessions', type=int, default=4, help='concurrent simulated planners')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between the actions of a planner')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_output.json', help='where to write the results')
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if url is None:
+        process, url = start_server(args.workers, args.worker_class, args.threads)
+    sampler = ProcessSampler(process.pid) if process is not None else None
+    try:
+        if sampler:
+            sampler.start()
+        recorder = Recorder()
+        wall_s = run_sessions(url, args.sessions, args.duration, args.think_ms / 1000, args.seed, recorder)
+    finally:
+        if sampler:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    report = summarize(recorder, wall_s)
+    report['meta'] = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'url': args.url or 'local gunicorn',
+        'workers': args.workers,
+        'worker_class': args.worker_class,
+        'threads': args.threads,
+        'sessions': args.sessions,
+        'think_ms': args.think_ms,
+    }
+    report['processes'] = sampler.summary() if sampler else []
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f"{report['requests']} requests in {wall_s:.1f}s: {report['requests_per_s']:.1f} req/s, "
+          f"{report['actions_per_s']:.2f} actions/s, error rate {report['error_rate']:.2%}")
+    print(f"\n{'callback':<60}{'n':>6}{'err':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'KB':>8}")
+    for callback, row in report['callbacks'].items():
+        print(f"{callback[:59]:<60}{row['requests']:>6}{row['error_rate']:>7.1%}{row['p50_s'] * 1000:>9.1f}"
+              f"{row['p95_s'] * 1000:>9.1f}{row['p99_s'] * 1000:>9.1f}{row['mean_bytes'] / 1024:>8.1f}")
+    print(f"\n{'user action':<60}{'n':>6}{'failed':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, row in report['actions'].items():
+        print(f"{name:<60}{row['count']:>6}{row['failed']:>7}{row['p50_s'] * 1000:>9.1f}"
+              f"{row['p95_s'] * 1000:>9.1f}{row['p99_s'] * 1000:>9.1f}")
+    if report['processes']:
+        print(f"\n{'process':<20}{'cpu %':>8}{'peak RSS MB':>14}{'peak PSS MB':>14}")
+        for row in report['processes']:
+            print(f"{row['role'] + ' ' + str(row['pid']):<20}{row['cpu_percent']:>8.1f}"
+                  f"{row['peak_rss_bytes'] / 1024 ** 2:>14.1f}{row['peak_pss_bytes'] / 1024 ** 2:>14.1f}")
+    print(f'\nWrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
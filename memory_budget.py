@@ -0,0 +1,214 @@
+#import require package
+import argparse
+import mmap
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+"""
+====================================================================================================================
+Compact in-memory representation of the loaded data and a per-dataset memory report
+
+Compact mode (DATA_COMPACT=1) stores float columns as float32 when the round trip loses less than
+float32_tolerance relative precision, integer columns (Year, Month, Hour...) in the smallest integer type that holds
+them, and repeated strings (region names) as categoricals
+
+The report counts, for each dataset the dashboard keeps, the private heap bytes of the process and the bytes of
+memory-mapped files, which are shared by every worker through the page cache. A dataset is measured once and again
+only when its version changes (it was rebuilt or grew), so /metrics scrapes do not walk the data every time.
+MEMORY_BUDGET_MB sets the private budget. Run from the repository root to check a worker against it:
+    python memory_budget.py --budget-mb 300 [--compact]
+====================================================================================================================
+"""
+
+# Largest relative error accepted when storing a float64 column as float32
+float32_tolerance = 1e-6
+# Object columns with at most this share of distinct values become categoricals
+category_max_ratio = 0.5
+
+
+def fits_float32(values, tolerance=float32_tolerance):
+    """
+    Check that float64 values survive a float32 round trip within the relative tolerance.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0:
+        return True
+    if np.abs(finite).max() > np.finfo(np.float32).max:
+        return False
+    rounded = finite.astype(np.float32).astype(np.float64)
+    scale = np.maximum(np.abs(finite), np.finfo(np.float32).tiny)
+    return bool((np.abs(rounded - finite) / scale).max() <= tolerance)
+
+
+def compact_array(values):
+    """
+    Return the array in float32 or the smallest integer type when nothing is lost, unchanged otherwise.
+    """
+    values = np.asarray(values)
+    if values.dtype == np.float64 and fits_float32(values):
+        return values.astype(np.float32)
+    if values.dtype.kind in 'iu' and len(values):
+        return pd.to_numeric(pd.Series(values), downcast='integer' if values.dtype.kind == 'i' else 'unsigned').to_numpy()
+    return values
+
+
+def compact_frame(df):
+    """
+    Return a copy of a DataFrame with compact column types, see compact_array; repeated strings become categoricals.
+    """
+    columns = {}
+    for name, column in df.items():
+        if column.dtype == object:
+            if column.nunique(dropna=False) <= category_max_ratio * len(column):
+                columns[name] = column.astype('category')
+            else:
+                columns[name] = column
+        elif column.dtype.kind in 'fiu':
+            columns[name] = pd.Series(compact_array(column.to_numpy()), index=column.index, name=name)
+        else:
+            columns[name] = column
+    return pd.DataFrame(columns, index=df.index)
+
+
+def nbytes(value, seen=None):
+    """
+    Bytes held by a dataset, following dictionaries, lists, tuples and object attributes.
+
+    Returns:
+    - The (private, mapped) byte counts; arrays backed by a memory-mapped file count as mapped. Objects with a
+      memory_bytes() method report their own (private, mapped) counts.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0, 0
+    seen.add(id(value))
+    if hasattr(value, 'memory_bytes') and not isinstance(value, type):
+        return value.memory_bytes()
+    if isinstance(value, np.ndarray):
+        base = value
+        while isinstance(base, np.ndarray) and not isinstance(base, np.memmap) and base.base is not None:
+            base = base.base
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return 0, value.nbytes
+        return value.nbytes, 0
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum()), 0
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True)), 0
+
+    private, mapped = sys.getsizeof(value), 0
+    if isinstance(value, dict):
+        items = [item for pair in value.items() for item in pair]
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = value
+    elif hasattr(value, '__dict__') and not isinstance(value, type):
+        items = vars(value).values()
+    else:
+        items = ()
+    for item in items:
+        item_private, item_mapped = nbytes(item, seen)
+        private += item_private
+        mapped += item_mapped
+    return private, mapped
+
+
+class MemoryReport:
+    """
+    Registry of the datasets a process keeps, each measured when the report is made.
+    """
+
+    def __init__(self, budget_bytes=None):
+        self.budget_bytes = budget_bytes
+        self.datasets = {}
+        # {dataset: (version, (private, mapped))} of the last measurement
+        self.measured = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, get, version=None):
+        """
+        Add a dataset; get() returns the objects holding it and version() a cheap value that changes whenever the
+        dataset is rebuilt or grows. Without version the dataset is measured once.
+        """
+        self.datasets[name] = (get, version)
+
+    def report(self):
+        """
+        Return one {'dataset', 'private_bytes', 'mapped_bytes'} row per dataset, largest private first; only the
+        datasets whose version changed since the last report are measured again.
+        """
+        rows = []
+        with self.lock:
+            for name, (get, version) in self.datasets.items():
+                current = version() if version is not None else None
+                measured = self.measured.get(name)
+                if measured is None or measured[0] != current:
+                    measured = (current, nbytes(get()))
+                    self.measured[name] = measured
+                private, mapped = measured[1]
+                rows.append({'dataset': name, 'private_bytes': private, 'mapped_bytes': mapped})
+        return sorted(rows, key=lambda row: -row['private_bytes'])
+
+    def over_budget(self, rows=None):
+        rows = self.report() if rows is None else rows
+        total = sum(row['private_bytes'] for row in rows)
+        return self.budget_bytes is not None and total > self.budget_bytes
+
+    def metrics(self):
+        """
+        Return a renderer for callback_metrics exposing the report as gauges.
+        """
+        def render():
+            # Measured in the worker answering the scrape, the worker label keeps the workers' series apart
+            worker = os.getpid()
+            lines = ['# HELP dashboard_dataset_bytes Memory held by each loaded dataset.',
+                     '# TYPE dashboard_dataset_bytes gauge']
+            for row in self.report():
+                for kind in ('private', 'mapped'):
+                    lines.append(f'dashboard_dataset_bytes{{dataset="{row["dataset"]}",kind="{kind}",'
+                                 f'worker="{worker}"}} {row[kind + "_bytes"]}')
+            if self.budget_bytes is not None:
+                lines.append('# TYPE dashboard_memory_budget_bytes gauge')
+                lines.append(f'dashboard_memory_budget_bytes {self.budget_bytes}')
+            return lines
+        return render
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the memory held by the datasets of a dashboard worker.')
+    parser.add_argument('--budget-mb', type=float, default=None, help='fail when private memory is above this')
+    parser.add_argument('--compact', action='store_true', help='load the data in compact mode')
+    args = parser.parse_args()
+    if args.compact:
+        os.environ['DATA_COMPACT'] = '1'
+    if args.budget_mb is not None:
+        os.environ['MEMORY_BUDGET_MB'] = str(args.budget_mb)
+    sys.path.insert(0, os.getcwd())
+
+    import dashboard_future
+    # Load what a worker holds after a while: every lazily read table and the pre-warmed figures
+    dashboard_future.warm_shared_data()
+    memory_report = dashboard_future.memory_report
+    rows = memory_report.report()
+
+    print(f"{'dataset':<32}{'private MB':>12}{'mapped MB':>12}")
+    for row in rows:
+        print(f"{row['dataset']:<32}{row['private_bytes'] / 1024 ** 2:>12.2f}{row['mapped_bytes'] / 1024 ** 2:>12.2f}")
+    private = sum(row['private_bytes'] for row in rows)
+    mapped = sum(row['mapped_bytes'] for row in rows)
+    print(f"{'total':<32}{private / 1024 ** 2:>12.2f}{mapped / 1024 ** 2:>12.2f}")
+
+    if memory_report.budget_bytes is not None:
+        budget_mb = memory_report.budget_bytes / 1024 ** 2
+        if memory_report.over_budget(rows):
+            print(f'\nOVER BUDGET: {private / 1024 ** 2:.2f} MB > {budget_mb:.2f} MB')
+            sys.exit(1)
+        print(f'\nWithin budget: {private / 1024 ** 2:.2f} MB <= {budget_mb:.2f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#import require package
+import argparse
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from scenario_cube import scenarios
+
+"""
+====================================================================================================================
+Consolidated store for the per-region files in resources/outlier, resources/outlier_demand and resources/CI_results:
+every file becomes one partition of a single SQLite file. The partitions table is indexed on
+(region, kind, extreme, scenario, projection) and records the contiguous rowid range its rows were written to,
+so any slice comes back with a single query and no per-row key is stored
+
+kind is hdd / cdd (degree days), outlier_days (dates of extreme weather), outlier_demand (daily load on those dates)
+or ci (confidence interval bound); extreme is max / min (heat / cold) where the file has one
+
+Run from the repository root:  python outlier_store.py [--summaries]
+====================================================================================================================
+"""
+
+store_file = 'outlier_store.sqlite'
+source_folders = ('outlier', 'outlier_demand', 'CI_results')
+file_pattern = re.compile(
+    r'^(?P<region>.+?)_(?P<kind>cdd|hdd|extreme_outliers|extreme_demand_outliers|CI)'
+    r'_(?:(?P<extreme>max|min)_?)?(?P<scenario>' + '|'.join(scenarios) + r')?(?P<project>_project_)?\.csv$'
+)
+kind_names = {'extreme_outliers': 'outlier_days', 'extreme_demand_outliers': 'outlier_demand', 'CI': 'ci'}
+partition_columns = ['folder', 'region', 'kind', 'extreme', 'scenario', 'projection']
+row_columns = ['rb', 'Year', 'Date', 'value']
+
+
+def parse_file_name(name):
+    """
+    Split a per-region file name such as 'New York_extreme_outliers_max_rcp45cooler_project_.csv' into its keys.
+
+    Returns:
+    - A dictionary of region, kind, extreme, scenario and projection, or None for files that are not part of the store.
+    """
+    match = file_pattern.match(name)
+    if match is None:
+        return None
+    return {
+        'region': match['region'],
+        'kind': kind_names.get(match['kind'], match['kind']),
+        'extreme': match['extreme'],
+        'scenario': match['scenario'],
+        'projection': int(match['project'] is not None),
+    }
+
+
+def read_source_file(file_path):
+    """
+    Read one per-region file into the row layout of the store.
+
+    Returns:
+    - A DataFrame with the rb, Year, Date and value columns, or None for an empty file.
+    """
+    try:
+        df = pd.read_csv(file_path)
+    except pd.errors.EmptyDataError:
+        return None
+    rows = pd.DataFrame(index=df.index)
+    rows['rb'] = df['rb'] if 'rb' in df.columns else None
+    rows['Year'] = df['Year'] if 'Year' in df.columns else None
+    rows['Date'] = df['Date'] if 'Date' in df.columns else None
+    value_columns = [c for c in df.columns if c in ('hdd', 'cdd', 'Load_sum') or c.startswith('CI_')]
+    rows['value'] = df[value_columns[0]].astype(float) if value_columns else None
+    return rows
+
+
+def build_outlier_store(resources_path, store_path, workers=None):
+    """
+    Pack every per-region file into the SQLite store, replacing any previous build.
+
+    Parameters:
+    - resources_path: the resources folder holding outlier, outlier_demand and CI_results.
+    - store_path: the SQLite file to write.
+    - workers: size of the process pool reading the files, defaults to the number of CPUs.
+
+    Returns:
+    - The number of non-empty files packed.
+    """
+    partitions = []
+    for folder in source_folders:
+        folder_path = os.path.join(resources_path, folder)
+        for name in os.listdir(folder_path):
+            keys = parse_file_name(name)
+            if keys is not None:
+                partitions.append(dict(folder=folder, file_path=os.path.join(folder_path, name), **keys))
+    # Partitions of one region sit next to each other, in key order
+    partitions.sort(key=lambda p: tuple('' if p[c] is None else str(p[c]) for c in partition_columns))
+
+    tmp_path = store_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with ProcessPoolExecutor(max_workers=workers) as pool, sqlite3.connect(tmp_path) as connection:
+        connection.execute('CREATE TABLE partitions (id INTEGER PRIMARY KEY, folder TEXT, region TEXT, kind TEXT, '
+                           'extreme TEXT, scenario TEXT, projection INTEGER, row_start INTEGER, row_end INTEGER)')
+        connection.execute('CREATE TABLE rows (id INTEGER PRIMARY KEY, rb TEXT, Year INTEGER, Date TEXT, value REAL)')
+        next_row = 1
+        packed = 0
+        paths = [p['file_path'] for p in partitions]
+        for partition_id, (partition, rows) in enumerate(zip(partitions, pool.map(read_source_file, paths, chunksize=64))):
+            if rows is None or rows.empty:
+                continue
+            rows.insert(0, 'id', range(next_row, next_row + len(rows)))
+            rows.to_sql('rows', connection, if_exists='append', index=False)
+            connection.execute('INSERT INTO partitions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [partition_id] + [partition[c] for c in partition_columns]
+                               + [next_row, next_row + len(rows) - 1])
+            next_row += len(rows)
+            packed += 1
+        connection.execute('CREATE INDEX partitions_slice ON partitions (region, kind, extreme, scenario, projection)')
+        connection.execute('CREATE INDEX partitions_kind ON partitions (kind, extreme, scenario, projection)')
+    os.replace(tmp_path, store_path)
+    return packed
+
+
+def slice_query(columns, where):
+    """
+    SQL reading the rows of every partition that matches the where clause, through their rowid ranges.
+    """
+    return (f'SELECT {columns} FROM partitions AS p JOIN rows AS r ON r.id BETWEEN p.row_start AND p.row_end'
+            + (' WHERE ' + where if where else ''))
+
+
+def load_slice(store_path, region=None, kind=None, extreme=None, scenario=None, projection=None, folder=None):
+    """
+    Return every stored row matching the given keys in one read; keys left as None are not filtered on.
+    """
+    filters = {'region': region, 'kind': kind, 'extreme': extreme, 'scenario': scenario, 'folder': folder,
+               'projection': None if projection is None else int(bool(projection))}
+    where = ' AND '.join(f'p.{column} = ?' for column, value in filters.items() if value is not None)
+    columns = ', '.join([f'p.{c}' for c in partition_columns] + [f'r.{c}' for c in row_columns])
+    with sqlite3.connect(f'file:{store_path}?mode=ro', uri=True) as connection:
+        return pd.read_sql_query(slice_query(columns, where), connection,
+                                 params=[v for v in filters.values() if v is not None])
+
+
+def summary_queries():
+    """
+    Yield (file name, SQL) for every all_*.csv summary the extreme-weather graph reads.
+    """
+    for scenario_value in scenarios:
+        for kind in ('hdd', 'cdd'):
+            yield (f'all_{kind}_{scenario_value}.csv',
+                   slice_query(f'p.region AS region, r.Year AS Year, r.value AS {kind}',
+                               f"p.kind = '{kind}' AND p.scenario = '{scenario_value}'"))
+        for extreme in ('max', 'min'):
+            for projection_bool in (False, True):
+                suffix = '_project_' if projection_bool else ''
+                keys = f"p.extreme = '{extreme}' AND p.scenario = '{scenario_value}' AND p.projection = {int(projection_bool)}"
+                yield (f'all_{extreme}_outliers_summary_{scenario_value}{suffix}.csv',
+                       slice_query('p.region AS region, r.Year AS Year, COUNT(*) AS number_of_days',
+                                   f"p.kind = 'outlier_days' AND {keys}") + ' GROUP BY p.region, r.Year')
+                yield (f'all_{extreme}_outliers_demand_summary_{scenario_value}{suffix}.csv',
+                       slice_query('p.region AS region, r.Year AS Year, AVG(r.value) AS average_total_load',
+                                   f"p.kind = 'outlier_demand' AND p.folder = 'outlier_demand' AND {keys}")
+                       + ' GROUP BY p.region, r.Year HAVING COUNT(r.value) > 0')
+
+
+def build_summaries(store_path, data_path):
+    """
+    Write the all_*.csv summaries in web_page_data from the store.
+
+    Returns:
+    - The names of the files written.
+    """
+    written = []
+    with sqlite3.connect(f'file:{store_path}?mode=ro', uri=True) as connection:
+        for name, query in summary_queries():
+            df = pd.read_sql_query(query, connection)
+            if df.empty:
+                continue
+            df.to_csv(os.path.join(data_path, name), index=False)
+            written.append(name)
+    return written
+
+
+if __name__ == '__main__':
+    current_directory = os.getcwd()
+    resources_path = os.path.join(current_directory, 'resources')
+    parser = argparse.ArgumentParser(description='Pack the per-region outlier and CI files into one indexed store.')
+    parser.add_argument('--store', default=os.path.join(resources_path, store_file))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--summaries', action='store_true', help='also regenerate the all_*.csv files in web_page_data')
+    args = parser.parse_args()
+
+    count = build_outlier_store(resources_path, args.store, args.workers)
+    print(f'Packed {count} files into {args.store}')
+    if args.summaries:
+        written = build_summaries(args.store, os.path.join(current_directory, 'web_page_data'))
+        print(f'Wrote {len(written)} summaries')
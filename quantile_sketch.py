@@ -0,0 +1,193 @@
+#import require package
+import os
+import threading
+
+import numpy as np
+
+from scenario_cube import file_signature
+
+"""
+====================================================================================================================
+Mergeable quantile sketches of the hourly demand, one per region, hour of day, day type and year
+
+Each sketch is a histogram over logarithmic bins (the DDSketch layout): a value v > 0 falls in bin
+ceil(log(v) / log(gamma)) with gamma = (1 + a) / (1 - a), and every quantile read back from the bins is within a
+relative error a of the exact one. Two sketches merge by adding their bin counts, so the band of any set of years
+or hours is computed at request time from the stored counts without going back to the hourly data.
+
+Sketches of one scenario file are stored as a sparse table (year, daytype, hour, region, bin, count) sorted by
+region, in {prefix}mock_{scenario}_sketch.npz next to the other aggregates
+====================================================================================================================
+"""
+
+default_accuracy = 0.01
+# Bin of zero and negative demand, read back as 0
+zero_bin = np.iinfo(np.int16).min
+daytypes = ['Weekday', 'Weekend']
+
+
+def gamma_of(relative_accuracy):
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def value_bins(values, gamma):
+    """
+    Logarithmic bin of every value, zero_bin for values <= 0. NaN values must be dropped beforehand.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    bins = np.full(values.shape, zero_bin, dtype=np.int16)
+    positive = values > 0
+    raw = np.ceil(np.log(values[positive]) / np.log(gamma))
+    bins[positive] = np.clip(raw, zero_bin + 1, np.iinfo(np.int16).max)
+    return bins
+
+
+def bin_values(bins, gamma):
+    """
+    Value each bin stands for: the point of the bin with the same relative distance to both edges.
+    """
+    bins = np.asarray(bins)
+    values = 2 * np.power(gamma, bins.astype(np.float64)) / (gamma + 1)
+    return np.where(bins == zero_bin, 0.0, values)
+
+
+def sketch_hourly(time, values, relative_accuracy=default_accuracy):
+    """
+    Build the sketches of an hourly file.
+
+    Parameters:
+    - time: DatetimeIndex of the rows.
+    - values: DataFrame with one column of hourly demand per region.
+    - relative_accuracy: relative error bound of the quantiles.
+
+    Returns:
+    - A dictionary of arrays ready for np.savez.
+    """
+    regions = list(values.columns)
+    n_regions = len(regions)
+    gamma = gamma_of(relative_accuracy)
+    years = np.asarray(time.year)
+    cells = np.asarray(time.weekday >= 5, dtype=np.int64) * 24 + np.asarray(time.hour)
+    array = values.to_numpy(dtype=np.float64)
+
+    parts = []
+    # A year at a time, so the key array stays a year of hours by the number of regions
+    for year in np.unique(years):
+        rows = years == year
+        block = array[rows]
+        valid = ~np.isnan(block)
+        bins = value_bins(np.where(valid, block, 0), gamma).astype(np.int64) - zero_bin
+        key = (cells[rows][:, None] * n_regions + np.arange(n_regions)[None, :]) * 65536 + bins
+        unique, counts = np.unique(key[valid], return_counts=True)
+        cell, region = np.divmod(unique // 65536, n_regions)
+        parts.append((np.full(len(unique), year), cell // 24, cell % 24, region, unique % 65536 + zero_bin, counts))
+
+    year, daytype, hour, region, bin_index, count = (np.concatenate(column) for column in zip(*parts))
+    order = np.lexsort((hour, year, daytype, region))
+    return {
+        'year': year[order].astype(np.int16),
+        'daytype': daytype[order].astype(np.int8),
+        'hour': hour[order].astype(np.int8),
+        'region': region[order].astype(np.int16),
+        'bin': bin_index[order].astype(np.int16),
+        'count': count[order].astype(np.uint32),
+        'regions': np.array(regions),
+        'gamma': np.float64(gamma),
+    }
+
+
+def write_sketches(file_path, sketches):
+    # np.savez adds .npz to names without it, keep the temporary name ending in .npz
+    np.savez_compressed(file_path + '.tmp.npz', **sketches)
+    os.replace(file_path + '.tmp.npz', file_path)
+
+
+class QuantileSketch:
+    """
+    The sketches of one scenario file, merged on request.
+    """
+
+    def __init__(self, arrays):
+        self.year = arrays['year']
+        self.daytype = arrays['daytype']
+        self.hour = arrays['hour']
+        self.region = arrays['region']
+        self.bin = arrays['bin']
+        self.count = arrays['count']
+        self.gamma = float(arrays['gamma'])
+        self.region_index = {r: i for i, r in enumerate(arrays['regions'].tolist())}
+
+    def quantiles(self, region, years, daytype, quantiles, hours=None):
+        """
+        Merge the sketches of some years (and hours) of one region and day type and read quantiles from them.
+
+        Parameters:
+        - region: region column name.
+        - years: the years to merge, any set.
+        - daytype: 'Weekday' or 'Weekend'.
+        - quantiles: the quantiles to read, between 0 and 1.
+        - hours: hours of day to keep, all of them when None.
+
+        Returns:
+        - The hours that have data and a (quantile, hour) array, both empty when nothing matches.
+        """
+        position = self.region_index.get(region)
+        if position is None:
+            return np.empty(0, dtype=int), np.empty((len(quantiles), 0))
+        first, last = np.searchsorted(self.region, [position, position + 1])
+        selected = np.isin(self.year[first:last], list(years))
+        selected &= self.daytype[first:last] == daytypes.index(daytype)
+        if hours is not None:
+            selected &= np.isin(self.hour[first:last], list(hours))
+        hour = self.hour[first:last][selected].astype(np.intp)
+        if len(hour) == 0:
+            return np.empty(0, dtype=int), np.empty((len(quantiles), 0))
+
+        # Merging is adding counts: one histogram row per hour over the bins that occur
+        bins, columns = np.unique(self.bin[first:last][selected], return_inverse=True)
+        histogram = np.zeros((24, len(bins)))
+        np.add.at(histogram, (hour, columns), self.count[first:last][selected])
+        present = np.flatnonzero(histogram.sum(axis=1))
+        cumulative = histogram[present].cumsum(axis=1)
+        total = cumulative[:, -1:]
+        values = bin_values(bins, self.gamma)
+        result = np.empty((len(quantiles), len(present)))
+        for i, q in enumerate(quantiles):
+            # First bin whose cumulative count passes the rank q * (n - 1)
+            first_bin = (cumulative <= q * (total - 1)).sum(axis=1)
+            result[i] = values[np.minimum(first_bin, len(bins) - 1)]
+        return present, result
+
+
+class QuantileSketches:
+    """
+    Sketch files of a data folder, each loaded on first use and kept until the file changes on disk.
+    """
+
+    def __init__(self, data_path):
+        self.data_path = data_path
+        # {file name: (file signature, QuantileSketch)}
+        self.sketches = {}
+        self.lock = threading.Lock()
+
+    def get(self, file_name):
+        """
+        Return the QuantileSketch stored in file_name, or None when the file does not exist. A file rewritten by
+        build_aggregates.py (another size or mtime) is loaded again.
+        """
+        file_path = os.path.join(self.data_path, file_name)
+        try:
+            signature = file_signature(file_path)
+        except FileNotFoundError:
+            with self.lock:
+                self.sketches.pop(file_name, None)
+            return None
+        entry = self.sketches.get(file_name)
+        if entry is None or entry[0] != signature:
+            with self.lock:
+                entry = self.sketches.get(file_name)
+                if entry is None or entry[0] != signature:
+                    with np.load(file_path) as arrays:
+                        entry = (signature, QuantileSketch({name: arrays[name] for name in arrays.files}))
+                    self.sketches[file_name] = entry
+        return entry[1]
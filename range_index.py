@@ -0,0 +1,179 @@
+#import require package
+import json
+import os
+
+import numpy as np
+
+from callback_metrics import timed_phase
+from scenario_cube import cube_file, file_signature
+
+"""
+====================================================================================================================
+Range-query index over the scenario cube: cumulative monthly sums answer any [start, end] total with one
+subtraction; the monthly max over a range comes from running maxima inside fixed blocks of months plus a sparse table
+over whole blocks, so the index stays about the size of the max slices of the cube
+====================================================================================================================
+"""
+
+prefix_file = 'scenario_prefix_sum.npy'
+block_file = 'scenario_block_max.npy'
+sparse_file = 'scenario_sparse_max.npy'
+index_meta_file = 'scenario_range_index.json'
+# Months per block; a range inside one block is scanned in the cube, so this bounds that scan
+block_months = 32
+
+
+def build_range_index(data_path, cube):
+    """
+    Precompute the prefix sums of the sum slices and the sparse table of the max slices of the cube.
+
+    Parameters:
+    - data_path: the web_page_data folder holding the cube; the index is written next to it.
+    - cube: the ScenarioCube to index.
+    """
+    values = cube.values
+    n_months = values.shape[3]
+
+    # prefix[s, p, t] is the total of months [0, t), so row 0 is all zeros
+    sums = values[:, :, 0]
+    prefix = np.zeros(sums.shape[:2] + (n_months + 1,) + sums.shape[3:], dtype=np.float64)
+    np.cumsum(sums, axis=2, dtype=np.float64, out=prefix[:, :, 1:])
+
+    # blocks[0, s, p, t] is the max from the start of t's block up to t, blocks[1, s, p, t] from t to the end of its
+    # block; the months are padded with -inf to whole blocks and the padding dropped again
+    maxes = values[:, :, 1]
+    n_blocks = -(-n_months // block_months)
+    padded = np.full(maxes.shape[:2] + (n_blocks * block_months,) + maxes.shape[3:], -np.inf)
+    padded[:, :, :n_months] = maxes
+    by_block = padded.reshape(maxes.shape[:2] + (n_blocks, block_months) + maxes.shape[3:])
+    blocks = np.empty((2,) + maxes.shape, dtype=np.float64)
+    running_up = np.maximum.accumulate(by_block, axis=3)
+    running_down = np.maximum.accumulate(by_block[:, :, :, ::-1], axis=3)[:, :, :, ::-1]
+    blocks[0] = running_up.reshape(padded.shape)[:, :, :n_months]
+    blocks[1] = running_down.reshape(padded.shape)[:, :, :n_months]
+
+    # sparse[k, s, p, b] is the max of blocks [b, b + 2**k); entries running past the end repeat the last level
+    block_maxes = blocks[1][:, :, ::block_months]
+    levels = int(np.log2(n_blocks)) + 1
+    sparse = np.empty((levels,) + block_maxes.shape, dtype=np.float64)
+    sparse[0] = block_maxes
+    for k in range(1, levels):
+        half = 1 << (k - 1)
+        sparse[k] = sparse[k - 1]
+        np.maximum(sparse[k - 1][:, :, :-half], sparse[k - 1][:, :, half:], out=sparse[k][:, :, :-half])
+
+    for name, array in ((prefix_file, prefix), (block_file, blocks), (sparse_file, sparse)):
+        path = os.path.join(data_path, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+    meta_path = os.path.join(data_path, index_meta_file)
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'cube': file_signature(os.path.join(data_path, cube_file)), 'block_months': block_months}, f)
+    os.replace(tmp_path, meta_path)
+
+
+def index_is_current(data_path):
+    """
+    Check that the index files exist and were built from the cube currently on disk, with the current block size.
+    """
+    meta_path = os.path.join(data_path, index_meta_file)
+    if not all(os.path.exists(os.path.join(data_path, name))
+               for name in (prefix_file, block_file, sparse_file, index_meta_file)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta.get('block_months') == block_months
+            and meta['cube'] == file_signature(os.path.join(data_path, cube_file)))
+
+
+class RangeIndex:
+    """
+    Answers per-region totals and maxima over an inclusive (year, month) range of the scenario cube.
+    """
+
+    def __init__(self, cube, prefix, blocks, sparse):
+        self.cube = cube
+        self.prefix = prefix
+        self.blocks = blocks
+        self.sparse = sparse
+        self.n_months = cube.values.shape[3]
+
+    def month_position(self, year, month):
+        return (year - self.cube.start_year) * 12 + (month - self.cube.start_month)
+
+    def month_range(self, start_year, start_month, end_year, end_month):
+        """
+        Return the clipped (first, last) cube rows of the range, or None when no month of the data falls in it.
+        """
+        first = max(self.month_position(start_year, start_month), 0)
+        last = min(self.month_position(end_year, end_month), self.n_months - 1)
+        if first > last:
+            return None
+        return first, last
+
+    def range_max(self, s, p, first, last, positions):
+        """
+        Max of months first..last for the regions at positions, for scenario row s (an index, or slice(None) for all).
+        """
+        first_block, last_block = first // block_months, last // block_months
+        if first_block == last_block:
+            return self.cube.values[s, p, 1][..., first:last + 1, positions].max(axis=-2)
+        result = np.maximum(self.blocks[1, s, p][..., first, positions], self.blocks[0, s, p][..., last, positions])
+        if last_block - first_block > 1:
+            first_block, last_block = first_block + 1, last_block - 1
+            k = int(np.log2(last_block - first_block + 1))
+            level = self.sparse[k, s, p]
+            np.maximum(result, level[..., first_block, positions], out=result)
+            np.maximum(result, level[..., last_block - (1 << k) + 1, positions], out=result)
+        return result
+
+    @timed_phase('read')
+    def aggregate(self, scenario_value, projection_bool, max_bool, regions, start_year, start_month, end_year, end_month):
+        """
+        Total (or max, when max_bool is set) demand of each region over the selected months.
+
+        Returns:
+        - A float array aligned with regions, all NaN when the range holds no data.
+        """
+        positions = self.cube.region_positions(regions)
+        month_range = self.month_range(start_year, start_month, end_year, end_month)
+        if month_range is None:
+            return np.full(len(positions), np.nan)
+        first, last = month_range
+        s = self.cube.scenario_index[scenario_value]
+        p = int(bool(projection_bool))
+        if max_bool:
+            return self.range_max(s, p, first, last, positions)
+        return self.prefix[s, p, last + 1, positions] - self.prefix[s, p, first, positions]
+
+    @timed_phase('read')
+    def aggregate_scenarios(self, projection_bool, max_bool, regions, start_year, start_month, end_year, end_month):
+        """
+        Same as aggregate for every scenario at once.
+
+        Returns:
+        - A (scenario, region) float array, rows in cube.scenarios order, all NaN when the range holds no data.
+        """
+        positions = self.cube.region_positions(regions)
+        month_range = self.month_range(start_year, start_month, end_year, end_month)
+        if month_range is None:
+            return np.full((len(self.cube.scenarios), len(positions)), np.nan)
+        first, last = month_range
+        p = int(bool(projection_bool))
+        if max_bool:
+            return self.range_max(slice(None), p, first, last, positions)
+        return self.prefix[:, p, last + 1, positions] - self.prefix[:, p, first, positions]
+
+
+def load_range_index(data_path, cube, rebuild=False):
+    """
+    Memory-map the range index for a cube, building it first if it is missing or older than the cube.
+    """
+    if rebuild or not index_is_current(data_path):
+        build_range_index(data_path, cube)
+    prefix = np.load(os.path.join(data_path, prefix_file), mmap_mode='r')
+    blocks = np.load(os.path.join(data_path, block_file), mmap_mode='r')
+    sparse = np.load(os.path.join(data_path, sparse_file), mmap_mode='r')
+    return RangeIndex(cube, prefix, blocks, sparse)
@@ -0,0 +1,222 @@
+#import require package
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from callback_metrics import timed_phase
+from memory_budget import compact_array
+
+"""
+====================================================================================================================
+Binary scenario cube: the 20 monthly demand CSVs packed into one memory-mapped float array
+indexed by scenario x projection flag x sum/max x (Year, Month) x region
+
+In compact mode (DATA_COMPACT=1) the cube is written as float32 when every value survives the round trip (see
+memory_budget.py), and the Year/Month arrays are kept in the smallest integer types
+====================================================================================================================
+"""
+
+scenarios = ['rcp85hotter', 'rcp85cooler', 'rcp45hotter', 'rcp45cooler', 'projection']
+cube_file = 'scenario_cube.npy'
+cube_meta_file = 'scenario_cube.json'
+
+
+def scenario_file_name(scenario_value, projection_bool, max_bool):
+    """
+    Return the name of the monthly CSV in web_page_data for one scenario/projection/max combination.
+    """
+    if projection_bool:
+        if max_bool:
+            return f'_project_max_{scenario_value}_monthlly.csv'
+        return f'_project_mock_{scenario_value}.csv'
+    if max_bool:
+        return f'max_{scenario_value}_monthlly.csv'
+    return f'mock_{scenario_value}.csv'
+
+
+def source_files(data_path):
+    """
+    List every CSV packed into the cube, in cube order (scenario, projection flag, sum/max).
+    """
+    return [os.path.join(data_path, scenario_file_name(scenario_value, projection_bool, max_bool))
+            for scenario_value in scenarios
+            for projection_bool in (False, True)
+            for max_bool in (False, True)]
+
+
+def file_signature(file_path):
+    """
+    Return the (size, mtime_ns) pair used to detect that a source file has changed.
+    """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_scenario_cube(data_path, compact=False):
+    """
+    Parse the 20 monthly CSVs once and write them to a single .npy array plus a JSON sidecar.
+
+    Parameters:
+    - data_path: the web_page_data folder holding the CSVs; the cube is written next to them.
+    - compact: write the cube as float32 when no value loses precision.
+
+    Returns:
+    - The metadata dictionary written to the sidecar.
+    """
+    files = source_files(data_path)
+    frames = [pd.read_csv(file_path).sort_values(['Year', 'Month']) for file_path in files]
+
+    first = frames[0]
+    regions = [c for c in first.columns if c not in ('Unnamed: 0', 'Year', 'Month')]
+    years = first['Year'].to_numpy()
+    months = first['Month'].to_numpy()
+
+    cube = np.empty((len(scenarios), 2, 2, len(first), len(regions)), dtype=np.float64)
+    for i, df in enumerate(frames):
+        if not (np.array_equal(df['Year'].to_numpy(), years) and np.array_equal(df['Month'].to_numpy(), months)):
+            raise ValueError(f'{files[i]} does not cover the same months as {files[0]}')
+        s, rest = divmod(i, 4)
+        p, m = divmod(rest, 2)
+        # Select by name so files with a different column order still line up
+        cube[s, p, m] = df[regions].to_numpy(dtype=np.float64)
+    if compact:
+        cube = compact_array(cube)
+
+    meta = {
+        'scenarios': scenarios,
+        'regions': regions,
+        'start_year': int(years[0]),
+        'start_month': int(months[0]),
+        'years': years.tolist(),
+        'months': months.tolist(),
+        'sources': {os.path.basename(f): file_signature(f) for f in files},
+        'compact': bool(compact),
+    }
+
+    # Write to temporary names and rename, so a worker never maps a half-written file
+    cube_path = os.path.join(data_path, cube_file)
+    meta_path = os.path.join(data_path, cube_meta_file)
+    # The names carry the process id, so two workers rebuilding at once never write the same temporary file
+    tmp_path = f'{cube_path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, cube)
+    os.replace(tmp_path, cube_path)
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+    return meta
+
+
+def cube_is_current(data_path, compact=False):
+    """
+    Check that the cube exists and was built, in the same compact mode, from the CSVs currently on disk.
+    """
+    cube_path = os.path.join(data_path, cube_file)
+    meta_path = os.path.join(data_path, cube_meta_file)
+    if not (os.path.exists(cube_path) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta.get('compact', False) != bool(compact):
+        return False
+    try:
+        return all(meta['sources'].get(os.path.basename(f)) == file_signature(f) for f in source_files(data_path))
+    except FileNotFoundError:
+        # Source CSVs were removed after the build; the cube is all that is left, so trust it
+        return True
+
+
+class ScenarioCube:
+    """
+    Read-only view over the memory-mapped cube. Slicing returns numpy views, no text is parsed.
+    """
+
+    def __init__(self, values, meta):
+        self.values = values
+        self.scenarios = meta['scenarios']
+        self.regions = meta['regions']
+        self.years = np.asarray(meta['years'])
+        self.months = np.asarray(meta['months'])
+        if meta.get('compact', False):
+            self.years = compact_array(self.years)
+            self.months = compact_array(self.months)
+        self.start_year = meta['start_year']
+        self.start_month = meta['start_month']
+        self.scenario_index = {s: i for i, s in enumerate(self.scenarios)}
+        self.region_index = {r: i for i, r in enumerate(self.regions)}
+
+    def region_positions(self, regions):
+        return [self.region_index[r] for r in regions]
+
+    def block(self, scenario_value, projection_bool, max_bool):
+        """
+        Return the (month, region) array for one scenario/projection/max combination.
+        """
+        return self.values[self.scenario_index[scenario_value], int(bool(projection_bool)), int(bool(max_bool))]
+
+    @timed_phase('read')
+    def scenario_matrix(self, projection_bool, max_bool, region):
+        """
+        Return one region for every scenario at once as a (scenario, month) array, rows in self.scenarios order.
+        """
+        return self.values[:, int(bool(projection_bool)), int(bool(max_bool)), :, self.region_index[region]]
+
+    def yearly(self, matrix, max_bool):
+        """
+        Roll a (..., month) array up to years with a single sum (or max) reduction.
+
+        Returns:
+        - The years and the (..., year) array.
+        """
+        starts = np.flatnonzero(np.r_[True, self.years[1:] != self.years[:-1]])
+        reduce = np.maximum if max_bool else np.add
+        return self.years[starts], reduce.reduceat(matrix, starts, axis=-1)
+
+    def frame(self, scenario_value, projection_bool, max_bool, regions):
+        """
+        Return a DataFrame shaped like pd.read_csv(file_path, usecols=['Year', 'Month'] + regions).
+        """
+        block = self.block(scenario_value, projection_bool, max_bool)
+        df = pd.DataFrame(block[:, self.region_positions(regions)], columns=regions)
+        df.insert(0, 'Month', self.months)
+        df.insert(0, 'Year', self.years)
+        return df
+
+
+def load_scenario_cube(data_path, rebuild=False, compact=False):
+    """
+    Memory-map the scenario cube, building it first if it is missing, older than its CSVs or in the other mode.
+
+    Parameters:
+    - data_path: the web_page_data folder.
+    - rebuild: force the cube to be rebuilt from the CSVs.
+    - compact: use the compact cube, see build_scenario_cube.
+
+    Returns:
+    - A ScenarioCube.
+    """
+    if rebuild or not cube_is_current(data_path, compact):
+        build_scenario_cube(data_path, compact)
+    with open(os.path.join(data_path, cube_meta_file)) as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(data_path, cube_file), mmap_mode='r')
+    return ScenarioCube(values, meta)
+
+
+if __name__ == '__main__':
+    data_path = os.path.join(os.getcwd(), 'web_page_data')
+    from range_index import load_range_index
+
+    compact = os.environ.get('DATA_COMPACT', '0') == '1'
+    meta = build_scenario_cube(data_path, compact)
+    print(f"Packed {len(meta['sources'])} files, {len(meta['years'])} months x {len(meta['regions'])} regions "
+          f"into {os.path.join(data_path, cube_file)}")
+    from scenario_envelope import load_scenario_envelope
+
+    cube = load_scenario_cube(data_path, compact=compact)
+    load_range_index(data_path, cube, rebuild=True)
+    print('Built the date-range index')
+    load_scenario_envelope(data_path, cube, rebuild=True)
+    print('Built the cross-scenario envelope')
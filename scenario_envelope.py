@@ -0,0 +1,89 @@
+#import require package
+import json
+import os
+
+import numpy as np
+
+from scenario_cube import cube_file, file_signature
+
+"""
+====================================================================================================================
+Cross-scenario envelope of the scenario cube: for every projection flag, sum/max slice, month and region, the
+minimum, median and maximum over the five climate scenarios and their spread (max - min), computed in one pass over
+the stacked scenario axis and memory-mapped like the cube, so one read replaces reading the five scenarios
+====================================================================================================================
+"""
+
+envelope_file = 'scenario_envelope.npy'
+envelope_meta_file = 'scenario_envelope.json'
+envelope_stats = ['min', 'median', 'max', 'spread']
+
+
+def envelope_of(values, axis=0):
+    """
+    Min, median, max and spread of an array over its scenario axis.
+
+    Returns:
+    - An array with the scenario axis replaced by a leading axis in envelope_stats order.
+    """
+    ordered = np.sort(values, axis=axis)
+    low = np.take(ordered, 0, axis=axis)
+    high = np.take(ordered, -1, axis=axis)
+    return np.stack([low, np.median(ordered, axis=axis), high, high - low])
+
+
+def build_scenario_envelope(data_path, cube):
+    """
+    Precompute the envelope of the whole cube and write it next to it.
+
+    Parameters:
+    - data_path: the web_page_data folder holding the cube.
+    - cube: the ScenarioCube to summarise.
+    """
+    envelope = envelope_of(np.asarray(cube.values, dtype=np.float64))
+    path = os.path.join(data_path, envelope_file)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, envelope)
+    os.replace(tmp_path, path)
+    meta_path = os.path.join(data_path, envelope_meta_file)
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'cube': file_signature(os.path.join(data_path, cube_file)), 'stats': envelope_stats}, f)
+    os.replace(tmp_path, meta_path)
+
+
+def envelope_is_current(data_path):
+    """
+    Check that the envelope exists and was built from the cube currently on disk.
+    """
+    meta_path = os.path.join(data_path, envelope_meta_file)
+    if not (os.path.exists(os.path.join(data_path, envelope_file)) and os.path.exists(meta_path)):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta['cube'] == file_signature(os.path.join(data_path, cube_file)) and meta['stats'] == envelope_stats
+
+
+class ScenarioEnvelope:
+    """
+    Read-only view over the memory-mapped envelope, indexed by stat x projection flag x sum/max x month x region.
+    """
+
+    def __init__(self, cube, values):
+        self.cube = cube
+        self.values = values
+
+    def series(self, projection_bool, max_bool, region):
+        """
+        Return one region as a (stat, month) array, rows in envelope_stats order.
+        """
+        return self.values[:, int(bool(projection_bool)), int(bool(max_bool)), :, self.cube.region_index[region]]
+
+
+def load_scenario_envelope(data_path, cube, rebuild=False):
+    """
+    Memory-map the envelope of a cube, building it first if it is missing or older than the cube.
+    """
+    if rebuild or not envelope_is_current(data_path):
+        build_scenario_envelope(data_path, cube)
+    return ScenarioEnvelope(cube, np.load(os.path.join(data_path, envelope_file), mmap_mode='r'))
@@ -0,0 +1,195 @@
+#import require package
+import argparse
+import json
+import os
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+from flask import Response, abort, request
+
+from build_geometry import tier_path
+
+"""
+====================================================================================================================
+Point to region lookup over the map polygons: one bulk-loaded STRtree per breakdown, queried with a whole array of
+points at once, so thousands of lat/lon points (weather stations, customer sites) get their subregion and state in
+a single vectorized call instead of a Python loop over Point objects
+
+Polygons come from the full-resolution GeoJSON written by build_geometry.py, or from the GeoPackage when it has not
+been run; shapely (and geopandas for the fallback) are only imported when a tree is first built
+
+The dashboard serves the lookup on its Flask server, points as comma-separated lists or a JSON body:
+
+    GET /api/locate?lon=-74.0,-118.2&lat=40.7,34.1
+    POST /api/locate  {"lon": [...], "lat": [...]}
+
+and it runs on a CSV with lon and lat columns from the repository root:
+    python spatial_index.py stations.csv --output stations_located.csv
+====================================================================================================================
+"""
+
+
+def layer_polygons(data_path, breakdown, gpkg_path, label):
+    """
+    Read the region names and polygons of one breakdown, in lon/lat.
+
+    Returns:
+    - An array of names and an array of shapely geometries.
+    """
+    import shapely
+
+    file_path = tier_path(data_path, breakdown, 'full')
+    if os.path.exists(file_path):
+        with open(file_path) as f:
+            features = json.load(f)['features']
+        names = [feature['properties'][label] for feature in features]
+        geometries = shapely.from_geojson([json.dumps(feature['geometry']) for feature in features])
+        return np.array(names, dtype=object), geometries
+    import geopandas as gpd
+    gdf = gpd.read_file(gpkg_path).to_crs(epsg=4326)
+    return gdf[label].to_numpy(dtype=object), gdf.geometry.to_numpy()
+
+
+class SpatialIndex:
+    """
+    Region lookup for points, the tree of a breakdown is built on first use and kept.
+    """
+
+    def __init__(self, data_path, layers):
+        """
+        Parameters:
+        - data_path: the web_page_data folder.
+        - layers: {breakdown: (GeoPackage path, name column)} of the breakdowns to index.
+        """
+        self.data_path = data_path
+        self.layers = layers
+        self.trees = {}
+        self.lock = threading.Lock()
+
+    def tree(self, breakdown):
+        tree = self.trees.get(breakdown)
+        if tree is None:
+            with self.lock:
+                tree = self.trees.get(breakdown)
+                if tree is None:
+                    import shapely
+                    gpkg_path, label = self.layers[breakdown]
+                    names, geometries = layer_polygons(self.data_path, breakdown, gpkg_path, label)
+                    tree = (shapely.STRtree(geometries), names)
+                    self.trees[breakdown] = tree
+        return tree
+
+    def warm(self):
+        for breakdown in self.layers:
+            self.tree(breakdown)
+
+    def memory_bytes(self):
+        """
+        (private, mapped) bytes held by the built trees for the memory report: the polygon coordinates, counted
+        without copying them out of GEOS, and the region names.
+        """
+        import shapely
+
+        private = 0
+        for tree, names in self.trees.values():
+            private += int(shapely.get_num_coordinates(tree.geometries).sum()) * 2 * 8
+            private += names.nbytes + sum(sys.getsizeof(name) for name in names)
+        return private, 0
+
+    def lookup(self, breakdown, lon, lat):
+        """
+        Name of the region of every point, None for points outside every region.
+
+        Parameters:
+        - breakdown: one of the indexed breakdowns.
+        - lon, lat: arrays of coordinates in degrees.
+
+        Returns:
+        - An object array of names aligned with the points.
+        """
+        import shapely
+
+        tree, names = self.tree(breakdown)
+        points = shapely.points(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        # Candidates from the tree's bounding boxes, then the exact test, all in one call; intersects keeps points
+        # lying on a border, the first region found wins
+        point_positions, region_positions = tree.query(points, predicate='intersects')
+        result = np.full(len(points), None, dtype=object)
+        _, first = np.unique(point_positions, return_index=True)
+        result[point_positions[first]] = names[region_positions[first]]
+        return result
+
+    def locate(self, lon, lat):
+        """
+        Return a DataFrame of the points with one column per indexed breakdown holding their region.
+        """
+        df = pd.DataFrame({'lon': lon, 'lat': lat})
+        for breakdown in self.layers:
+            df[breakdown] = self.lookup(breakdown, df['lon'], df['lat'])
+        return df
+
+
+# Most points answered by one request
+max_locate_points = 100000
+
+
+def coordinates(values, name):
+    """
+    Parse one coordinate list of a request, aborting with 400 when it is not a list of numbers.
+    """
+    if isinstance(values, str):
+        values = [value for value in values.split(',') if value.strip()]
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        abort(400, description=f'{name} must be a list of numbers')
+
+
+def install_locate_api(server, spatial_index):
+    """
+    Add the /api/locate route to the Flask server.
+
+    Parameters:
+    - server: the Flask app behind Dash.
+    - spatial_index: the SpatialIndex to query.
+    """
+    @server.route('/api/locate', methods=['GET', 'POST'])
+    def locate_points():
+        if request.method == 'POST':
+            body = request.get_json(silent=True)
+            if not isinstance(body, dict):
+                abort(400, description='send a JSON object with lon and lat lists')
+        else:
+            body = request.args
+        lon = coordinates(body.get('lon', []), 'lon')
+        lat = coordinates(body.get('lat', []), 'lat')
+        if lon.ndim != 1 or lon.shape != lat.shape:
+            abort(400, description='lon and lat must be lists of the same length')
+        if len(lon) > max_locate_points:
+            abort(413, description=f'at most {max_locate_points} points per request')
+        df = spatial_index.locate(lon, lat)
+        return Response(json.dumps({column: df[column].tolist() for column in df.columns}),
+                        mimetype='application/json')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add the subregion and state of every lon/lat point of a CSV')
+    parser.add_argument('points', help='CSV with lon and lat columns')
+    parser.add_argument('--output', help='CSV to write, default: print to the terminal')
+    args = parser.parse_args()
+
+    data_path = os.path.join(os.getcwd(), 'web_page_data')
+    spatial_index = SpatialIndex(data_path, {'subregion': (os.path.join(data_path, 'gdf_subregion.gpkg'), 'rb'),
+                                             'state': (os.path.join(data_path, 'gdf_state.gpkg'), 'state')})
+    points = pd.read_csv(args.points)
+    located = spatial_index.locate(points['lon'].to_numpy(), points['lat'].to_numpy())
+    for breakdown in spatial_index.layers:
+        points[breakdown] = located[breakdown]
+    if args.output:
+        points.to_csv(args.output, index=False)
+        print(f'Located {points[list(spatial_index.layers)].notna().all(axis=1).sum()} of {len(points)} points, '
+              f'wrote {args.output}')
+    else:
+        print(points.to_string(index=False))
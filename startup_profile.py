@@ -0,0 +1,95 @@
+#import require package
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+"""
+====================================================================================================================
+Cold-start profiler for dashboard_future.py: the dashboard calls mark() after each load step, this module records
+how long each step took since the previous mark. Importing this module first starts the clock
+
+Run from the repository root to check the cold start against a budget:
+    python startup_profile.py --budget 2.0
+It imports the dashboard in a fresh interpreter with -X importtime, prints the load steps and the slowest imported
+packages, and exits with status 1 when the import took longer than the budget (seconds)
+====================================================================================================================
+"""
+
+started = time.perf_counter()
+marks = []
+
+
+def mark(name):
+    """
+    Record that the load step called name just finished.
+    """
+    marks.append((name, time.perf_counter()))
+
+
+def report():
+    """
+    Return the duration of every step and the total since this module was imported.
+    """
+    steps = []
+    previous = started
+    for name, at in marks:
+        steps.append({'step': name, 'seconds': at - previous})
+        previous = at
+    return {'total_s': previous - started, 'steps': steps}
+
+
+def import_times(stderr, depth=1):
+    """
+    Sum the cumulative -X importtime of the packages imported at a given nesting depth (1 = imported directly by the
+    dashboard module), by top-level package name.
+    """
+    totals = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if len(name) - len(name.lstrip(' ')) - 1 != depth * 2:
+            continue
+        package = name.strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(cumulative) / 1e6
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile the cold start of the dashboard.')
+    parser.add_argument('--budget', type=float, default=None, help='fail when the import takes longer (seconds)')
+    parser.add_argument('--top', type=int, default=10, help='number of imported packages to list')
+    args = parser.parse_args()
+
+    code = 'import startup_profile, json, dashboard_future; print(json.dumps(startup_profile.report()))'
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=os.getcwd(),
+                               capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+    if completed.returncode != 0:
+        print(completed.stderr[-2000:])
+        sys.exit(completed.returncode)
+    profile = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    print(f"{'step':<28}{'seconds':>10}")
+    for step in profile['steps']:
+        print(f"{step['step']:<28}{step['seconds']:>10.3f}")
+    print(f"{'dashboard import':<28}{profile['total_s']:>10.3f}")
+    print(f"{'process wall time':<28}{wall_s:>10.3f}")
+    print('\nSlowest imports of the dashboard (importtime adds overhead, compare them to each other)')
+    totals = import_times(completed.stderr)
+    for package, seconds in sorted(totals.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{package:<28}{seconds:>10.3f}')
+
+    if args.budget is not None:
+        if profile['total_s'] > args.budget:
+            print(f"\nOVER BUDGET: {profile['total_s']:.3f}s > {args.budget:.3f}s")
+            sys.exit(1)
+        print(f"\nWithin budget: {profile['total_s']:.3f}s <= {args.budget:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#import require package
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from callback_metrics import timed_phase
+from memory_budget import compact_array
+
+"""
+====================================================================================================================
+Region-keyed index over the degree-day and extreme-weather summaries (all_hdd_*, all_cdd_*, all_*_outliers_*summary_*):
+each table is read once, region names are case-folded once, and every region keeps contiguous Year/value arrays,
+so a lookup is a dictionary access instead of a scan of the whole table
+====================================================================================================================
+"""
+
+
+def weather_file_name(weather, heat_or_cold, scenario_value, projection_bool):
+    """
+    Return the summary file holding one weather view of one scenario.
+    """
+    if weather == 'degree_day':
+        # Degree days do not depend on the projection flag
+        return f"all_{'hdd' if heat_or_cold == 'Heat' else 'cdd'}_{scenario_value}.csv"
+    extreme = 'max' if heat_or_cold == 'Heat' else 'min'
+    kind = 'outliers_summary' if weather == 'Num_of_days' else 'outliers_demand_summary'
+    suffix = '_project_' if projection_bool else ''
+    return f'all_{extreme}_{kind}_{scenario_value}{suffix}.csv'
+
+
+def weather_value_column(weather, heat_or_cold):
+    if weather == 'degree_day':
+        return 'hdd' if heat_or_cold == 'Heat' else 'cdd'
+    return 'number_of_days' if weather == 'Num_of_days' else 'average_total_load'
+
+
+def index_table(df, value_column, compact=False):
+    """
+    Group a summary table by lower-cased region into {region: (years, values)}, keeping the file order of the rows.
+    With compact, years and values are stored in the smallest types that hold them exactly (float32 within 1e-6).
+    """
+    regions = df['region'].str.lower().to_numpy()
+    order = np.argsort(regions, kind='stable')
+    regions = regions[order]
+    years = df['Year'].to_numpy()[order]
+    values = df[value_column].to_numpy()[order]
+    if compact:
+        years = compact_array(years)
+        values = compact_array(values)
+    boundaries = np.flatnonzero(regions[1:] != regions[:-1]) + 1
+    starts = np.r_[0, boundaries]
+    ends = np.r_[boundaries, len(regions)]
+    return {regions[s]: (years[s:e], values[s:e]) for s, e in zip(starts, ends)}
+
+
+class WeatherIndex:
+    """
+    Lazily indexed summary tables, each file is read the first time it is needed and kept for the process lifetime.
+    """
+
+    def __init__(self, data_path, compact=False):
+        self.data_path = data_path
+        self.compact = compact
+        self.tables = {}
+        self.lock = threading.Lock()
+
+    def table(self, file_name, value_column):
+        table = self.tables.get(file_name)
+        if table is None:
+            with self.lock:
+                table = self.tables.get(file_name)
+                if table is None:
+                    file_path = os.path.join(self.data_path, file_name)
+                    # A missing file is indexed as empty, so it is not looked for again on every request
+                    table = index_table(pd.read_csv(file_path), value_column, self.compact) \
+                        if os.path.exists(file_path) else {}
+                    self.tables[file_name] = table
+        return table
+
+    def warm(self, scenario_values):
+        """
+        Index every summary file of the given scenarios now, instead of on the first request that needs it.
+        """
+        for scenario_value in scenario_values:
+            for weather in ('Num_of_days', 'average_t2', 'degree_day'):
+                for heat_or_cold in ('Heat', 'Cold'):
+                    for projection_bool in (False, True):
+                        self.table(weather_file_name(weather, heat_or_cold, scenario_value, projection_bool),
+                                   weather_value_column(weather, heat_or_cold))
+
+    @timed_phase('read')
+    def series(self, weather, heat_or_cold, projection_bool, scenario_value, region, start_year, end_year):
+        """
+        Return the (years, values) of a region between start_year and end_year, or None when there is no data.
+        """
+        table = self.table(weather_file_name(weather, heat_or_cold, scenario_value, projection_bool),
+                           weather_value_column(weather, heat_or_cold))
+        entry = table.get(region.lower())
+        if entry is None:
+            return None
+        years, values = entry
+        mask = (years >= start_year) & (years <= end_year)
+        if not mask.any():
+            return None
+        return years[mask], values[mask]